@@ -0,0 +1,130 @@
+"""
+Cross-image slice batching.
+
+Slices from consecutive images are gathered into fixed-size batches, so the model
+always sees full batches (instead of the last, partial batch of every image).
+Every slice carries its source image and offset, which is used to send the
+detections back to the right image once all of its slices have been predicted.
+"""
+from collections import namedtuple
+from pathlib import Path
+
+from detections import Detections, concatenate_detections, empty_detections, shift_detections
+from profiling import NULL_PROFILER
+from tile_reader import get_slice_bboxes, open_window_reader
+
+ImageJob = namedtuple("ImageJob", ["path", "width", "height"])
+
+# image: ImageJob, bbox: (x_min, y_min, x_max, y_max), num_slices: slices in the image,
+# array: RGB uint8 pixels of the slice. An image without any slice to predict (all
+# skipped) is passed on as a single task with num_slices 0 and no bbox or array.
+# An image whose reading fails after it was opened ends with a task with num_slices
+# READ_FAILED, so the slices of it that were already passed on are dropped.
+SliceTask = namedtuple("SliceTask", ["image", "bbox", "num_slices", "array"])
+READ_FAILED = -1
+
+
+def iter_image_slices(image_path, slice_width, overlap_ratio, slice_filter=None, profiler=NULL_PROFILER):
+    """
+    Yield a SliceTask for every slice window of one image, read window by window.
+    With a slice_filter.SliceFilter, only the slices it keeps are read.
+    profiler: profiling.Profiler that gets the read and slice times.
+    When reading fails, a READ_FAILED task is yielded before the error is raised.
+    """
+    with profiler.span("read", image_path):
+        reader = open_window_reader(image_path)
+    with reader:
+        image = ImageJob(Path(image_path), reader.width, reader.height)
+        try:
+            with profiler.span("slice", image_path):
+                slice_bboxes = get_slice_bboxes(
+                    reader.width, reader.height, slice_width, slice_width, overlap_ratio, overlap_ratio
+                )
+                if slice_filter is not None:
+                    slice_bboxes = slice_filter.filter_slices(reader, slice_bboxes)
+            profiler.count("slices", len(slice_bboxes), image_path)
+            if not slice_bboxes:
+                yield SliceTask(image, None, 0, None)
+            for bbox in slice_bboxes:
+                with profiler.span("read", image_path):
+                    array = reader.read_window(*bbox)
+                yield SliceTask(image, tuple(bbox), len(slice_bboxes), array)
+        except Exception:
+            yield SliceTask(image, None, READ_FAILED, None)
+            raise
+
+
+def iter_folder_slices(image_paths, slice_width, overlap_ratio, slice_filter=None, profiler=NULL_PROFILER):
+    """Yield the SliceTasks of all images, one image after the other."""
+    for image_path in image_paths:
+        yield from iter_image_slices(image_path, slice_width, overlap_ratio, slice_filter, profiler)
+
+
+def ultralytics_predict_batch(model, confidence_threshold, device, profiler=NULL_PROFILER, max_detections=300):
+    """
+    Wrap an ultralytics YOLO model as a predict_batch function:
+    list of RGB uint8 arrays -> list of Detections (in slice coordinates).
+    At most max_detections boxes are kept per slice (ultralytics' max_det).
+    The preprocess, forward and postprocess times ultralytics measures go to profiler.
+    """
+    def predict_batch(images):
+        # YOLO expects BGR numpy arrays, a list of arrays is run as one batch
+        results = model([image[:, :, ::-1] for image in images], conf=confidence_threshold, device=device,
+                        max_det=max_detections, verbose=False)
+        # speed: milliseconds per image of every step, the batch time divided over its images
+        for stage, step in (("preprocess", "preprocess"), ("forward", "inference"), ("postprocess", "postprocess")):
+            profiler.add(stage, sum(r.speed[step] for r in results) / 1000)
+        detections = []
+        for r in results:
+            data = r.boxes.data.cpu().numpy()
+            detections.append(Detections(data[:, :4], data[:, 4], data[:, 5].astype("int64")))
+        return detections
+
+    return predict_batch
+
+
+def run_batched_inference(slice_stream, predict_batch, batch_size, profiler=NULL_PROFILER):
+    """
+    Run the model on slices from many images in batches of batch_size.
+
+    Args:
+        slice_stream: iterable of SliceTask, slices of an image may be interleaved
+            with slices of other images.
+        predict_batch: function mapping a list of RGB arrays to a list of Detections.
+        batch_size (int): number of slices per forward pass.
+        profiler: profiling.Profiler, the time of every batch is charged to its images.
+
+    Yields:
+        (ImageJob, Detections) in full image coordinates, as soon as the last slice of
+        an image has been predicted. Detections are not yet merged across slices.
+        An image ended by a READ_FAILED task is dropped with a message.
+    """
+    pending = {}
+    batch = []
+
+    def flush():
+        with profiler.for_images([task.image.path for task in batch]):
+            predictions = predict_batch([task.array for task in batch])
+        for task, detections in zip(batch, predictions):
+            x_min, y_min, x_max, y_max = task.bbox
+            parts = pending.setdefault(task.image, [])
+            parts.append(shift_detections(detections, x_min, y_min, x_max - x_min, y_max - y_min))
+            if len(parts) == task.num_slices:
+                del pending[task.image]
+                yield task.image, concatenate_detections(parts)
+        batch.clear()
+
+    for task in slice_stream:
+        if task.num_slices == READ_FAILED:
+            batch[:] = [other for other in batch if other.image != task.image]
+            pending.pop(task.image, None)
+            print(f"Image {task.image.path} not written, reading its slices failed")
+            continue
+        if not task.num_slices:
+            yield task.image, empty_detections()
+            continue
+        batch.append(task)
+        if len(batch) == batch_size:
+            yield from flush()
+    if batch:
+        yield from flush()
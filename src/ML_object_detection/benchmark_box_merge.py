@@ -0,0 +1,94 @@
+"""
+Benchmark the vectorized box merging (box_merge) against SAHI's postprocess on
+synthetic dense scenes, like sliced predictions of an orthophoto with thousands
+of small objects (chimneys).
+
+Every scene is a grid of slices with overlap. Objects are placed at random and
+every slice containing (part of) an object predicts it with a little jitter, so
+objects in the overlap strips are predicted two or four times.
+
+Usage:
+    python benchmark_box_merge.py --objects 1000 5000 20000
+"""
+import argparse
+import time
+
+import numpy as np
+from sahi.postprocess.combine import GreedyNMMPostprocess, NMMPostprocess, NMSPostprocess
+from sahi.prediction import ObjectPrediction
+
+from box_merge import merge_detections
+from detections import Detections, concatenate_detections, shift_detections
+from tile_reader import get_slice_bboxes
+
+SAHI_POSTPROCESS = {"greedy_nmm": GreedyNMMPostprocess, "nmm": NMMPostprocess, "nms": NMSPostprocess}
+
+
+def synthetic_scene(num_objects, image_size, slice_size=640, overlap_ratio=0.0625, num_classes=2, seed=0):
+    """Detections of all slices of one image, in image coordinates (not merged)."""
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0, image_size - 40, (num_objects, 2))
+    wh = rng.uniform(8, 40, (num_objects, 2))
+    boxes = np.concatenate([xy, xy + wh], axis=1)
+    class_ids = rng.integers(0, num_classes, num_objects)
+
+    parts = []
+    for x_min, y_min, x_max, y_max in get_slice_bboxes(image_size, image_size, slice_size, slice_size, overlap_ratio, overlap_ratio):
+        inside = (boxes[:, 2] > x_min) & (boxes[:, 0] < x_max) & (boxes[:, 3] > y_min) & (boxes[:, 1] < y_max)
+        jitter = rng.normal(0, 1.0, (inside.sum(), 4))
+        local = boxes[inside] + jitter - [x_min, y_min, x_min, y_min]
+        scores = rng.uniform(0.3, 1.0, inside.sum())
+        detections = Detections(local.astype(np.float32), scores.astype(np.float32), class_ids[inside])
+        parts.append(shift_detections(detections, x_min, y_min, x_max - x_min, y_max - y_min))
+    return concatenate_detections(parts)
+
+
+def sahi_merge(detections, method, image_size, match_metric, match_threshold):
+    """Merge with SAHI's postprocess, returns the merged boxes as an (N, 4) array."""
+    object_predictions = [
+        ObjectPrediction(bbox=box.tolist(), category_id=int(class_id), category_name=str(class_id),
+                         score=float(score), full_shape=[image_size, image_size])
+        for box, score, class_id in zip(detections.boxes, detections.scores, detections.class_ids)
+    ]
+    start = time.perf_counter()
+    postprocess = SAHI_POSTPROCESS[method](match_threshold=match_threshold, match_metric=match_metric, class_agnostic=False)
+    merged = postprocess(object_predictions)
+    seconds = time.perf_counter() - start
+    return np.array([p.bbox.to_xyxy() for p in merged], dtype=np.float32).reshape(-1, 4), seconds
+
+
+def box_set(boxes):
+    return {tuple(box) for box in np.round(boxes, 2).tolist()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark box_merge against SAHI's postprocess")
+    parser.add_argument("--objects", type=int, nargs="+", default=[1000, 5000, 20000], help="Objects per scene (default: 1000 5000 20000)")
+    parser.add_argument("--density", type=float, default=2000.0, help="Objects per megapixel, sets the image size (default: 2000)")
+    parser.add_argument("--methods", nargs="+", choices=list(SAHI_POSTPROCESS), default=list(SAHI_POSTPROCESS), help="Merge methods to compare")
+    parser.add_argument("--match_metric", choices=["IOU", "IOS"], default="IOS", help="Overlap metric (default: IOS)")
+    parser.add_argument("--match_threshold", type=float, default=0.5, help="Match threshold (default: 0.5)")
+    args = parser.parse_args()
+
+    # the first SAHI call imports and selects its backend, keep that out of the timings
+    for method in args.methods:
+        sahi_merge(synthetic_scene(100, 500), method, 500, args.match_metric, args.match_threshold)
+
+    print(f"{'objects':>8} {'boxes':>8} {'method':>10} {'sahi (s)':>9} {'ours (s)':>9} {'speedup':>8} {'kept':>7} {'agree':>6}")
+    for num_objects in args.objects:
+        image_size = int(np.sqrt(num_objects / args.density) * 1000)
+        detections = synthetic_scene(num_objects, image_size)
+        for method in args.methods:
+            sahi_boxes, sahi_seconds = sahi_merge(detections, method, image_size, args.match_metric, args.match_threshold)
+
+            start = time.perf_counter()
+            _, merged = merge_detections(detections, method, args.match_metric, args.match_threshold)
+            seconds = time.perf_counter() - start
+
+            agree = box_set(sahi_boxes) == box_set(merged.boxes)
+            print(f"{num_objects:>8} {len(detections.scores):>8} {method:>10} {sahi_seconds:>9.3f} {seconds:>9.3f} "
+                  f"{sahi_seconds / seconds:>7.1f}x {len(merged.scores):>7} {str(agree):>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark the startup time of the cli.py commands, like a shell pipeline that
+calls them thousands of times sees it: every run is a new Python process that
+prints the help of a command (which imports the command's module).
+
+    cold -> the first run, without any bytecode cache: every module, of the
+            repository and of the standard library and site-packages, is compiled
+            from source (a fresh PYTHONPYCACHEPREFIX). With --drop_caches the OS
+            page cache is also dropped first (Linux, needs root).
+    warm -> the median of --repeats runs after that, with the bytecode cached.
+
+The heavy dependencies a command loaded at startup are listed from -X importtime,
+none should appear. "python" is the startup of the bare interpreter.
+
+Usage:
+    python benchmark_cli_startup.py --repeats 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from cli import COMMANDS
+
+CLI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+HEAVY_MODULES = ("torch", "ultralytics", "sahi", "rasterio", "osgeo", "cv2", "onnxruntime", "tqdm")
+
+
+def drop_page_cache():
+    subprocess.run(["sync"], check=True)
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def run_seconds(command, env):
+    start = time.perf_counter()
+    subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def heavy_imports(command, env):
+    """Top level heavy modules imported by a run, from -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", *command[1:]], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    imported = {line.rsplit("|", 1)[-1].strip().split(".")[0] for line in result.stderr.splitlines() if line.startswith("import time:")}
+    return sorted(imported.intersection(HEAVY_MODULES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the cold and warm startup of the cli.py commands")
+    parser.add_argument("--commands", nargs="+", choices=list(COMMANDS), default=list(COMMANDS), help="Commands to time (default: all)")
+    parser.add_argument("--repeats", type=int, default=10, help="Warm runs per command (default: 10)")
+    parser.add_argument("--drop_caches", action="store_true", help="Drop the OS page cache before every cold run (Linux, needs root)")
+    args = parser.parse_args()
+
+    runs = [("python", [sys.executable, "-c", "pass"])]
+    runs += [(name, [sys.executable, CLI_PATH, name, "--help"]) for name in args.commands]
+
+    print(f"{'command':>10} {'cold (s)':>9} {'warm (s)':>9} {'min (s)':>8}  heavy imports")
+    for name, command in runs:
+        with tempfile.TemporaryDirectory() as pycache:
+            env = dict(os.environ, PYTHONPYCACHEPREFIX=pycache)
+            env.pop("PYTHONDONTWRITEBYTECODE", None)  # the warm runs need the cache the cold run writes
+            if args.drop_caches:
+                drop_page_cache()
+            cold = run_seconds(command, env)
+            warm = [run_seconds(command, env) for _ in range(args.repeats)]
+            heavy = heavy_imports(command, env)
+        print(f"{name:>10} {cold:>9.3f} {statistics.median(warm):>9.3f} {min(warm):>8.3f}  {', '.join(heavy) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
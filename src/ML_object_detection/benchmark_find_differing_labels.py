@@ -0,0 +1,71 @@
+"""
+Benchmark the indexed box comparison of find_differing_labels (find_unmatched)
+against comparing all pairs with iou(), as filter_shapes did before.
+
+The scenes imitate model suggestions against human labels of a full image: the
+second list holds jittered copies of most boxes of the first list plus some
+extra boxes. For large scenes the all-pairs time is extrapolated from a sample
+of rows, and the results are checked on that sample.
+
+Usage:
+    python benchmark_find_differing_labels.py --boxes 1000 10000 100000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from find_differing_labels import find_unmatched, iou
+
+
+def synthetic_scene(num_boxes, density=2000.0, seed=0):
+    """Two lists of (xmin, ymin, xmax, ymax) with num_boxes boxes each."""
+    rng = np.random.default_rng(seed)
+    image_size = np.sqrt(num_boxes / density) * 1000
+    xy = rng.uniform(0, image_size, (num_boxes, 2))
+    wh = rng.uniform(8, 40, (num_boxes, 2))
+    boxes1 = np.concatenate([xy, xy + wh], axis=1)
+
+    boxes2 = boxes1 + rng.normal(0, 4.0, boxes1.shape)
+    missing = rng.random(num_boxes) < 0.1
+    extra_xy = rng.uniform(0, image_size, (missing.sum(), 2))
+    boxes2[missing] = np.concatenate([extra_xy, extra_xy + wh[missing]], axis=1)
+    boxes2 = np.concatenate([np.minimum(boxes2[:, :2], boxes2[:, 2:]), np.maximum(boxes2[:, :2], boxes2[:, 2:])], axis=1)
+    return [tuple(b) for b in boxes1.round(2).tolist()], [tuple(b) for b in boxes2.round(2).tolist()]
+
+
+def all_pairs_unmatched(rows, boxes, threshold):
+    """The reference: every box of rows against every box of boxes with iou()."""
+    return np.array([all(iou(b1, b2) <= threshold for b2 in boxes) for b1 in rows], dtype=bool)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark find_unmatched against the all-pairs iou() loop")
+    parser.add_argument("--boxes", type=int, nargs="+", default=[1000, 10000, 100000], help="Boxes per list (default: 1000 10000 100000)")
+    parser.add_argument("--threshold", type=float, default=0.5, help="IoU threshold (default: 0.5)")
+    parser.add_argument("--sample_rows", type=int, default=200, help="Rows timed with the all-pairs loop for large scenes (default: 200)")
+    args = parser.parse_args()
+
+    print(f"{'boxes':>8} {'all pairs (s)':>14} {'indexed (s)':>12} {'speedup':>9} {'unmatched':>10} {'same':>5}")
+    for num_boxes in args.boxes:
+        boxes1, boxes2 = synthetic_scene(num_boxes)
+
+        start = time.perf_counter()
+        unmatched1, unmatched2 = find_unmatched(boxes1, boxes2, args.threshold)
+        seconds = time.perf_counter() - start
+
+        # both directions, as filter_shapes did
+        rows = min(num_boxes, args.sample_rows) if num_boxes > 2000 else num_boxes
+        start = time.perf_counter()
+        reference1 = all_pairs_unmatched(boxes1[:rows], boxes2, args.threshold)
+        reference2 = all_pairs_unmatched(boxes2[:rows], boxes1, args.threshold)
+        reference_seconds = (time.perf_counter() - start) * num_boxes / rows
+
+        same = np.array_equal(reference1, unmatched1[:rows]) and np.array_equal(reference2, unmatched2[:rows])
+        estimated = "~" if rows < num_boxes else ""
+        print(f"{num_boxes:>8} {estimated + format(reference_seconds, '.2f'):>14} {seconds:>12.3f} "
+              f"{reference_seconds / seconds:>8.0f}x {unmatched1.sum() + unmatched2.sum():>10} {str(same):>5}")
+
+
+if __name__ == "__main__":
+    main()
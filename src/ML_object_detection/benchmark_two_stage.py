@@ -0,0 +1,103 @@
+"""
+Check the two-stage (coarse-to-fine) mode of infer_with_sahi.py against the
+exhaustive sliced inference on a held-out folder of images.
+
+Every image is run both ways with the same model and merge. The detections of the
+exhaustive run are taken as reference: an exhaustive box is recalled when the
+two-stage run has a box of the same class with IoU >= --iou. The report gives
+the recall per class, the share of slices run at full resolution and the time per
+image of both modes.
+
+Usage:
+    python benchmark_two_stage.py --weights best.onnx --backend onnxruntime --folder held_out/ --coarse_classes Skorsten
+"""
+import argparse
+import os
+import time
+from collections import Counter
+
+import numpy as np
+
+from batched_inference import iter_image_slices, run_batched_inference
+from box_ops import candidate_pairs, pair_metric
+from coarse_to_fine import COARSE_CONFIDENCE_THRESHOLD, COARSE_FACTOR, MARGIN, CoarseSliceSelector, thresholded
+from detector_backends import BACKENDS, MAX_DETECTIONS, MAX_NMS, load_backend
+from infer_with_sahi import CONFIDENCE_THRESHOLD, postprocess_detections
+
+
+def run_image(image_path, predict_batch, names, slice_width, overlap_ratio, batch_size, slice_filter=None):
+    """Merged detections of one image and the seconds it took."""
+    start = time.perf_counter()
+    slice_stream = iter_image_slices(image_path, slice_width, overlap_ratio, slice_filter)
+    (image, detections), = run_batched_inference(slice_stream, predict_batch, batch_size)
+    detections = postprocess_detections(detections, "greedy_nmm", names, image.width, image.height)
+    return detections, time.perf_counter() - start
+
+
+def recalled(reference, detections, iou_threshold):
+    """Boolean array, True for the reference boxes matched by a box of the same class in detections."""
+    found = np.zeros(len(reference.scores), dtype=bool)
+    i, j = candidate_pairs(reference.boxes, detections.boxes)
+    same_class = reference.class_ids[i] == detections.class_ids[j]
+    i, j = i[same_class], j[same_class]
+    iou = pair_metric(reference.boxes[i].astype(np.float64), detections.boxes[j].astype(np.float64), "IOU")
+    found[i[iou >= iou_threshold]] = True
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall and speed of the two-stage mode against exhaustive sliced inference")
+    parser.add_argument("--weights", required=True, help="Model weights (.pt) or ONNX export")
+    parser.add_argument("--backend", choices=BACKENDS, default="ultralytics", help="Detector backend (default: ultralytics)")
+    parser.add_argument("--folder", required=True, help="Folder of held-out images")
+    parser.add_argument("--slice_width", type=int, default=640, help="Slice width (default: 640)")
+    parser.add_argument("--overlap_ratio", type=float, default=0.0625, help="Slice overlap ratio (default: 0.0625)")
+    parser.add_argument("--batch_size", type=int, default=8, help="Slices per forward pass (default: 8)")
+    parser.add_argument("--coarse_factor", type=int, default=COARSE_FACTOR, help=f"Reduction of the coarse pass (default: {COARSE_FACTOR})")
+    parser.add_argument("--coarse_margin", type=int, default=MARGIN, help=f"Margin around the candidates in pixels (default: {MARGIN})")
+    parser.add_argument("--coarse_confidence", type=float, default=COARSE_CONFIDENCE_THRESHOLD, help=f"Confidence threshold of the candidates (default: {COARSE_CONFIDENCE_THRESHOLD})")
+    parser.add_argument("--coarse_classes", nargs="+", default=None, help="Class names selecting slices (default: all); recall is reported for all classes")
+    parser.add_argument("--iou", type=float, default=0.5, help="IoU of a recalled box (default: 0.5)")
+    args = parser.parse_args()
+
+    detector = load_backend(args.backend, args.weights, min(CONFIDENCE_THRESHOLD, args.coarse_confidence), max_detections=MAX_NMS)
+    names = detector.names
+    predict_batch = thresholded(detector.predict_batch, CONFIDENCE_THRESHOLD, MAX_DETECTIONS)
+    class_ids = None
+    if args.coarse_classes:
+        class_ids = [class_id for class_id, name in names.items() if name in args.coarse_classes]
+    selector = CoarseSliceSelector(detector.predict_batch, args.slice_width, args.coarse_factor, args.coarse_margin, class_ids, args.batch_size)
+
+    image_paths = sorted(
+        os.path.join(args.folder, name) for name in os.listdir(args.folder)
+        if name.lower().endswith(('.png', '.jpg', '.jpeg', '.tif', '.bmp', '.gif'))
+    )
+    # warm up, so the first image does not pay for it
+    run_image(image_paths[0], predict_batch, names, args.slice_width, args.overlap_ratio, args.batch_size)
+
+    reference_counts, recalled_counts = Counter(), Counter()
+    exhaustive_seconds = two_stage_seconds = 0.0
+    for image_path in image_paths:
+        reference, seconds = run_image(image_path, predict_batch, names, args.slice_width, args.overlap_ratio, args.batch_size)
+        exhaustive_seconds += seconds
+        detections, seconds = run_image(image_path, predict_batch, names, args.slice_width, args.overlap_ratio, args.batch_size, selector)
+        two_stage_seconds += seconds
+
+        found = recalled(reference, detections, args.iou)
+        reference_counts.update(reference.class_ids.tolist())
+        recalled_counts.update(reference.class_ids[found].tolist())
+        print(f"{os.path.basename(image_path)}: {found.sum()} of {len(found)} boxes recalled")
+
+    print(f"\n{'class':>16} {'boxes':>7} {'recall':>7}")
+    for class_id in sorted(reference_counts):
+        print(f"{names[class_id]:>16} {reference_counts[class_id]:>7} {recalled_counts[class_id] / reference_counts[class_id]:>7.3f}")
+    total = sum(reference_counts.values())
+    print(f"{'all':>16} {total:>7} {sum(recalled_counts.values()) / total if total else 1.0:>7.3f}")
+    selector.report()
+    print(f"seconds per image: exhaustive {exhaustive_seconds / len(image_paths):.2f}, "
+          f"two-stage {two_stage_seconds / len(image_paths):.2f} "
+          f"({exhaustive_seconds / two_stage_seconds:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Vectorized, class-aware merging of overlapping detections (NMS, NMM, greedy NMM).
+
+Used as the postprocess for sliced inference (detections of overlapping slices)
+and for merging tiled LabelMe JSON back onto the large image.
+
+The semantics follow SAHI's postprocess (boxes are visited in score order and
+a box matches when its IOU/IOS with the kept box is >= match_threshold), but the
+overlaps are only computed for candidate pairs found with a uniform grid
+(box_ops.candidate_pairs), and only boxes that actually match something go
+through the sequential part. For a dense image with thousands of boxes that are
+mostly unique, almost all of the work is a handful of NumPy calls.
+"""
+import numpy as np
+
+from box_ops import candidate_pairs, pair_metric
+from detections import Detections
+
+MERGE_METHODS = ("greedy_nmm", "nmm", "nms")
+
+
+def score_order(boxes, scores):
+    """Indices by descending score, ties broken by the box coordinates (as SAHI does)."""
+    return np.lexsort((boxes[:, 3], boxes[:, 2], boxes[:, 1], boxes[:, 0], -scores))
+
+
+def match_pairs(detections, match_metric="IOU", match_threshold=0.5, class_agnostic=False, groups=None):
+    """
+    All pairs (i, j), i < j, with IOU/IOS >= match_threshold.
+
+    Args:
+        detections: Detections.
+        match_metric (str): "IOU" or "IOS".
+        match_threshold (float): minimum overlap for a match.
+        class_agnostic (bool): if False only boxes of the same class match.
+        groups: optional (N,) array, boxes in the same group never match
+            (e.g. boxes from the same tile, which the model has already de-duplicated).
+    """
+    # no upcast: SAHI matches in float32 too, which decides overlaps right at the threshold
+    boxes = np.asarray(detections.boxes)
+    if match_threshold <= 0:
+        # every pair matches, even without overlap
+        i, j = np.triu_indices(len(boxes), 1)
+    else:
+        i, j = candidate_pairs(boxes)
+    mask = np.ones(len(i), dtype=bool)
+    if not class_agnostic:
+        mask &= detections.class_ids[i] == detections.class_ids[j]
+    if groups is not None:
+        groups = np.asarray(groups)
+        mask &= groups[i] != groups[j]
+    i, j = i[mask], j[mask]
+    if match_threshold > 0:
+        matched = pair_metric(boxes[i], boxes[j], match_metric) >= match_threshold
+        i, j = i[matched], j[matched]
+    return i, j
+
+
+def _claims(n, src, dst, sort_key):
+    """
+    CSR lists (indptr, indices) of the directed edges src -> dst, every row
+    sorted by sort_key[dst]. Returned as Python lists for the sequential loops.
+    """
+    order = np.lexsort((sort_key[dst], src))
+    indptr = np.searchsorted(src[order], np.arange(n + 1))
+    return indptr.tolist(), dst[order].tolist()
+
+
+def _metric(box_a, box_b, match_metric):
+    inter_w = min(box_a[2], box_b[2]) - max(box_a[0], box_b[0])
+    inter_h = min(box_a[3], box_b[3]) - max(box_a[1], box_b[1])
+    inter = max(0.0, inter_w) * max(0.0, inter_h)
+    area_a = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1])
+    area_b = (box_b[2] - box_b[0]) * (box_b[3] - box_b[1])
+    denominator = area_a + area_b - inter if match_metric == "IOU" else min(area_a, area_b)
+    return inter / denominator if denominator > 0 else 0.0
+
+
+def _dominates(detections, src, dst):
+    """
+    For the directed match edges src -> dst: may box src claim box dst in NMM?
+    Yes for a lower score, or an equal score and coordinates not lexicographically
+    greater than its own (SAHI's rule, so tied boxes only merge when they are
+    exact duplicates).
+    """
+    scores = detections.scores
+    boxes = detections.boxes
+    less = np.zeros(len(src), dtype=bool)
+    equal = np.ones(len(src), dtype=bool)
+    for col in range(4):
+        less |= equal & (boxes[src, col] < boxes[dst, col])
+        equal &= boxes[src, col] == boxes[dst, col]
+    return (scores[dst] < scores[src]) | ((scores[dst] == scores[src]) & ~less)
+
+
+def _apply_merges(detections, keep, merge_lists, match_metric, match_threshold):
+    """
+    Merge every box in merge_lists[k] into keep[k]: union box, max score, class of the
+    higher scoring box. Like SAHI, each merge is checked again against the grown box.
+    """
+    boxes = detections.boxes.astype(np.float64)
+    scores = detections.scores
+    class_ids = detections.class_ids
+    out_boxes = boxes[keep].copy()
+    out_scores = scores[keep].copy()
+    out_class_ids = class_ids[keep].copy()
+    for k, merge_list in merge_lists.items():
+        box = out_boxes[k].tolist()
+        score = float(out_scores[k])
+        class_id = out_class_ids[k]
+        for m in merge_list:
+            other = boxes[m].tolist()
+            if _metric(box, other, match_metric) >= match_threshold:
+                box = [min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3])]
+                class_id = class_id if score > scores[m] else class_ids[m]
+                score = max(score, float(scores[m]))
+        out_boxes[k] = box
+        out_scores[k] = score
+        out_class_ids[k] = class_id
+    return Detections(out_boxes.astype(np.float32), out_scores.astype(np.float32), out_class_ids.astype(np.int64))
+
+
+def _ranks(order):
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return rank
+
+
+def _lower_ranked(rank, i, j):
+    """Orient the match pairs from the higher to the lower scoring box."""
+    swap = rank[i] > rank[j]
+    return np.where(swap, j, i), np.where(swap, i, j)
+
+
+def nms(detections, match_metric="IOU", match_threshold=0.5, class_agnostic=False, groups=None):
+    """
+    Non-maximum suppression.
+
+    Returns:
+        (keep, Detections): indices of the kept boxes in score order and the kept detections.
+    """
+    n = len(detections.scores)
+    order = score_order(detections.boxes, detections.scores)
+    rank = _ranks(order)
+    src, dst = _lower_ranked(rank, *match_pairs(detections, match_metric, match_threshold, class_agnostic, groups))
+    indptr, indices = _claims(n, src, dst, rank)
+
+    suppressed = [False] * n
+    for idx in order[np.isin(order, src)].tolist():
+        if not suppressed[idx]:
+            for m in indices[indptr[idx]:indptr[idx + 1]]:
+                suppressed[m] = True
+    suppressed = np.array(suppressed, dtype=bool)
+    keep = order[~suppressed[order]]
+    return keep, Detections(detections.boxes[keep], detections.scores[keep], detections.class_ids[keep])
+
+
+def greedy_nmm(detections, match_metric="IOS", match_threshold=0.5, class_agnostic=False, groups=None):
+    """
+    Greedy non-maximum merging: every kept box absorbs the lower scoring boxes that
+    directly match it (no transitive merging). The default postprocess of SAHI.
+
+    Returns:
+        (keep, Detections): indices of the kept boxes in score order and the merged detections.
+    """
+    n = len(detections.scores)
+    order = score_order(detections.boxes, detections.scores)
+    rank = _ranks(order)
+    src, dst = _lower_ranked(rank, *match_pairs(detections, match_metric, match_threshold, class_agnostic, groups))
+    indptr, indices = _claims(n, src, dst, rank)
+
+    suppressed = [False] * n
+    merges = {}
+    for idx in order[np.isin(order, src)].tolist():
+        if suppressed[idx]:
+            continue
+        candidates = [m for m in indices[indptr[idx]:indptr[idx + 1]] if not suppressed[m]]
+        for m in candidates:
+            suppressed[m] = True
+        if candidates:
+            merges[idx] = candidates
+
+    suppressed = np.array(suppressed, dtype=bool)
+    keep = order[~suppressed[order]]
+    position = {int(idx): k for k, idx in enumerate(keep)}
+    merge_lists = {position[idx]: candidates for idx, candidates in merges.items()}
+    return keep, _apply_merges(detections, keep, merge_lists, match_metric, match_threshold)
+
+
+def nmm(detections, match_metric="IOS", match_threshold=0.5, class_agnostic=False, groups=None):
+    """
+    Non-maximum merging with transitive merging: a box that was merged into a kept
+    box passes on its own matches to that kept box (A~B, B~C -> A+B+C).
+
+    Returns:
+        (keep, Detections): indices of the kept boxes in score order and the merged detections.
+    """
+    n = len(detections.scores)
+    order = score_order(detections.boxes, detections.scores)
+    i, j = match_pairs(detections, match_metric, match_threshold, class_agnostic, groups)
+    src = np.concatenate([i, j])
+    dst = np.concatenate([j, i])
+    claim = _dominates(detections, src, dst)
+    indptr, indices = _claims(n, src[claim], dst[claim], np.arange(n))
+
+    merge_to_keep = [-1] * n
+    merges = {}
+    # every matched box is visited, a box becomes a keeper when it is visited unclaimed
+    for idx in order[np.isin(order, src)].tolist():
+        if merge_to_keep[idx] < 0:
+            merge_to_keep[idx] = idx
+            merges[idx] = []
+        keep_idx = merge_to_keep[idx]
+        for m in indices[indptr[idx]:indptr[idx + 1]]:
+            if merge_to_keep[m] < 0:
+                merge_to_keep[m] = keep_idx
+                merges[keep_idx].append(m)
+
+    merge_to_keep = np.array(merge_to_keep, dtype=np.int64)
+    keep = order[(merge_to_keep[order] < 0) | (merge_to_keep[order] == order)]
+    position = {int(idx): k for k, idx in enumerate(keep)}
+    merge_lists = {position[idx]: candidates for idx, candidates in merges.items() if candidates}
+    return keep, _apply_merges(detections, keep, merge_lists, match_metric, match_threshold)
+
+
+def merge_detections(detections, method="greedy_nmm", match_metric="IOS", match_threshold=0.5, class_agnostic=False, groups=None):
+    """
+    Merge overlapping detections with one of MERGE_METHODS.
+
+    Returns:
+        (keep, Detections), see nms/nmm/greedy_nmm.
+    """
+    functions = {"greedy_nmm": greedy_nmm, "nmm": nmm, "nms": nms}
+    if method not in functions:
+        raise ValueError(f"Unknown merge method {method}, use one of {MERGE_METHODS}")
+    if len(detections.scores) == 0:
+        return np.zeros(0, dtype=np.int64), detections
+    return functions[method](detections, match_metric, match_threshold, class_agnostic, groups)
@@ -0,0 +1,132 @@
+"""
+Vectorized axis-aligned box operations.
+
+Boxes are (N, 4) arrays of x1, y1, x2, y2. Instead of comparing all pairs of
+boxes, candidate pairs are found with a uniform grid: every box is registered in
+the grid cells it covers, and only boxes sharing a cell are compared. Boxes that
+overlap with a positive area always share at least one cell.
+"""
+import numpy as np
+
+
+def box_areas(boxes):
+    return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+
+def default_cell_size(*box_arrays):
+    """
+    Grid cell size of 1.5 times the median box size, so a typical box covers 1-4 cells.
+    Larger cells hold many more pairs to check, smaller ones register boxes in more cells.
+    """
+    sizes = np.concatenate([np.maximum(b[:, 2] - b[:, 0], b[:, 3] - b[:, 1]) for b in box_arrays if len(b)])
+    if len(sizes) == 0:
+        return 1.0
+    return max(float(np.median(sizes)) * 1.5, 1.0)
+
+
+def _grid_cells(boxes, cell_size):
+    """Return (box index, cell x, cell y) for every grid cell covered by every box."""
+    gx1 = np.floor(boxes[:, 0] / cell_size).astype(np.int64)
+    gy1 = np.floor(boxes[:, 1] / cell_size).astype(np.int64)
+    gx2 = np.floor(boxes[:, 2] / cell_size).astype(np.int64)
+    gy2 = np.floor(boxes[:, 3] / cell_size).astype(np.int64)
+    nx = np.maximum(gx2 - gx1 + 1, 1)
+    ny = np.maximum(gy2 - gy1 + 1, 1)
+    counts = nx * ny
+    box_index = np.repeat(np.arange(len(boxes)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    ny_rep = np.repeat(ny, counts)
+    cell_x = np.repeat(gx1, counts) + local // ny_rep
+    cell_y = np.repeat(gy1, counts) + local % ny_rep
+    return box_index, cell_x, cell_y
+
+
+def candidate_pairs(boxes, other=None, cell_size=None):
+    """
+    Find all pairs of boxes that overlap with a positive area.
+
+    Args:
+        boxes: (N, 4) array.
+        other: (M, 4) array, or None to pair boxes with themselves.
+        cell_size: grid cell size in pixels, default 1.5 times the median box size.
+
+    Returns:
+        (i, j) index arrays. With other=None i < j and both index boxes,
+        otherwise i indexes boxes and j indexes other.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    self_pairs = other is None
+    other = boxes if self_pairs else np.asarray(other, dtype=np.float64)
+    empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    if len(boxes) == 0 or len(other) == 0:
+        return empty
+    if cell_size is None:
+        cell_size = default_cell_size(boxes, other)
+
+    a_index, a_x, a_y = _grid_cells(boxes, cell_size)
+    if self_pairs:
+        b_index, b_x, b_y = a_index, a_x, a_y
+    else:
+        b_index, b_x, b_y = _grid_cells(other, cell_size)
+
+    # one int64 key per cell, offset so keys are non-negative
+    x0 = min(a_x.min(), b_x.min())
+    y0 = min(a_y.min(), b_y.min())
+    span_y = max(a_y.max(), b_y.max()) - y0 + 1
+    a_key = (a_x - x0) * span_y + (a_y - y0)
+    b_key = (b_x - x0) * span_y + (b_y - y0)
+
+    order = np.argsort(b_key, kind="stable")
+    b_key_sorted = b_key[order]
+    b_index_sorted = b_index[order]
+    starts = np.searchsorted(b_key_sorted, a_key, side="left")
+    ends = np.searchsorted(b_key_sorted, a_key, side="right")
+    counts = ends - starts
+    if counts.sum() == 0:
+        return empty
+
+    i = np.repeat(a_index, counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    j = b_index_sorted[np.repeat(starts, counts) + local]
+    cell_x = np.repeat(a_x, counts)
+    cell_y = np.repeat(a_y, counts)
+
+    if self_pairs:
+        mask = i < j
+        i, j, cell_x, cell_y = i[mask], j[mask], cell_x[mask], cell_y[mask]
+
+    left = np.maximum(boxes[i, 0], other[j, 0])
+    top = np.maximum(boxes[i, 1], other[j, 1])
+    overlapping = (np.minimum(boxes[i, 2], other[j, 2]) > left) & (np.minimum(boxes[i, 3], other[j, 3]) > top)
+    # boxes sharing several cells meet in each of them, count a pair only in the cell
+    # holding the top left corner of the intersection (both boxes cover that cell)
+    owner = (np.floor(left / cell_size) == cell_x) & (np.floor(top / cell_size) == cell_y)
+    keep = overlapping & owner
+    return i[keep], j[keep]
+
+
+def pair_intersections(boxes_a, boxes_b):
+    """Intersection areas of the row-aligned box arrays boxes_a[k], boxes_b[k]."""
+    inter_w = np.maximum(0, np.minimum(boxes_a[:, 2], boxes_b[:, 2]) - np.maximum(boxes_a[:, 0], boxes_b[:, 0]))
+    inter_h = np.maximum(0, np.minimum(boxes_a[:, 3], boxes_b[:, 3]) - np.maximum(boxes_a[:, 1], boxes_b[:, 1]))
+    return inter_w * inter_h
+
+
+def pair_metric(boxes_a, boxes_b, match_metric="IOU"):
+    """
+    IOU (intersection over union) or IOS (intersection over the smaller area)
+    of the row-aligned box arrays boxes_a[k], boxes_b[k]. 0 where the denominator is 0.
+    Computed in the dtype of the boxes.
+    """
+    inter = pair_intersections(boxes_a, boxes_b)
+    area_a = box_areas(boxes_a)
+    area_b = box_areas(boxes_b)
+    if match_metric == "IOU":
+        denominator = area_a + area_b - inter
+    elif match_metric == "IOS":
+        denominator = np.minimum(area_a, area_b)
+    else:
+        raise ValueError(f"Unknown match metric {match_metric}, use IOU or IOS")
+    out = np.zeros_like(inter)
+    np.divide(inter, denominator, out=out, where=denominator > 0)
+    return out
@@ -0,0 +1,57 @@
+"""
+One command line entry point for the tools of this repository:
+
+    python src/ML_object_detection/cli.py <command> [options]
+    python src/ML_object_detection/cli.py infer --help
+
+    infer      -> infer_with_sahi.py
+    merge      -> merge_json.py
+    split      -> split_with_gdal.py
+    diff       -> find_differing_labels.py
+    visualize  -> visualize_boundingboxes.py
+    serve      -> inference_server.py
+
+The options of every command are those of its script. Only the module of the
+command that runs is imported, and the modules import their heavy dependencies
+(torch, ultralytics, sahi, rasterio, GDAL) inside the functions that need them,
+so --help and the JSON tools start without loading any of them.
+benchmark_cli_startup.py measures the startup time of every command.
+"""
+import argparse
+import importlib
+import os
+import sys
+
+# command -> (module, description)
+COMMANDS = {
+    "infer": ("infer_with_sahi", "Sliced object detection on a folder of large images"),
+    "merge": ("merge_json", "Merge the LabelMe JSONs of the tiles of an image into one"),
+    "split": ("split_with_gdal", "Split GeoTIFFs into tiles"),
+    "diff": ("find_differing_labels", "Find differing labels between two folders of LabelMe JSONs"),
+    "visualize": ("visualize_boundingboxes", "Draw the boxes of a LabelMe JSON on a large TIFF"),
+    "serve": ("inference_server", "Serve sliced object detection with a resident model over local HTTP"),
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    prog = os.path.basename(sys.argv[0]) or "cli.py"
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description="Object detection tools for large (ortho)images.",
+        epilog="commands:\n" + "\n".join(f"  {name:<10} {description}" for name, (_, description) in COMMANDS.items())
+        + f"\n\nRun '{prog} <command> --help' for the options of a command.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("command", choices=COMMANDS, metavar="command", help="One of: " + ", ".join(COMMANDS))
+    # everything after the command, --help included, belongs to the command
+    args = parser.parse_args(argv[:1])
+
+    module = importlib.import_module(COMMANDS[args.command][0])
+    # the usage and errors of the command read "cli.py <command>"
+    sys.argv[0] = f"{prog} {args.command}"
+    module.main(argv[1:])
+
+
+if __name__ == "__main__":
+    main()
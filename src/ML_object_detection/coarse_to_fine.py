@@ -0,0 +1,154 @@
+"""
+Coarse-to-fine (two-stage) slice selection for sparse objects.
+
+    coarse pass -> the detector runs on the image reduced factor times (sliced into
+                   model sized slices when that is still larger), with a low
+                   confidence threshold, to find candidate regions
+    fine pass   -> only the full resolution slices that overlap a candidate box,
+                   grown by a safety margin, are run, the others are skipped
+
+A 10000 x 7000 px image has 216 slices of 640 px, reduced 4 times it is 12 coarse
+slices, so for sparse classes most of the cost of the fine pass is saved. Objects
+the coarse pass misses are lost: check the recall against the exhaustive mode with
+benchmark_two_stage.py before using it for a class.
+
+CoarseSliceSelector has the filter_slices interface of slice_filter.SliceFilter,
+so the batched inference treats it like any other slice filter.
+"""
+import threading
+import time
+
+import numpy as np
+
+from box_ops import candidate_pairs
+from detections import Detections, concatenate_detections, shift_detections
+from tile_reader import get_slice_bboxes
+
+COARSE_FACTOR = 4
+COARSE_CONFIDENCE_THRESHOLD = 0.1
+MARGIN = 128
+
+
+def serialized(predict_batch):
+    """predict_batch behind a lock, for a model shared by the reader threads (coarse) and the main thread (fine)."""
+    lock = threading.Lock()
+
+    def predict(images):
+        with lock:
+            return predict_batch(images)
+
+    return predict
+
+
+def thresholded(predict_batch, confidence_threshold, max_detections=None):
+    """
+    predict_batch keeping only detections scoring above confidence_threshold,
+    and of those the max_detections highest scoring per image (None: all).
+
+    Lets one model loaded with the lower coarse threshold serve the fine pass too.
+    NMS only suppresses boxes with higher scoring ones, so the boxes above the
+    threshold are the same as with a model loaded with that threshold, up to the
+    maximum number of detections per slice of the model (ultralytics' max_det,
+    detector_backends.MAX_DETECTIONS), which also counts the boxes between the two
+    thresholds. Load the shared model without that maximum (detector_backends.MAX_NMS),
+    which also keeps all candidates of the dense coarse slices, and pass the
+    maximum as max_detections to get the boxes of a model loaded with
+    confidence_threshold.
+    """
+    def predict(images):
+        results = []
+        for d in predict_batch(images):
+            keep = np.flatnonzero(d.scores > confidence_threshold)
+            if max_detections is not None and len(keep) > max_detections:
+                keep = keep[np.argsort(-d.scores[keep], kind="stable")[:max_detections]]
+            results.append(Detections(d.boxes[keep], d.scores[keep], d.class_ids[keep]))
+        return results
+
+    return predict
+
+
+def read_reduced(reader, factor):
+    """The image of reader reduced factor times, area averaged from an overview of half that reduction."""
+    import cv2
+
+    overview = reader.read_overview(max(1, factor // 2))
+    width, height = -(-reader.width // factor), -(-reader.height // factor)
+    if overview.shape[:2] == (height, width):
+        return overview
+    return cv2.resize(overview, (width, height), interpolation=cv2.INTER_AREA)
+
+
+class CoarseSliceSelector:
+    """
+    Keeps the slices of an image that overlap a candidate of the coarse pass.
+
+    Args:
+        predict_batch: The detector (list of RGB arrays -> list of Detections), called
+            from the reader threads, serialize it when the main thread also uses it.
+        slice_width (int): Size of the coarse slices, the model input size.
+        factor (int): Reduction of the image in the coarse pass.
+        margin (int): Safety margin added around every candidate box, in full resolution pixels.
+        class_ids (list): Only candidates of these classes select slices (default: all).
+        batch_size (int): Coarse slices per forward pass.
+    """
+
+    def __init__(self, predict_batch, slice_width=640, factor=COARSE_FACTOR, margin=MARGIN, class_ids=None, batch_size=8):
+        self.predict_batch = predict_batch
+        self.slice_width = slice_width
+        self.factor = factor
+        self.margin = margin
+        self.class_ids = None if class_ids is None else np.asarray(class_ids, dtype=np.int64)
+        self.batch_size = batch_size
+        self.slices = 0
+        self.kept = 0
+        self.coarse_slices = 0
+        self.coarse_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def coarse_detections(self, reader):
+        """Detections of the coarse pass, in full resolution pixels."""
+        reduced = read_reduced(reader, self.factor)
+        height, width = reduced.shape[:2]
+        bboxes = get_slice_bboxes(width, height, self.slice_width, self.slice_width, 0.0, 0.0)
+        parts = []
+        for start in range(0, len(bboxes), self.batch_size):
+            batch = bboxes[start:start + self.batch_size]
+            predictions = self.predict_batch([np.ascontiguousarray(reduced[y0:y1, x0:x1]) for x0, y0, x1, y1 in batch])
+            for (x0, y0, x1, y1), detections in zip(batch, predictions):
+                parts.append(shift_detections(detections, x0, y0, x1 - x0, y1 - y0))
+        detections = concatenate_detections(parts)
+        scale = np.array([reader.width / width, reader.height / height] * 2, dtype=np.float32)
+        return Detections(detections.boxes * scale, detections.scores, detections.class_ids), len(bboxes)
+
+    def filter_slices(self, reader, slice_bboxes):
+        """
+        Args:
+            reader: An open tile_reader window reader of the image.
+            slice_bboxes (list): [x_min, y_min, x_max, y_max] slice windows of the image.
+
+        Returns:
+            the slice windows that overlap a candidate region.
+        """
+        start = time.perf_counter()
+        detections, num_coarse = self.coarse_detections(reader)
+        boxes = detections.boxes
+        if self.class_ids is not None:
+            boxes = boxes[np.isin(detections.class_ids, self.class_ids)]
+        regions = boxes + np.array([-self.margin, -self.margin, self.margin, self.margin], dtype=np.float32)
+
+        kept = []
+        if len(slice_bboxes) and len(regions):
+            slice_indices, _ = candidate_pairs(np.asarray(slice_bboxes, dtype=np.float64), regions)
+            kept = [slice_bboxes[i] for i in np.unique(slice_indices)]
+
+        with self._lock:
+            self.slices += len(slice_bboxes)
+            self.kept += len(kept)
+            self.coarse_slices += num_coarse
+            self.coarse_seconds += time.perf_counter() - start
+        return kept
+
+    def report(self):
+        share = 100 * self.kept / self.slices if self.slices else 0.0
+        print(f"Two-stage: {self.kept} of {self.slices} slices ({share:.1f}%) ran at full resolution, "
+              f"coarse pass: {self.coarse_slices} slices in {self.coarse_seconds:.1f} s")
@@ -0,0 +1,468 @@
+"""
+Columnar detection store: the detections of many images in a few flat arrays
+instead of one indented LabelMe JSON per image.
+
+A store is a directory:
+
+    meta.json      -> format version and the class names (class id -> name)
+    images.jsonl   -> one line per image: name, path, width, height and the rows
+                      [start, start + count) of its detections
+    x1.npy y1.npy x2.npy y2.npy score.npy -> float32 columns, boxes in pixels
+    class_id.npy image_id.npy             -> int32 columns
+
+The rows of an image are contiguous. The columns are plain .npy files, loaded
+memory-mapped, so a query over a campaign only reads the columns it uses. The
+writer appends image by image: the rows go to the end of every column, the
+fixed-size .npy headers are rewritten with the new length and then the image line
+is appended. A run that crashes loses at most the image it was writing.
+
+Converters from and to LabelMe JSON folders and GeoJSON:
+
+    python detection_store.py from_labelme --json_folder results/ --store results.dets
+    python detection_store.py to_labelme --store results.dets --json_folder labelme/
+    python detection_store.py to_geojson --store results.dets --output detections.fgb
+    python detection_store.py from_geojson --geojson detections.geojsonl --image_folder images/ --store results.dets
+    python detection_store.py info --store results.dets
+
+infer_with_sahi.py writes a store with --store, merge_json.py and
+find_differing_labels.py read a store wherever they read a folder of LabelMe JSON.
+"""
+import argparse
+import json
+import struct
+from pathlib import Path
+
+import numpy as np
+
+from detections import Detections
+from file_utils import atomic_write_json
+from image_probe import get_image_size
+
+META_NAME = "meta.json"
+IMAGES_NAME = "images.jsonl"
+FORMAT_VERSION = 1
+COLUMNS = {
+    "x1": np.float32, "y1": np.float32, "x2": np.float32, "y2": np.float32,
+    "score": np.float32, "class_id": np.int32, "image_id": np.int32,
+}
+# .npy header (magic, version, length and the padded dict) of every column, fixed so it
+# can be rewritten in place when rows are appended
+NPY_HEADER_SIZE = 128
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+
+
+def is_store(path):
+    """True when path is a detection store directory."""
+    return (Path(path) / META_NAME).is_file()
+
+
+def npy_header(dtype, length):
+    """The NPY_HEADER_SIZE bytes .npy (version 1.0) header of a 1-d array of length items."""
+    header = repr({"descr": np.dtype(dtype).str, "fortran_order": False, "shape": (length,)})
+    header_length = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2
+    return NPY_MAGIC + struct.pack("<H", header_length) + header.ljust(header_length - 1).encode("latin1") + b"\n"
+
+
+def write_meta(path, names):
+    atomic_write_json({"format": "detection_store", "version": FORMAT_VERSION,
+                       "names": {str(class_id): name for class_id, name in sorted(names.items())}},
+                      Path(path) / META_NAME)
+
+
+def read_images(path):
+    """The image records of a store, a line cut short by a crash is left out."""
+    images = []
+    with open(Path(path) / IMAGES_NAME, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                images.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return images
+
+
+class DetectionStore:
+    """
+    Reads a detection store.
+
+    Args:
+        path (str): The store directory.
+        mmap_mode (str): np.load mmap_mode of the columns, None to read them into memory.
+
+    Attributes:
+        names (dict): class id -> name.
+        images (list): image records (name, path, width, height, start, count), by image id.
+        image_ids (dict): image name -> image id.
+        columns (dict): column name -> 1-d array, see COLUMNS.
+    """
+
+    def __init__(self, path, mmap_mode="r"):
+        self.path = Path(path)
+        with open(self.path / META_NAME, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"{path} is a detection store of version {meta.get('version')}, expected {FORMAT_VERSION}")
+        self.names = {int(class_id): name for class_id, name in meta["names"].items()}
+        self.images = read_images(self.path)
+        self.image_ids = {image["name"]: image_id for image_id, image in enumerate(self.images)}
+        rows = self.images[-1]["start"] + self.images[-1]["count"] if self.images else 0
+        self.columns = {
+            column: np.load(self.path / f"{column}.npy", mmap_mode=mmap_mode)[:rows] for column in COLUMNS
+        }
+
+    def __len__(self):
+        return len(self.columns["score"])
+
+    @property
+    def boxes(self):
+        """(N, 4) float32 x1, y1, x2, y2 of all rows."""
+        return np.stack([self.columns[column] for column in ("x1", "y1", "x2", "y2")], axis=1)
+
+    def detections(self, image_id):
+        """Detections of one image."""
+        image = self.images[image_id]
+        rows = slice(image["start"], image["start"] + image["count"])
+        return Detections(
+            np.stack([self.columns[column][rows] for column in ("x1", "y1", "x2", "y2")], axis=1),
+            np.array(self.columns["score"][rows], dtype=np.float32),
+            np.array(self.columns["class_id"][rows], dtype=np.int64),
+        )
+
+    def iter_images(self):
+        """Yield (image record, Detections) of every image."""
+        for image_id, image in enumerate(self.images):
+            yield image, self.detections(image_id)
+
+    def labelme_dict(self, image_id, shapes=None):
+        """The LabelMe JSON dict of one image, with shapes or else its detections (with their score) as shapes."""
+        from infer_with_sahi import create_labelme_json_dict
+
+        image = self.images[image_id]
+        if shapes is None:
+            shapes = labelme_shapes(self.detections(image_id), self.names)
+        return create_labelme_json_dict(Path(image["path"]), shapes, (image["width"], image["height"]))
+
+
+def labelme_shapes(detections, names):
+    """LabelMe rectangle shapes of Detections, with their score, names: class id -> label."""
+    from infer_with_sahi import yolo_to_labelme_shape
+
+    return [
+        yolo_to_labelme_shape(box, names[class_id], score)
+        for box, score, class_id in zip(detections.boxes.tolist(), detections.scores.tolist(), detections.class_ids.tolist())
+    ]
+
+
+class DetectionStoreWriter:
+    """
+    Appends the detections of one image at a time to a store.
+
+    Args:
+        path (str): The store directory, created when missing.
+        append (bool): Add to the images already in the store, otherwise start it empty.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.names = {}
+        images = []
+        if append and is_store(self.path):
+            store = DetectionStore(self.path)
+            self.names = store.names
+            images = store.images
+            del store
+        self.num_images = len(images)
+        self.rows = images[-1]["start"] + images[-1]["count"] if images else 0
+
+        self.files = {}
+        for column, dtype in COLUMNS.items():
+            f = open(self.path / f"{column}.npy", "r+b" if images else "wb")
+            # drop rows written after the last complete image
+            f.truncate(NPY_HEADER_SIZE + self.rows * np.dtype(dtype).itemsize)
+            f.seek(0)
+            f.write(npy_header(dtype, self.rows))
+            self.files[column] = f
+        # rewritten, without a line cut short by a crash
+        self.images_file = open(self.path / IMAGES_NAME, "w", encoding="utf-8")
+        self.images_file.writelines(json.dumps(image) + "\n" for image in images)
+        self.images_file.flush()
+        self._write_meta()
+
+    def _write_meta(self):
+        self._written_names = dict(self.names)
+        write_meta(self.path, self.names)
+
+    def _store_class_ids(self, class_ids, names):
+        """The class ids of names as ids of the store, names new to the store are added to it."""
+        label_ids = {name: class_id for class_id, name in self.names.items()}
+        mapping = {}
+        for class_id, name in names.items():
+            if name not in label_ids:
+                new_id = class_id if class_id not in self.names else max(self.names) + 1
+                self.names[new_id] = name
+                label_ids[name] = new_id
+            mapping[class_id] = label_ids[name]
+        if len(label_ids) > len(self._written_names):
+            self._write_meta()
+        if not len(class_ids) or all(class_id == store_id for class_id, store_id in mapping.items()):
+            return class_ids
+        return np.array([mapping[class_id] for class_id in class_ids.tolist()], dtype=np.int64)
+
+    def write_image(self, image_path, detections, names, image_size=None):
+        """
+        Append the detections of an image.
+
+        Args:
+            image_path (str): The image, its name identifies it in the store.
+            detections (Detections): Boxes in pixels of the image.
+            names (dict): class id -> name of the detections.
+            image_size: (width, height) when already known, saves reading the image header.
+
+        Returns:
+            the image id in the store.
+        """
+        class_ids = self._store_class_ids(detections.class_ids, names)
+        boxes = np.asarray(detections.boxes, dtype=np.float32).reshape(-1, 4)
+        count = len(boxes)
+        values = {
+            "x1": boxes[:, 0], "y1": boxes[:, 1], "x2": boxes[:, 2], "y2": boxes[:, 3],
+            "score": detections.scores, "class_id": class_ids,
+            "image_id": np.full(count, self.num_images),
+        }
+        for column, f in self.files.items():
+            f.seek(0, 2)
+            f.write(np.ascontiguousarray(values[column], dtype=COLUMNS[column]).tobytes())
+        self.rows += count
+        for column, f in self.files.items():
+            f.seek(0)
+            f.write(npy_header(COLUMNS[column], self.rows))
+            f.flush()
+
+        width, height = image_size or get_image_size(image_path)
+        image = {"name": Path(image_path).name, "path": str(image_path), "width": width, "height": height,
+                 "start": self.rows - count, "count": count}
+        self.images_file.write(json.dumps(image) + "\n")
+        self.images_file.flush()
+        self.num_images += 1
+        return self.num_images - 1
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.images_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_store(path, names, images, columns):
+    """
+    Write a complete store at once, e.g. a selection of the rows of another store.
+
+    Args:
+        path (str): The store directory, replaced when it exists.
+        names (dict): class id -> name.
+        images (list): image records (name, path, width, height), their start and count
+            are set from the image_id column.
+        columns (dict): column name -> 1-d array of every column of COLUMNS, the rows
+            sorted by image_id.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    counts = np.bincount(np.asarray(columns["image_id"], dtype=np.int64), minlength=len(images))
+    starts = np.cumsum(counts) - counts
+    for column, dtype in COLUMNS.items():
+        values = np.ascontiguousarray(columns[column], dtype=dtype)
+        with open(path / f"{column}.npy", "wb") as f:
+            f.write(npy_header(dtype, len(values)))
+            f.write(values.tobytes())
+    with open(path / IMAGES_NAME, "w", encoding="utf-8") as f:
+        for image, start, count in zip(images, starts.tolist(), counts.tolist()):
+            f.write(json.dumps({**image, "start": start, "count": count}) + "\n")
+    write_meta(path, names)
+
+
+def labelme_to_store(json_folder, store_path):
+    """Convert a folder of LabelMe JSON into a store. Only rectangles are kept, shapes without score count as 1.0."""
+    json_files = sorted(Path(json_folder).glob("*.json"))
+    skipped = 0
+    with DetectionStoreWriter(store_path) as writer:
+        for json_file in json_files:
+            with open(json_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            shapes = data.get("shapes", [])
+            rectangles = [s for s in shapes if s.get("shape_type") == "rectangle" and len(s["points"]) == 2]
+            skipped += len(shapes) - len(rectangles)
+            labels = sorted({s["label"] for s in rectangles})
+            label_ids = {label: i for i, label in enumerate(labels)}
+            points = np.array([s["points"] for s in rectangles], dtype=np.float32).reshape(-1, 2, 2)
+            detections = Detections(
+                np.concatenate([points.min(axis=1), points.max(axis=1)], axis=1),
+                np.array([s.get("score", 1.0) for s in rectangles], dtype=np.float32),
+                np.array([label_ids[s["label"]] for s in rectangles], dtype=np.int64),
+            )
+            image_path = json_file.parent / (data.get("imagePath") or json_file.with_suffix(".tif").name)
+            writer.write_image(image_path, detections, dict(enumerate(labels)), (data["imageWidth"], data["imageHeight"]))
+    print(f"Converted {len(json_files)} JSON files into {store_path}" + (f", {skipped} shapes that are not rectangles skipped" if skipped else ""))
+
+
+def store_to_labelme(store_path, json_folder):
+    """Write the LabelMe JSON of every image of a store into json_folder."""
+    store = DetectionStore(store_path)
+    Path(json_folder).mkdir(parents=True, exist_ok=True)
+    for image_id, image in enumerate(store.images):
+        atomic_write_json(store.labelme_dict(image_id), Path(json_folder) / Path(image["name"]).with_suffix(".json").name)
+    print(f"Wrote {len(store.images)} JSON files to {json_folder}")
+
+
+def store_to_geojson(store_path, output_path, image_folder=None):
+    """
+    Write the detections of a store georeferenced, in the format of the suffix of
+    output_path (see merge_geojson.open_writer).
+
+    image_folder: where the images are, if not at the path recorded in the store (for their geotransform).
+    """
+    from geo_output import iter_image_features, read_georeference
+    from merge_geojson import open_writer
+
+    store = DetectionStore(store_path)
+    writer = open_writer(output_path)
+    skipped = 0
+    try:
+        for image_id, image in enumerate(store.images):
+            image_path = Path(image_folder) / image["name"] if image_folder else Path(image["path"])
+            geotransform, _, epsg = read_georeference(image_path)
+            if geotransform is None:
+                skipped += 1
+                continue
+            crs = {"type": "name", "properties": {"name": f"urn:ogc:def:crs:EPSG::{epsg}"}} if epsg else None
+            if writer.crs is None:
+                writer.crs = crs
+            elif crs != writer.crs:
+                print(f"Warning: {image['name']} has another CRS than the output, its detections are not written.")
+                skipped += 1
+                continue
+            for feature in iter_image_features(image_path, store.detections(image_id), store.names, geotransform):
+                writer.write(feature)
+    finally:
+        writer.close()
+    print(f"Wrote {writer.features} features to {output_path}" + (f", {skipped} images without (matching) georeference skipped" if skipped else ""))
+
+
+def pixel_bounds(bounds, geotransform):
+    """Map (N, 4) map coordinate bounds x_min, y_min, x_max, y_max into pixel boxes through the inverse geotransform."""
+    g0, g1, g2, g3, g4, g5 = geotransform
+    det = g1 * g5 - g2 * g4
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    # the four corners, the geotransform may be rotated
+    x = bounds[:, [0, 2, 2, 0]] - g0
+    y = bounds[:, [1, 1, 3, 3]] - g3
+    px = (g5 * x - g2 * y) / det
+    py = (-g4 * x + g1 * y) / det
+    return np.stack([px.min(axis=1), py.min(axis=1), px.max(axis=1), py.max(axis=1)], axis=1)
+
+
+def iter_coordinates(coordinates):
+    """Yield the positions of nested GeoJSON coordinates."""
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+    else:
+        for part in coordinates:
+            yield from iter_coordinates(part)
+
+
+def geojson_to_store(geojson_paths, image_folder, store_path):
+    """
+    Convert georeferenced detections (GeoJSON FeatureCollections or newline-delimited
+    GeoJSON with the properties image, label and optionally score) back into pixel
+    boxes of their images in image_folder, through the inverse geotransform.
+    """
+    from geo_output import NDJSON_SUFFIXES, read_georeference
+    from merge_geojson import iter_feature_collection, iter_ndjson_features
+
+    # image -> ([map bounds], [label], [score]), only the bounds of every geometry are kept
+    per_image = {}
+    labels = {}
+    for path in geojson_paths:
+        with open(path, "r", encoding="utf-8") as f:
+            members = iter_ndjson_features(f) if Path(path).suffix.lower() in NDJSON_SUFFIXES else iter_feature_collection(f)
+            for key, feature in members:
+                if key != "features" or not feature.get("geometry"):
+                    continue
+                properties = feature.get("properties") or {}
+                coordinates = np.array(list(iter_coordinates(feature["geometry"]["coordinates"])), dtype=np.float64)
+                bounds, label_list, scores = per_image.setdefault(properties["image"], ([], [], []))
+                bounds.append((*coordinates.min(axis=0)[:2], *coordinates.max(axis=0)[:2]))
+                label_list.append(labels.setdefault(properties["label"], len(labels)))
+                scores.append(properties.get("score", 1.0))
+
+    names = {class_id: label for label, class_id in labels.items()}
+    with DetectionStoreWriter(store_path) as writer:
+        for image_name, (bounds, class_ids, scores) in per_image.items():
+            image_path = Path(image_folder) / image_name
+            geotransform, _, _ = read_georeference(image_path)
+            if geotransform is None:
+                print(f"Warning: {image_path} is not georeferenced, its features are skipped.")
+                continue
+            detections = Detections(
+                pixel_bounds(bounds, geotransform).astype(np.float32),
+                np.array(scores, dtype=np.float32),
+                np.array(class_ids, dtype=np.int64),
+            )
+            writer.write_image(image_path, detections, names)
+    print(f"Converted the features of {len(per_image)} images into {store_path}")
+
+
+def store_info(store_path):
+    store = DetectionStore(store_path)
+    print(f"{store_path}: {len(store.images)} images, {len(store)} detections")
+    counts = np.bincount(store.columns["class_id"], minlength=max(store.names, default=-1) + 1)
+    for class_id, name in sorted(store.names.items()):
+        print(f"{name:>16} {counts[class_id]:>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert between detection stores, LabelMe JSON folders and GeoJSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("from_labelme", help="Folder of LabelMe JSON -> store")
+    command.add_argument("--json_folder", required=True, help="Folder with LabelMe JSON files")
+    command.add_argument("--store", required=True, help="Store directory to create")
+
+    command = commands.add_parser("to_labelme", help="Store -> folder of LabelMe JSON")
+    command.add_argument("--store", required=True, help="Store directory")
+    command.add_argument("--json_folder", required=True, help="Folder the LabelMe JSON files are written to")
+
+    command = commands.add_parser("to_geojson", help="Store -> georeferenced GeoJSON, FlatGeobuf or GeoPackage")
+    command.add_argument("--store", required=True, help="Store directory")
+    command.add_argument("--output", required=True, help="Output file: .geojson, .geojsonl/.geojsons/.ndjson, .fgb or .gpkg")
+    command.add_argument("--image_folder", default=None, help="Folder with the images, if they moved since the store was written")
+
+    command = commands.add_parser("from_geojson", help="Georeferenced GeoJSON -> store")
+    command.add_argument("--geojson", nargs="+", required=True, help="GeoJSON FeatureCollection or newline-delimited GeoJSON files")
+    command.add_argument("--image_folder", required=True, help="Folder with the images named in the image property")
+    command.add_argument("--store", required=True, help="Store directory to create")
+
+    command = commands.add_parser("info", help="Number of images and detections per class")
+    command.add_argument("--store", required=True, help="Store directory")
+
+    args = parser.parse_args(argv)
+    if args.command == "from_labelme":
+        labelme_to_store(args.json_folder, args.store)
+    elif args.command == "to_labelme":
+        store_to_labelme(args.store, args.json_folder)
+    elif args.command == "to_geojson":
+        store_to_geojson(args.store, args.output, args.image_folder)
+    elif args.command == "from_geojson":
+        geojson_to_store(args.geojson, args.image_folder, args.store)
+    else:
+        store_info(args.store)
+
+
+if __name__ == "__main__":
+    main()
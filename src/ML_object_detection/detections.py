@@ -0,0 +1,50 @@
+"""
+Array based representation of the detections of one image (or one slice).
+
+Keeping boxes, scores and class ids as NumPy arrays lets the batched inference,
+the box merging and the output writers work on whole images at a time instead of
+on one Python object per box.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+# boxes: (N, 4) float32 x1, y1, x2, y2 in pixels, scores: (N,) float32, class_ids: (N,) int64
+Detections = namedtuple("Detections", ["boxes", "scores", "class_ids"])
+
+
+def empty_detections():
+    return Detections(
+        np.zeros((0, 4), dtype=np.float32),
+        np.zeros((0,), dtype=np.float32),
+        np.zeros((0,), dtype=np.int64),
+    )
+
+
+def concatenate_detections(detections_list):
+    """Concatenate a list of Detections into one."""
+    detections_list = [d for d in detections_list if len(d.scores)]
+    if not detections_list:
+        return empty_detections()
+    return Detections(
+        np.concatenate([d.boxes for d in detections_list]).astype(np.float32, copy=False),
+        np.concatenate([d.scores for d in detections_list]).astype(np.float32, copy=False),
+        np.concatenate([d.class_ids for d in detections_list]).astype(np.int64, copy=False),
+    )
+
+
+def shift_detections(detections, offset_x, offset_y, window_width, window_height):
+    """
+    Move detections from slice coordinates to full image coordinates.
+
+    Boxes are clipped to the slice window first and boxes without area are dropped,
+    the same way SAHI treats the raw model output of a slice.
+    """
+    boxes = detections.boxes.astype(np.float32, copy=True)
+    boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, window_width)
+    boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, window_height)
+    valid = (boxes[:, 0] < boxes[:, 2]) & (boxes[:, 1] < boxes[:, 3])
+    boxes = boxes[valid]
+    boxes[:, [0, 2]] += offset_x
+    boxes[:, [1, 3]] += offset_y
+    return Detections(boxes, detections.scores[valid], detections.class_ids[valid])
@@ -0,0 +1,216 @@
+"""
+Detector backends for the inference scripts.
+
+Every backend loads a model and exposes:
+    names                  -> {class_id: class_name}
+    predict_batch(images)  -> one Detections per RGB uint8 array, in its pixel coordinates
+
+    ultralytics  -> anything ultralytics YOLO loads (.pt, ...), through PyTorch
+    onnxruntime  -> a YOLOv8 ONNX export (train.py --export) on the CPU without
+                    torch: letterboxing, output decoding and NMS are done here
+"""
+import ast
+
+import numpy as np
+
+from batched_inference import ultralytics_predict_batch
+from detections import Detections
+from profiling import NULL_PROFILER
+
+BACKENDS = ("ultralytics", "onnxruntime")
+
+# ultralytics' predict defaults
+CONFIDENCE_THRESHOLD = 0.25
+IOU_THRESHOLD = 0.7
+MAX_DETECTIONS = 300
+# boxes kept for NMS, by score
+MAX_NMS = 30000
+# class offset of the boxes in NMS, so boxes of different classes never overlap
+MAX_WH = 7680
+LETTERBOX_COLOR = 114
+
+
+class UltralyticsBackend:
+    """An ultralytics YOLO model."""
+
+    def __init__(self, weights_path, confidence_threshold=CONFIDENCE_THRESHOLD, device=None, max_detections=MAX_DETECTIONS,
+                 profiler=NULL_PROFILER):
+        import torch
+        from ultralytics import YOLO
+
+        self.model = YOLO(weights_path)
+        self.names = self.model.names
+        device = device or ("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.predict_batch = ultralytics_predict_batch(self.model, confidence_threshold, device, profiler, max_detections)
+
+
+def nms(boxes, scores, class_ids, iou_threshold, max_detections):
+    """
+    Class-aware greedy NMS, like ultralytics' (torchvision) NMS: a box is suppressed
+    by a higher scoring box of the same class with IoU > iou_threshold.
+
+    Every kept box is compared to all remaining boxes at once, and the loop stops
+    as soon as max_detections boxes are kept.
+
+    Returns:
+        indices of the kept boxes, by descending score.
+    """
+    offset_boxes = boxes + (class_ids * MAX_WH)[:, np.newaxis].astype(boxes.dtype)
+    areas = (offset_boxes[:, 2] - offset_boxes[:, 0]) * (offset_boxes[:, 3] - offset_boxes[:, 1])
+    order = np.argsort(-scores, kind="stable")
+    keep = []
+    while len(order) and len(keep) < max_detections:
+        i, rest = order[0], order[1:]
+        keep.append(i)
+        x1 = np.maximum(offset_boxes[i, 0], offset_boxes[rest, 0])
+        y1 = np.maximum(offset_boxes[i, 1], offset_boxes[rest, 1])
+        x2 = np.minimum(offset_boxes[i, 2], offset_boxes[rest, 2])
+        y2 = np.minimum(offset_boxes[i, 3], offset_boxes[rest, 3])
+        intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            iou = intersection / (areas[i] + areas[rest] - intersection)
+        # 0 / 0 for empty boxes is not an overlap
+        order = rest[~(iou > iou_threshold)]
+    return np.array(keep, dtype=np.int64)
+
+
+def letterbox(image, new_shape, color=LETTERBOX_COLOR):
+    """
+    Resize an image to fit new_shape (height, width) keeping its aspect ratio and pad
+    the rest, centered, like ultralytics' LetterBox.
+
+    Returns:
+        (padded image, gain, (pad_left, pad_top))
+    """
+    import cv2
+
+    height, width = image.shape[:2]
+    gain = min(new_shape[0] / height, new_shape[1] / width)
+    new_width, new_height = int(round(width * gain)), int(round(height * gain))
+    if (new_width, new_height) != (width, height):
+        image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+
+    pad_x = (new_shape[1] - new_width) / 2
+    pad_y = (new_shape[0] - new_height) / 2
+    top, bottom = int(round(pad_y - 0.1)), int(round(pad_y + 0.1))
+    left, right = int(round(pad_x - 0.1)), int(round(pad_x + 0.1))
+    image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(color, color, color))
+    return image, gain, (left, top)
+
+
+class OnnxRuntimeBackend:
+    """
+    A YOLOv8 detection model exported to ONNX, run with ONNX Runtime on the CPU.
+
+    The class names and input size are read from the metadata ultralytics writes
+    into the export. Models exported with a fixed batch size are run image by image,
+    models with a dynamic batch axis run the whole batch in one call.
+    """
+
+    def __init__(self, model_path, confidence_threshold=CONFIDENCE_THRESHOLD, iou_threshold=IOU_THRESHOLD,
+                 max_detections=MAX_DETECTIONS, num_threads=None, profiler=NULL_PROFILER):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(str(model_path), options, providers=["CPUExecutionProvider"])
+        self.confidence_threshold = confidence_threshold
+        self.iou_threshold = iou_threshold
+        self.max_detections = max_detections
+        self.profiler = profiler
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.fixed_batch = model_input.shape[0] if isinstance(model_input.shape[0], int) else None
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        if "imgsz" in metadata:
+            self.imgsz = tuple(ast.literal_eval(metadata["imgsz"]))
+        else:
+            self.imgsz = tuple(model_input.shape[2:])
+        # exported with NMS: (batch, max_det, 6) rows of x1, y1, x2, y2, score, class
+        self.end_to_end = metadata.get("end2end") == "True"
+        if "names" in metadata:
+            self.names = ast.literal_eval(metadata["names"])
+        else:
+            num_classes = self.session.get_outputs()[0].shape[1] - 4
+            self.names = {i: str(i) for i in range(num_classes)}
+
+    def preprocess(self, images):
+        """Letterbox RGB uint8 images into a (B, 3, H, W) float32 batch in [0, 1]."""
+        padded, transforms = [], []
+        for image in images:
+            image, gain, pad = letterbox(image, self.imgsz)
+            padded.append(image)
+            transforms.append((gain, pad))
+        batch = np.stack(padded).transpose(0, 3, 1, 2).astype(np.float32) / 255.0
+        return np.ascontiguousarray(batch), transforms
+
+    def decode(self, prediction):
+        """(4 + num_classes, N) raw output of one image -> NMS'ed Detections in letterbox pixels."""
+        if self.end_to_end:
+            prediction = prediction[prediction[:, 4] > self.confidence_threshold]
+            return Detections(prediction[:, :4].astype(np.float32), prediction[:, 4].astype(np.float32),
+                              prediction[:, 5].astype(np.int64))
+
+        class_scores = prediction[4:]
+        class_ids = class_scores.argmax(axis=0)
+        scores = class_scores[class_ids, np.arange(class_scores.shape[1])]
+        candidates = np.flatnonzero(scores > self.confidence_threshold)
+        if len(candidates) > MAX_NMS:
+            candidates = candidates[np.argsort(-scores[candidates], kind="stable")[:MAX_NMS]]
+
+        cx, cy, w, h = prediction[:4, candidates]
+        boxes = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1).astype(np.float32)
+        scores = scores[candidates].astype(np.float32)
+        class_ids = class_ids[candidates].astype(np.int64)
+        keep = nms(boxes, scores, class_ids, self.iou_threshold, self.max_detections)
+        return Detections(boxes[keep], scores[keep], class_ids[keep])
+
+    def predict_batch(self, images):
+        if not images:
+            return []
+        with self.profiler.span("preprocess"):
+            batch, transforms = self.preprocess(images)
+        with self.profiler.span("forward"):
+            if self.fixed_batch:
+                outputs = np.concatenate([
+                    self.session.run(None, {self.input_name: batch[i:i + self.fixed_batch]})[0]
+                    for i in range(0, len(batch), self.fixed_batch)
+                ])
+            else:
+                outputs = self.session.run(None, {self.input_name: batch})[0]
+
+        results = []
+        with self.profiler.span("postprocess"):
+            for image, prediction, (gain, (pad_left, pad_top)) in zip(images, outputs, transforms):
+                detections = self.decode(prediction)
+                boxes = (detections.boxes - np.array([pad_left, pad_top, pad_left, pad_top], dtype=np.float32)) / gain
+                height, width = image.shape[:2]
+                boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+                boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+                results.append(Detections(boxes, detections.scores, detections.class_ids))
+        return results
+
+
+def load_backend(backend, weights_path, confidence_threshold=CONFIDENCE_THRESHOLD, device=None, num_threads=None,
+                 max_detections=MAX_DETECTIONS, profiler=NULL_PROFILER):
+    """
+    Load a model with one of BACKENDS.
+
+    Args:
+        backend (str): "ultralytics" or "onnxruntime".
+        weights_path (str): .pt for ultralytics (or any format it loads), .onnx for onnxruntime.
+        confidence_threshold (float): Minimum score of a detection.
+        device (str): Torch device of the ultralytics backend (default: cuda:0 when available).
+        num_threads (int): Intra-op threads of the onnxruntime backend (default: onnxruntime's).
+        max_detections (int): Maximum number of detections per image (slice) after NMS. ONNX exports
+            with NMS inside (end2end) keep the maximum they were exported with.
+        profiler (profiling.Profiler): Gets the preprocess, forward and postprocess times of the batches.
+    """
+    if backend == "onnxruntime":
+        return OnnxRuntimeBackend(weights_path, confidence_threshold, max_detections=max_detections, num_threads=num_threads,
+                                  profiler=profiler)
+    if backend == "ultralytics":
+        return UltralyticsBackend(weights_path, confidence_threshold, device, max_detections, profiler)
+    raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
@@ -0,0 +1,38 @@
+"""
+Small file helpers shared by the scripts: atomic writes and content hashes.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def atomic_write_json(data, path, indent=2):
+    """
+    Write JSON to a temporary file next to path and rename it into place,
+    so a killed process never leaves a truncated file behind.
+    """
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def file_sha256(path, chunk_size=CHUNK_SIZE):
+    """sha256 of the full file content (used for model weights)."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
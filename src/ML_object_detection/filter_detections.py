@@ -0,0 +1,157 @@
+"""
+Filter stored detections by score, class, rank and size, without running the model.
+
+Run the inference once at a low threshold (infer_with_sahi.py --confidence_threshold
+0.05), the scores are kept with the shapes. This tool then drops, per image:
+
+    score     -> detections scoring at or below the threshold of their class
+                 (--class_threshold Skorsten=0.5, others --threshold)
+    min_size  -> boxes narrower or lower than --min_size pixels
+    top_k     -> all but the --top_k best scoring of the detections left
+
+The filters are array operations over all detections at once. The input is a
+folder of LabelMe JSON (written to a folder of LabelMe JSON) or a detection_store
+(written to a store, the whole campaign is filtered in one pass over its columns).
+Shapes without a score count as 1.0, shapes that are not rectangles are kept.
+
+The slice merge of the inference runs before this filter: with --postprocess nms
+the result equals an inference run at the higher threshold, with greedy_nmm/nmm
+boxes may have grown by merging with low scoring ones.
+
+Usage:
+    python filter_detections.py --input results/ --output filtered/ --threshold 0.3 --class_threshold Skorsten=0.5 --top_k 200 --min_size 4
+"""
+import argparse
+import json
+import time
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+from detection_store import DetectionStore, is_store, write_store
+from file_utils import atomic_write_json
+from merge_json import is_rectangle
+
+
+def parse_class_thresholds(values):
+    """["name=threshold", ...] -> {name: threshold}"""
+    thresholds = {}
+    for value in values or []:
+        name, sep, threshold = value.rpartition("=")
+        if not sep or not name:
+            raise ValueError(f"Expected name=threshold, got {value!r}")
+        thresholds[name] = float(threshold)
+    return thresholds
+
+
+def keep_mask(boxes, scores, class_ids, image_ids, thresholds, top_k=None, min_size=0.0):
+    """
+    Which detections pass the filters.
+
+    Args:
+        boxes: (N, 4) x1, y1, x2, y2.
+        scores: (N,) scores.
+        class_ids: (N,) class ids.
+        image_ids: (N,) image of every detection, top_k is per image.
+        thresholds: (num_classes,) score threshold per class id.
+        top_k (int): Keep at most this many detections per image (None: all).
+        min_size (float): Minimum width and height of a box.
+
+    Returns:
+        (N,) bool array.
+    """
+    keep = scores > thresholds[class_ids]
+    if min_size:
+        keep &= (boxes[:, 2] - boxes[:, 0] >= min_size) & (boxes[:, 3] - boxes[:, 1] >= min_size)
+    if top_k is not None:
+        index = np.flatnonzero(keep)
+        # the kept detections by image, best score first, and their rank within the image
+        order = index[np.lexsort((-scores[index], image_ids[index]))]
+        sorted_images = image_ids[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sorted_images[1:] != sorted_images[:-1]
+        positions = np.arange(len(order))
+        rank = positions - np.maximum.accumulate(np.where(first, positions, 0))
+        keep[order[rank >= top_k]] = False
+    return keep
+
+
+def threshold_table(names, threshold, class_thresholds):
+    """Score threshold per class id, for a names dict class id -> name."""
+    unknown = set(class_thresholds) - set(names.values())
+    if unknown:
+        print(f"Warning: the classes {sorted(unknown)} are not in the store")
+    table = np.full(max(names, default=-1) + 1, threshold, dtype=np.float64)
+    for class_id, name in names.items():
+        table[class_id] = class_thresholds.get(name, threshold)
+    return table
+
+
+def filter_store(input_store, output_store, threshold, class_thresholds, top_k=None, min_size=0.0):
+    """Filter a detection store into a new store, returns (kept, total, per class kept counts)."""
+    store = DetectionStore(input_store)
+    columns = store.columns
+    keep = keep_mask(store.boxes, columns["score"], columns["class_id"], columns["image_id"],
+                     threshold_table(store.names, threshold, class_thresholds), top_k, min_size)
+    write_store(output_store, store.names, store.images, {column: values[keep] for column, values in columns.items()})
+    counts = np.bincount(columns["class_id"][keep], minlength=max(store.names, default=-1) + 1)
+    return int(keep.sum()), len(keep), {name: int(counts[class_id]) for class_id, name in store.names.items()}
+
+
+def filter_labelme_folder(input_folder, output_folder, threshold, class_thresholds, top_k=None, min_size=0.0):
+    """Filter every LabelMe JSON of a folder into output_folder, returns (kept, total, per class kept counts)."""
+    Path(output_folder).mkdir(parents=True, exist_ok=True)
+    kept = total = 0
+    class_counts = Counter()
+    for json_file in sorted(Path(input_folder).glob("*.json")):
+        with open(json_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        shapes = data.get("shapes", [])
+        rectangles = [shape for shape in shapes if is_rectangle(shape)]
+        labels = sorted({shape["label"] for shape in rectangles})
+        label_ids = {label: i for i, label in enumerate(labels)}
+        points = np.array([shape["points"] for shape in rectangles], dtype=np.float64).reshape(-1, 2, 2)
+        keep = keep_mask(
+            np.concatenate([points.min(axis=1), points.max(axis=1)], axis=1),
+            np.array([shape.get("score", 1.0) for shape in rectangles], dtype=np.float64),
+            np.array([label_ids[shape["label"]] for shape in rectangles], dtype=np.int64),
+            np.zeros(len(rectangles), dtype=np.int64),
+            np.array([class_thresholds.get(label, threshold) for label in labels], dtype=np.float64),
+            top_k, min_size,
+        )
+        keep_rectangle = iter(keep.tolist())
+        data["shapes"] = [shape for shape in shapes if not is_rectangle(shape) or next(keep_rectangle)]
+        atomic_write_json(data, Path(output_folder) / json_file.name)
+        kept += int(keep.sum())
+        total += len(rectangles)
+        class_counts.update(shape["label"] for shape, k in zip(rectangles, keep.tolist()) if k)
+    return kept, total, class_counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Filter stored detections by per class score threshold, top-k per image and box size")
+    parser.add_argument("--input", required=True, help="Folder of LabelMe JSON, or a detection store")
+    parser.add_argument("--output", required=True, help="Output folder of LabelMe JSON, or output store for a store input")
+    parser.add_argument("--threshold", type=float, default=0.0, help="Score threshold of the classes without their own (default: 0, keep all)")
+    parser.add_argument("--class_threshold", nargs="+", default=None, metavar="NAME=THRESHOLD", help="Score threshold of a class, e.g. Skorsten=0.5 Vindue=0.3")
+    parser.add_argument("--top_k", type=int, default=None, help="Keep at most this many detections per image, the best scoring (default: all)")
+    parser.add_argument("--min_size", type=float, default=0.0, help="Minimum box width and height in pixels (default: 0)")
+    args = parser.parse_args(argv)
+
+    if Path(args.input).resolve() == Path(args.output).resolve():
+        parser.error("--output must differ from --input")
+    class_thresholds = parse_class_thresholds(args.class_threshold)
+
+    start = time.perf_counter()
+    if is_store(args.input):
+        kept, total, class_counts = filter_store(args.input, args.output, args.threshold, class_thresholds, args.top_k, args.min_size)
+    else:
+        kept, total, class_counts = filter_labelme_folder(args.input, args.output, args.threshold, class_thresholds, args.top_k, args.min_size)
+    print(f"Kept {kept} of {total} detections in {time.perf_counter() - start:.2f} s")
+    for name, count in sorted(class_counts.items()):
+        print(f"{name:>16} {count:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,24 +3,36 @@ import argparse
 import json
 import os
 import shutil
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import lru_cache, partial
 from glob import glob
 from pathlib import Path
 from typing import List, Tuple
 
+import numpy as np
+
+from box_ops import candidate_pairs
+from detection_store import DetectionStore, is_store, labelme_shapes
+from detections import Detections
+
 # Function to parse command-line arguments
-def parse_args():
+def parse_args(argv=None):
     """
     Parses command-line arguments.
     """
     parser = argparse.ArgumentParser(description="Find differing labels between two folders of labelme annotations.")
-    parser.add_argument("--folder1", required=True, help="Path to the first folder containing images and JSON annotations.")
-    parser.add_argument("--folder2", required=True, help="Path to the second folder containing JSON annotations.")
+    parser.add_argument("--folder1", required=True, help="Path to the first folder containing images and JSON annotations, or a detection store (the images are read from the paths recorded in it).")
+    parser.add_argument("--folder2", required=True, help="Path to the second folder containing JSON annotations, or a detection store.")
     parser.add_argument("--output", required=True, help="Path to the output directory to save results.")
     parser.add_argument("--overlap", type=float, default=0.5, help="IoU threshold for considering bounding boxes as overlapping (default: 0.5).")
     # --- New Argument ---
     parser.add_argument("--only_save_boundingboxes_from_folder_1", action='store_true',
                         help="If set, only save bounding boxes from folder1 that do not overlap with folder2.")
-    return parser.parse_args()
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes comparing the files (default: 1).")
+    parser.add_argument("--io_threads", type=int, default=4, help="Number of threads copying images and writing JSON (default: 4).")
+    return parser.parse_args(argv)
 
 # Function to load JSON data from a file
 def load_json(path: Path):
@@ -48,6 +60,21 @@ def save_json(data, path: Path):
     with open(path, "w") as f:
         json.dump(data, f, indent=2)
 
+# Open a detection store once per process
+@lru_cache(maxsize=None)
+def open_store(path):
+    """
+    Opens a detection store (memory-mapped) and indexes its images by file stem.
+
+    Args:
+        path: The store directory.
+
+    Returns:
+        (store, image ids): the DetectionStore and a dict file stem -> image id.
+    """
+    store = DetectionStore(path)
+    return store, {Path(image["name"]).stem: image_id for image_id, image in enumerate(store.images)}
+
 # Function to convert labelme points to a bounding box
 def bbox_from_points(points: List[List[float]]) -> Tuple[float, float, float, float]:
     """
@@ -98,6 +125,112 @@ def iou(b1, b2) -> float:
     # Avoid division by zero if union area is 0
     return inter_area / union_area if union_area > 0 else 0
 
+# Function to find the boxes without an overlapping box in the other list
+def find_unmatched(boxes1, boxes2, threshold):
+    """
+    For both lists of boxes, find the boxes whose IoU with every box of the other
+    list is <= threshold (the same test as comparing all pairs with iou()).
+
+    Instead of all len(boxes1) * len(boxes2) pairs, only pairs of boxes that
+    intersect are found (uniform grid, box_ops.candidate_pairs) and their IoU is
+    computed with NumPy, in float64 with the same operations as iou(). Pairs
+    that do not intersect have IoU 0, which never exceeds a threshold >= 0.
+
+    Args:
+        boxes1: List of (xmin, ymin, xmax, ymax).
+        boxes2: List of (xmin, ymin, xmax, ymax).
+        threshold: The IoU threshold.
+
+    Returns:
+        Two boolean arrays, True for the boxes of boxes1 / boxes2 without a match.
+    """
+    unmatched1 = np.ones(len(boxes1), dtype=bool)
+    unmatched2 = np.ones(len(boxes2), dtype=bool)
+    if not threshold >= 0:
+        # every IoU (>= 0) is above a negative threshold: only boxes facing an empty list are kept
+        return unmatched1 & (len(boxes2) == 0), unmatched2 & (len(boxes1) == 0)
+    if len(boxes1) == 0 or len(boxes2) == 0:
+        return unmatched1, unmatched2
+
+    a = np.asarray(boxes1, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(boxes2, dtype=np.float64).reshape(-1, 4)
+    i, j = candidate_pairs(a, b)
+    inter_area = (
+        np.maximum(0, np.minimum(a[i, 2], b[j, 2]) - np.maximum(a[i, 0], b[j, 0]))
+        * np.maximum(0, np.minimum(a[i, 3], b[j, 3]) - np.maximum(a[i, 1], b[j, 1]))
+    )
+    area1 = (a[i, 2] - a[i, 0]) * (a[i, 3] - a[i, 1])
+    area2 = (b[j, 2] - b[j, 0]) * (b[j, 3] - b[j, 1])
+    union_area = area1 + area2 - inter_area
+    pair_iou = np.zeros(len(i), dtype=np.float64)
+    np.divide(inter_area, union_area, out=pair_iou, where=union_area > 0)
+
+    overlapping = pair_iou > threshold
+    unmatched1[i[overlapping]] = False
+    unmatched2[j[overlapping]] = False
+    return unmatched1, unmatched2
+
+# Boxes of the rectangle shapes of a LabelMe JSON
+def shape_boxes(shapes):
+    """
+    Bounding boxes of the 'rectangle' shapes, the only shapes compared.
+
+    Args:
+        shapes: List of shapes (dictionaries) of a LabelMe JSON.
+
+    Returns:
+        (boxes, shapes_of): the list of (xmin, ymin, xmax, ymax), and a function
+        returning the shapes of the boxes selected by a boolean array.
+    """
+    rectangles = [s for s in shapes if s.get("shape_type") == "rectangle"]
+    boxes = [bbox_from_points(s["points"]) for s in rectangles]
+    return boxes, lambda selected: [s for s, keep in zip(rectangles, selected) if keep]
+
+# Boxes of the detections of a store image
+def store_boxes(store, image_id):
+    """
+    Bounding boxes of the detections of one image of a store, read from its columns.
+    Only the selected boxes are turned into LabelMe shapes.
+
+    Args:
+        store: The DetectionStore.
+        image_id: The image id in the store.
+
+    Returns:
+        (boxes, shapes_of), as shape_boxes.
+    """
+    detections = store.detections(image_id)
+
+    def shapes_of(selected):
+        return labelme_shapes(Detections(*(column[selected] for column in detections)), store.names)
+
+    return detections.boxes, shapes_of
+
+# Function to keep the unmatched boxes of two sides
+def filter_boxes(side1, side2, threshold, only_keep_folder1=False):
+    """
+    Filters the boxes of two sides (shape_boxes or store_boxes) based on IoU overlap.
+
+    Args:
+        side1: (boxes, shapes_of) of the first folder.
+        side2: (boxes, shapes_of) of the second folder.
+        threshold: The IoU threshold. Boxes with IoU <= threshold with all boxes
+                   of the other side are considered non-overlapping.
+        only_keep_folder1: If True, only return non-overlapping shapes from side1.
+
+    Returns:
+        A list of filtered shapes (dictionaries).
+    """
+    (boxes1, shapes_of1), (boxes2, shapes_of2) = side1, side2
+    # Find boxes that do *not* significantly overlap with any box of the other side
+    unmatched1, unmatched2 = find_unmatched(boxes1, boxes2, threshold)
+    keep1 = shapes_of1(unmatched1)
+    if only_keep_folder1:
+        # If the flag is set, only return the non-overlapping shapes from folder1
+        return keep1
+    # Original behavior: also the shapes of side2 that do not overlap with side1
+    return keep1 + shapes_of2(unmatched2)
+
 # --- Modified Function ---
 # Function to filter shapes based on IoU and the new flag
 def filter_shapes(shapes1, shapes2, threshold, only_keep_folder1=False): # Added only_keep_folder1 parameter
@@ -115,31 +248,151 @@ def filter_shapes(shapes1, shapes2, threshold, only_keep_folder1=False): # Added
     Returns:
         A list of filtered shapes (dictionaries).
     """
-    # Extract bounding boxes for efficient calculation
-    # Store original shape along with its bounding box
     # Only consider 'rectangle' shapes for IoU comparison
-    boxes1 = [(s, bbox_from_points(s["points"])) for s in shapes1 if s.get("shape_type") == "rectangle"]
-    boxes2 = [(s, bbox_from_points(s["points"])) for s in shapes2 if s.get("shape_type") == "rectangle"]
+    return filter_boxes(shape_boxes(shapes1), shape_boxes(shapes2), threshold, only_keep_folder1)
 
-    # Find shapes in shapes1 that do *not* significantly overlap with any shape in shapes2
-    keep1 = [s1 for s1, b1 in boxes1 if all(iou(b1, b2) <= threshold for _, b2 in boxes2)]
+# Result of comparing one JSON file of folder1 with its counterpart in folder2.
+# status is "differ" (data holds the JSON to save), "same", "skipped" or "error";
+# reason groups the skips and errors in the summary; message is printed in file order.
+CompareResult = namedtuple("CompareResult", ["name", "status", "reason", "message", "img_file1_path", "data"])
 
-    # --- Conditional Logic Based on Flag ---
-    if only_keep_folder1:
-        # If the flag is set, only return the non-overlapping shapes from folder1
-        return keep1 # Only return shapes from the first list
+
+# Compare one JSON file of folder1 with the one of the same name in folder2
+def compare_file(json_file1_path, folder1, folder2, overlap, only_save_folder1_bboxes):
+    """
+    Loads one JSON file of folder1 and its counterpart in folder2 and filters the shapes.
+    Runs in the worker processes of process(). Either folder can be a detection store,
+    whose images are looked up by the stem of json_file1_path.
+
+    Args:
+        json_file1_path: Path to the JSON file in the first folder.
+        folder1: Path to the first folder.
+        folder2: Path to the second folder.
+        overlap: IoU threshold.
+        only_save_folder1_bboxes: Only keep non-overlapping bounding boxes from folder1.
+
+    Returns:
+        A CompareResult.
+    """
+    json_file1_path = Path(json_file1_path)
+    name = json_file1_path.stem # Get the base name without extension
+
+    # Load the JSON data from the first file to find the corresponding image path
+    try:
+        if is_store(folder1):
+            store1, image_ids1 = open_store(str(folder1))
+            data1 = None
+            img_file1_path = Path(store1.images[image_ids1[name]]["path"])
+        else:
+            data1 = load_json(json_file1_path)
+            # Handle potential missing imagePath or different image extensions
+            img_path_in_json = data1.get("imagePath")
+            if not img_path_in_json:
+                return CompareResult(name, "skipped", "imagePath missing",
+                                     f"Warning: 'imagePath' missing in {json_file1_path}. Skipping.", None, None)
+            img_suffix = Path(img_path_in_json).suffix # Get image suffix from JSON
+            img_file1_path = Path(folder1) / (name + img_suffix)
+    except json.JSONDecodeError:
+        return CompareResult(name, "error", "invalid JSON", f"Error decoding JSON from {json_file1_path}. Skipping.", None, None)
+    except Exception as e:
+        return CompareResult(name, "error", "loading failed", f"Error processing {json_file1_path}: {e}", None, None)
+
+    # Construct the expected path for the corresponding JSON file in the second folder
+    json_file2_path = Path(folder2) / (name + ".json")
+
+    # Check if the corresponding JSON file exists in the second folder
+    store2, image_ids2 = open_store(str(folder2)) if is_store(folder2) else (None, None)
+    if not (name in image_ids2 if store2 is not None else os.path.exists(json_file2_path)):
+        return CompareResult(name, "skipped", "no JSON in folder2", None, None, None)
+
+    # Check if the corresponding image file exists in the first folder
+    if not os.path.exists(img_file1_path):
+        return CompareResult(name, "skipped", "image missing",
+                             f"Skipping {name}: Image file {img_file1_path.name} not found in {folder1}", None, None)
+
+    # Load the boxes of both folders
+    try:
+        side1 = store_boxes(store1, image_ids1[name]) if data1 is None else shape_boxes(data1.get("shapes", []))
+        if store2 is not None:
+            side2 = store_boxes(store2, image_ids2[name])
+        else:
+            side2 = shape_boxes(load_json(json_file2_path).get("shapes", []))
+    except json.JSONDecodeError:
+        return CompareResult(name, "error", "invalid JSON", f"Error decoding JSON from {json_file2_path}. Skipping {name}.", None, None)
+    except Exception as e:
+        return CompareResult(name, "error", "loading failed",
+                             f"Error loading shapes from {json_file1_path} or {json_file2_path}: {e}", None, None)
+
+    # Filter shapes based on the overlap threshold and the new flag
+    try:
+        filtered_shapes = filter_boxes(side1, side2, overlap, only_save_folder1_bboxes)
+    except Exception as e:
+        return CompareResult(name, "error", "comparison failed", f"Error comparing shapes of {name}: {e}", None, None)
+
+    if not filtered_shapes:
+        return CompareResult(name, "same", None, None, img_file1_path, None)
+
+    # Create the output JSON data structure
+    # Use the data from the first file as a base, with the filtered shapes
+    if data1 is None:
+        base_data = store1.labelme_dict(image_ids1[name], filtered_shapes)
     else:
-        # Original behavior: also find shapes in shapes2 that do not overlap with shapes1
-        keep2 = [s2 for s2, b2 in boxes2 if all(iou(b2, b1) <= threshold for _, b1 in boxes1)]
-        # Return the combined list of non-overlapping shapes from both folders
-        return keep1 + keep2
+        base_data = data1
+        base_data["shapes"] = filtered_shapes
+    # Update the image path to point to the copied image in the output folder
+    base_data["imagePath"] = img_file1_path.name # Use relative path name
+    return CompareResult(name, "differ", None, None, img_file1_path, base_data)
+
+
+# Copy the image and save the JSON of one differing file
+def save_result(result, output):
+    """
+    Copies the image of a differing file to the output directory and saves its JSON.
+    Runs in the writer threads of process().
+
+    Args:
+        result: A CompareResult with status "differ".
+        output: Path to the output directory.
+
+    Returns:
+        (reason, message): (None, None) on success, otherwise the error.
+    """
+    # Define the output image path
+    out_img_path = Path(output) / result.img_file1_path.name
+    # Copy the image file to the output directory
+    try:
+        shutil.copy(result.img_file1_path, out_img_path)
+    except Exception as e:
+        return "copy failed", f"Error copying image {result.img_file1_path} to {out_img_path}: {e}"
+
+    # Define the output JSON file path
+    out_json_path = Path(output) / (result.name + ".json")
+    # Save the new JSON data
+    try:
+        save_json(result.data, out_json_path)
+    except Exception as e:
+        message = f"Error saving JSON {out_json_path}: {e}"
+        # Clean up the copied image if JSON saving fails
+        if os.path.exists(out_img_path):
+            try:
+                os.remove(out_img_path)
+                message += f"\nRemoved partially copied image {out_img_path.name} due to JSON save error."
+            except OSError as rm_err:
+                message += f"\nError removing image {out_img_path.name} after JSON save error: {rm_err}"
+        return "saving failed", message
+    return None, None
+
 
-# --- Modified Function ---
 # Main processing function
-def process(folder1, folder2, output, overlap, only_save_folder1_bboxes): # Added only_save_folder1_bboxes parameter
+def process(folder1, folder2, output, overlap, only_save_folder1_bboxes, workers=1, io_threads=4):
     """
     Processes the folders, finds differing labels, and saves the results.
 
+    The comparisons run in a pool of worker processes and the image copies and JSON
+    writes in a pool of threads, so I/O and comparisons overlap. Results are handled
+    in the sorted order of the files, so the output and the printed messages do not
+    depend on the number of workers.
+
     Args:
         folder1: Path to the first folder.
         folder2: Path to the second folder.
@@ -147,107 +400,70 @@ def process(folder1, folder2, output, overlap, only_save_folder1_bboxes): # Adde
         overlap: IoU threshold.
         only_save_folder1_bboxes: Boolean flag indicating whether to only save
                                      non-overlapping bounding boxes from folder1.
+        workers: Number of processes comparing files (1: compare in this process).
+        io_threads: Number of threads copying images and writing JSON.
     """
     os.makedirs(output, exist_ok=True) # Ensure output directory exists
-    # Find all JSON files in the first folder
-    json_files1 = sorted(glob(str(Path(folder1) / "*.json")))
+    # Find all JSON files in the first folder (the images of a store, by the JSON name they would have)
+    if is_store(folder1):
+        json_files1 = sorted(str(Path(folder1) / (stem + ".json")) for stem in open_store(str(folder1))[1])
+    else:
+        json_files1 = sorted(glob(str(Path(folder1) / "*.json")))
 
     print(f"Found {len(json_files1)} JSON files in {folder1}")
 
+    compare = partial(compare_file, folder1=folder1, folder2=folder2, overlap=overlap,
+                      only_save_folder1_bboxes=only_save_folder1_bboxes)
     processed_count = 0
-    # Iterate through each JSON file in the first folder
-    for json_file1_path in json_files1:
-        json_file1_path = Path(json_file1_path)
-        name = json_file1_path.stem # Get the base name without extension
-
-        # Load the JSON data from the first file to find the corresponding image path
-        try:
-            data1 = load_json(json_file1_path)
-            # Handle potential missing imagePath or different image extensions
-            img_path_in_json = data1.get("imagePath")
-            if not img_path_in_json:
-                 print(f"Warning: 'imagePath' missing in {json_file1_path}. Skipping.")
-                 continue
-            img_suffix = Path(img_path_in_json).suffix # Get image suffix from JSON
-            img_file1_path = Path(folder1) / (name + img_suffix)
-        except json.JSONDecodeError:
-            print(f"Error decoding JSON from {json_file1_path}. Skipping.")
-            continue
-        except Exception as e:
-            print(f"Error processing {json_file1_path}: {e}")
-            continue # Skip this file if loading fails or imagePath is missing
-
-        # Construct the expected path for the corresponding JSON file in the second folder
-        json_file2_path = Path(folder2) / (name + ".json")
-
-        # Check if the corresponding JSON file exists in the second folder
-        if not os.path.exists(json_file2_path):
-            # print(f"Skipping {name}: Corresponding JSON not found in {folder2}")
-            continue # Skip if the corresponding file doesn't exist
-
-        # Check if the corresponding image file exists in the first folder
-        if not os.path.exists(img_file1_path):
-            print(f"Skipping {name}: Image file {img_file1_path.name} not found in {folder1}")
-            continue # Skip if the image file is missing
-
-        # Load shapes from both JSON files
-        try:
-            shapes1 = data1.get("shapes", [])
-            data2 = load_json(json_file2_path)
-            shapes2 = data2.get("shapes", [])
-        except json.JSONDecodeError:
-             print(f"Error decoding JSON from {json_file2_path}. Skipping {name}.")
-             continue
-        except Exception as e:
-            print(f"Error loading shapes from {json_file1_path} or {json_file2_path}: {e}")
-            continue # Skip if shape loading fails
-
-        # Filter shapes based on the overlap threshold and the new flag
-        # Pass the value of the command-line flag here
-        filtered_shapes = filter_shapes(shapes1, shapes2, overlap, only_save_folder1_bboxes) # Pass the flag value
-
-        # If there are differing shapes, process and save the output
-        if filtered_shapes:
-            processed_count += 1
-            # Define the output image path
-            out_img_path = Path(output) / img_file1_path.name
-            # Copy the image file to the output directory
-            try:
-                shutil.copy(img_file1_path, out_img_path)
-            except Exception as e:
-                print(f"Error copying image {img_file1_path} to {out_img_path}: {e}")
-                continue # Skip if image copy fails
-
-            # Create the output JSON data structure
-            # Use the data from the first file as a base
-            base_data = data1
-            # Replace the shapes with the filtered list
-            base_data["shapes"] = filtered_shapes
-            # Update the image path to point to the copied image in the output folder
-            base_data["imagePath"] = out_img_path.name # Use relative path name
-
-            # Define the output JSON file path
-            out_json_path = Path(output) / (name + ".json")
-            # Save the new JSON data
-            try:
-                save_json(base_data, out_json_path)
-            except Exception as e:
-                print(f"Error saving JSON {out_json_path}: {e}")
-                # Clean up the copied image if JSON saving fails
-                if os.path.exists(out_img_path):
-                    try:
-                        os.remove(out_img_path)
-                        print(f"Removed partially copied image {out_img_path.name} due to JSON save error.")
-                    except OSError as rm_err:
-                        print(f"Error removing image {out_img_path.name} after JSON save error: {rm_err}")
-                continue # Continue to the next file
+    skipped = Counter()
+    errors = Counter()
+
+    def report(reason, message, counter):
+        if message:
+            print(message)
+        if reason:
+            counter[reason] += 1
+
+    with ExitStack() as stack:
+        if workers > 1:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            # map keeps the order of json_files1
+            results = pool.map(compare, json_files1, chunksize=max(1, min(32, len(json_files1) // (workers * 4))))
+        else:
+            results = map(compare, json_files1)
+        writer = stack.enter_context(ThreadPoolExecutor(max_workers=io_threads))
+
+        # writes in flight, finished in submission order to keep the messages deterministic
+        pending = deque()
+
+        def finish_write():
+            reason, message = pending.popleft().result()
+            report(reason, message, errors)
+
+        for result in results:
+            if result.status == "differ":
+                processed_count += 1
+                pending.append(writer.submit(save_result, result, output))
+                if len(pending) > 4 * io_threads:
+                    finish_write()
+            else:
+                report(result.reason, result.message, skipped if result.status == "skipped" else errors)
+        while pending:
+            finish_write()
 
     print(f"Processing complete. Saved results for {processed_count} images with differing labels to {output}")
+    for counter, what in ((skipped, "Skipped"), (errors, "Errors")):
+        if counter:
+            print(f"{what}: {sum(counter.values())} (" + ", ".join(f"{reason}: {n}" for reason, n in sorted(counter.items())) + ")")
 
-# Entry point of the script
-if __name__ == "__main__":
+def main(argv=None):
     # Parse the command-line arguments
-    args = parse_args()
+    args = parse_args(argv)
     # Run the main processing function with the parsed arguments
     # Pass the value of the new argument to the process function
-    process(args.folder1, args.folder2, args.output, args.overlap, args.only_save_boundingboxes_from_folder_1)
+    process(args.folder1, args.folder2, args.output, args.overlap, args.only_save_boundingboxes_from_folder_1,
+            workers=args.workers, io_threads=args.io_threads)
+
+# Entry point of the script
+if __name__ == "__main__":
+    main()
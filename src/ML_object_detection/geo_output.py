@@ -0,0 +1,221 @@
+"""
+Georeferenced output of the detections, written while the inference runs.
+
+The pixel boxes of an image are mapped through its GeoTIFF geotransform in one
+vectorized step into polygons (the geotransform may be rotated, so the four
+corners are mapped). Every image's features are appended to the output as soon as
+the image is finished, nothing is kept for the whole campaign:
+
+    .geojsonl / .geojsons / .ndjson -> newline-delimited GeoJSON, one Feature per line.
+                                       Every feature carries the (2008 GeoJSON) "crs"
+                                       member of its image, like the FeatureCollections
+                                       merge_geojson.py reads.
+    .fgb                            -> FlatGeobuf (through fiona), in the CRS of the
+                                       first georeferenced image.
+
+Every feature has the properties image (file name), label, class_id and score.
+Images without a georeference get no features (their LabelMe JSON is still written).
+"""
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+NDJSON_SUFFIXES = (".geojsonl", ".geojsons", ".ndjson")
+FLATGEOBUF_SUFFIXES = (".fgb",)
+GEO_OUTPUT_SUFFIXES = NDJSON_SUFFIXES + FLATGEOBUF_SUFFIXES
+
+
+def read_georeference(image_path):
+    """
+    Read the georeference of an image from its header.
+
+    Returns:
+        (geotransform, crs_wkt, epsg): the GDAL geotransform (None when the image is not
+        georeferenced), the CRS as WKT and its EPSG code (None when unknown).
+    """
+    try:
+        from osgeo import gdal
+    except ImportError:
+        import warnings
+
+        import rasterio
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", rasterio.errors.NotGeoreferencedWarning)
+            src = rasterio.open(image_path)
+        with src:
+            if src.crs is None and src.transform.is_identity:
+                return None, None, None
+            crs = src.crs
+            return src.transform.to_gdal(), crs.to_wkt() if crs else None, crs.to_epsg() if crs else None
+
+    ds = gdal.Open(str(image_path))
+    if ds is None:
+        raise FileNotFoundError(f"Could not open {image_path}")
+    geotransform = ds.GetGeoTransform(can_return_null=True)
+    srs = ds.GetSpatialRef()
+    if geotransform is None:
+        return None, None, None
+    epsg = int(srs.GetAuthorityCode(None)) if srs is not None and srs.GetAuthorityName(None) == "EPSG" else None
+    return geotransform, srs.ExportToWkt() if srs is not None else None, epsg
+
+
+def boxes_to_polygons(boxes, geotransform):
+    """
+    Map (N, 4) pixel boxes x1, y1, x2, y2 through a GDAL geotransform.
+
+    Returns:
+        (N, 5, 2) array, the closed rings of the box corners in map coordinates.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    # corners top left, top right, bottom right, bottom left, top left
+    px = boxes[:, [0, 2, 2, 0, 0]]
+    py = boxes[:, [1, 1, 3, 3, 1]]
+    x = geotransform[0] + px * geotransform[1] + py * geotransform[2]
+    y = geotransform[3] + px * geotransform[4] + py * geotransform[5]
+    return np.stack([x, y], axis=-1)
+
+
+def iter_image_features(image_path, detections, names, geotransform):
+    """Yield the GeoJSON-like feature dicts of the detections of one image."""
+    image_name = Path(image_path).name
+    rings = boxes_to_polygons(detections.boxes, geotransform).tolist()
+    for ring, score, class_id in zip(rings, detections.scores.tolist(), detections.class_ids.tolist()):
+        yield {
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [ring]},
+            "properties": {"image": image_name, "label": names[class_id], "class_id": class_id, "score": score},
+        }
+
+
+class NdjsonFeatureWriter:
+    """
+    Appends one GeoJSON Feature per line. The lines of an image are written with a
+    single write to a file opened in append mode, so worker processes can share the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.features = 0
+
+    def write_image(self, image_path, detections, names):
+        geotransform, _, epsg = read_georeference(image_path)
+        if geotransform is None:
+            print(f"{image_path} is not georeferenced, no features written")
+            return
+        crs = {"type": "name", "properties": {"name": f"urn:ogc:def:crs:EPSG::{epsg}"}} if epsg else None
+        lines = []
+        for feature in iter_image_features(image_path, detections, names, geotransform):
+            if crs:
+                feature["crs"] = crs
+            lines.append(json.dumps(feature))
+        if lines:
+            os.write(self.fd, ("\n".join(lines) + "\n").encode("utf-8"))
+        self.features += len(lines)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def drop_image_features(path, image_names):
+    """
+    Remove the features of the images image_names (file names) from a newline-delimited
+    GeoJSON file, before the images are run again and their features appended anew.
+    The file is rewritten through a temporary file next to it.
+
+    Returns:
+        the number of features removed.
+    """
+    path = Path(path)
+    if not path.exists():
+        return 0
+    image_names = set(image_names)
+    removed = 0
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        with open(path, "r", encoding="utf-8") as src, os.fdopen(fd, "w", encoding="utf-8") as dst:
+            for line in src:
+                if not line.strip():
+                    continue
+                try:
+                    image = (json.loads(line).get("properties") or {}).get("image")
+                except json.JSONDecodeError:
+                    # a line cut short by a crash, its image is run again
+                    removed += 1
+                    continue
+                if image in image_names:
+                    removed += 1
+                else:
+                    dst.write(line if line.endswith("\n") else line + "\n")
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return removed
+
+
+class FlatGeobufFeatureWriter:
+    """
+    Writes the features into a FlatGeobuf with fiona. The file is created with the
+    CRS of the first georeferenced image, images in another CRS are skipped.
+    """
+
+    SCHEMA = {"geometry": "Polygon", "properties": {"image": "str", "label": "str", "class_id": "int", "score": "float"}}
+
+    def __init__(self, path):
+        self.path = path
+        self.sink = None
+        self.crs_wkt = None
+        self.features = 0
+
+    def write_image(self, image_path, detections, names):
+        geotransform, crs_wkt, _ = read_georeference(image_path)
+        if geotransform is None:
+            print(f"{image_path} is not georeferenced, no features written")
+            return
+        if self.sink is None:
+            import fiona
+
+            self.crs_wkt = crs_wkt
+            self.sink = fiona.open(self.path, "w", driver="FlatGeobuf", schema=self.SCHEMA, crs_wkt=crs_wkt or "")
+        elif crs_wkt != self.crs_wkt:
+            print(f"{image_path} is in another CRS than the first image, no features written")
+            return
+        records = list(iter_image_features(image_path, detections, names, geotransform))
+        if records:
+            self.sink.writerecords(records)
+        self.features += len(records)
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_feature_writer(path):
+    """Open the writer for the format of path's suffix (see GEO_OUTPUT_SUFFIXES)."""
+    suffix = Path(path).suffix.lower()
+    if suffix in NDJSON_SUFFIXES:
+        return NdjsonFeatureWriter(path)
+    if suffix in FLATGEOBUF_SUFFIXES:
+        return FlatGeobufFeatureWriter(path)
+    raise ValueError(f"Unknown georeferenced output format {suffix}, expected one of {GEO_OUTPUT_SUFFIXES}")
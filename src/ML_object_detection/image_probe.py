@@ -0,0 +1,141 @@
+"""
+Header-only image size probe, shared by the inference and merge scripts.
+
+Only the first bytes of a file are read to find its width and height:
+    TIFF / BigTIFF -> ImageWidth / ImageLength of the first IFD
+    PNG            -> the IHDR chunk
+    JPEG           -> the first SOF marker, with the EXIF orientation applied
+                      (like cv2.imread and ultralytics, which produce the boxes)
+Other formats fall back to Pillow, which also only reads the header.
+
+Results are cached per path for the run, so the inference, JSON and merge steps
+of the same image do not open the file again (which is slow on network storage).
+"""
+import struct
+from functools import lru_cache
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+TIFF_IMAGE_WIDTH = 256
+TIFF_IMAGE_LENGTH = 257
+EXIF_ORIENTATION = 274
+# TIFF field types that hold a single unsigned integer: SHORT, LONG, LONG8
+TIFF_INTEGER_FORMATS = {3: "H", 4: "I", 16: "Q"}
+# SOF markers hold the frame size, DHT (C4), JPG (C8) and DAC (CC) share the range
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def read_tiff_tags(f, tags, base=0):
+    """
+    Read integer tags of the first IFD of a TIFF (or BigTIFF) starting at offset base of f.
+
+    Returns:
+        dict tag -> value for the tags that are present.
+    """
+    f.seek(base)
+    header = f.read(16)
+    byte_order = {b"II": "<", b"MM": ">"}.get(header[:2])
+    if byte_order is None:
+        raise ValueError("Not a TIFF header")
+    version, = struct.unpack(byte_order + "H", header[2:4])
+    if version == 42:
+        ifd_offset, = struct.unpack(byte_order + "I", header[4:8])
+        count_format, entry_format, entry_size = "H", "HHI", 12
+    elif version == 43:
+        ifd_offset, = struct.unpack(byte_order + "Q", header[8:16])
+        count_format, entry_format, entry_size = "Q", "HHQ", 20
+    else:
+        raise ValueError(f"Unknown TIFF version {version}")
+
+    f.seek(base + ifd_offset)
+    count_size = struct.calcsize(count_format)
+    entry_count, = struct.unpack(byte_order + count_format, f.read(count_size))
+    entries = f.read(entry_count * entry_size)
+
+    values = {}
+    value_offset = struct.calcsize(byte_order + entry_format)
+    for start in range(0, len(entries) - entry_size + 1, entry_size):
+        tag, field_type, count = struct.unpack_from(byte_order + entry_format, entries, start)
+        if tag in tags and count >= 1 and field_type in TIFF_INTEGER_FORMATS:
+            # a single value fits in the entry itself, left aligned
+            values[tag], = struct.unpack_from(byte_order + TIFF_INTEGER_FORMATS[field_type], entries, start + value_offset)
+    return values
+
+
+def tiff_size(f):
+    tags = read_tiff_tags(f, (TIFF_IMAGE_WIDTH, TIFF_IMAGE_LENGTH))
+    if len(tags) < 2:
+        raise ValueError("TIFF without ImageWidth/ImageLength")
+    return tags[TIFF_IMAGE_WIDTH], tags[TIFF_IMAGE_LENGTH]
+
+
+def png_size(f):
+    f.seek(16)
+    return struct.unpack(">II", f.read(8))
+
+
+def jpeg_size(f):
+    f.seek(2)
+    orientation = 1
+    while True:
+        byte = f.read(1)
+        if not byte:
+            raise ValueError("JPEG without frame header")
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        while marker == b"\xff":  # fill bytes
+            marker = f.read(1)
+        marker = ord(marker) if marker else 0xD9
+        if marker == 0xD8 or marker == 0x01 or 0xD0 <= marker <= 0xD7:  # markers without a segment
+            continue
+        if marker in (0xD9, 0xDA):  # end of image or start of scan before any frame header
+            raise ValueError("JPEG without frame header")
+
+        length, = struct.unpack(">H", f.read(2))
+        if marker in JPEG_SOF_MARKERS:
+            _, height, width = struct.unpack(">BHH", f.read(5))
+            if orientation in (5, 6, 7, 8):  # rotated by 90 degrees
+                width, height = height, width
+            return width, height
+        if marker == 0xE1:
+            segment_start = f.tell()
+            if f.read(6) == b"Exif\x00\x00":
+                try:
+                    orientation = read_tiff_tags(f, (EXIF_ORIENTATION,), base=f.tell()).get(EXIF_ORIENTATION, 1)
+                except (ValueError, struct.error):
+                    pass  # a broken EXIF block does not hide the frame size
+            f.seek(segment_start + length - 2)
+        else:
+            f.seek(length - 2, 1)
+
+
+@lru_cache(maxsize=4096)
+def _probe_image_size(image_path):
+    with open(image_path, "rb") as f:
+        signature = f.read(8)
+        try:
+            if signature[:4] in (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+"):
+                return tiff_size(f)
+            if signature == PNG_SIGNATURE:
+                return png_size(f)
+            if signature[:2] == b"\xff\xd8":
+                return jpeg_size(f)
+        except (ValueError, struct.error):
+            pass
+
+    from PIL import Image
+    with Image.open(image_path) as img:
+        return img.size
+
+
+def get_image_size(image_path):
+    """
+    Get the width and height of an image from its header, without decoding it.
+
+    Args:
+        image_path (str or Path): The image.
+
+    Returns:
+        (width, height)
+    """
+    return _probe_image_size(str(image_path))
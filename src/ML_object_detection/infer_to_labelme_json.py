@@ -2,25 +2,35 @@ import argparse
 import json
 from pathlib import Path
 import cv2
-from ultralytics import YOLO
 import time
+from pipeline import run_pipeline
+from image_probe import get_image_size
+from file_utils import file_sha256
+from detector_backends import BACKENDS, CONFIDENCE_THRESHOLD, load_backend
+from profiling import NULL_PROFILER, Profiler
 
-def yolo_to_labelme_shape(box, label):
-    """Convert YOLO bounding box to LabelMe rectangle shape"""
+def yolo_to_labelme_shape(box, label, score=None):
+    """Convert YOLO bounding box to LabelMe rectangle shape, with the confidence as "score" when given"""
     x1, y1, x2, y2 = map(float, box)
     x1, x2 = sorted([x1, x2])
     y1, y2 = sorted([y1, y2])
-    return {
+    shape = {
         "label": label,
         "points": [[x1, y1], [x2, y2]],
         "group_id": None,
         "shape_type": "rectangle",
         "flags": {}
     }
+    if score is not None:
+        shape["score"] = float(score)
+    return shape
 
-def create_labelme_json_dict(image_path, shapes):
-    image = cv2.imread(str(image_path))
-    height, width = image.shape[:2]
+def create_labelme_json_dict(image_path, shapes, image_shape=None):
+    """image_shape: shape of the decoded image when it is in memory, otherwise the size is read from the header."""
+    if image_shape is None:
+        width, height = get_image_size(image_path)
+    else:
+        height, width = image_shape[:2]
 
     return {
         "version": "5.0.1",
@@ -32,44 +42,156 @@ def create_labelme_json_dict(image_path, shapes):
         "imageWidth": width,
     }
 
-def detect_and_save_json(model_path, image_dir,output_dir):
-    model = YOLO(model_path)
+def iter_batches(records, batch_size):
+    """Group an iterator of records into lists of batch_size records (the last one may be shorter)."""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def report_throughput(num_images, batch_seconds, wall_seconds):
+    """Print the model time per image and per batch, and the overall throughput."""
+    if not batch_seconds or not num_images:
+        return
+    model_seconds = sum(batch_seconds)
+    print(f"model: {len(batch_seconds)} batches, {model_seconds / len(batch_seconds) * 1000:.1f} ms per batch, "
+          f"{model_seconds / num_images * 1000:.1f} ms per image")
+    print(f"throughput: {num_images / wall_seconds:.1f} images/s, {len(batch_seconds) / wall_seconds:.2f} batches/s")
+
+
+def detect_and_save_json_pipelined(detector, image_paths, output_dir, num_readers=2, batch_size=1, profiler=NULL_PROFILER):
+    """
+    Same as the loop in detect_and_save_json, but reader threads decode upcoming images,
+    the main thread runs the model (a detector_backends backend) and a writer thread
+    writes the JSON files.
+
+    With batch_size > 1 the model runs on batch_size images per forward pass, the
+    readers keep decoding the next batch while the current one is predicted.
+    profiler: profiling.Profiler that gets the stage times of every image.
+    """
+    batch_seconds = []
+
+    def read_image(image_path):
+        with profiler.span("read", image_path):
+            image = cv2.imread(str(image_path))
+        if image is None:
+            raise ValueError(f"Could not read image {image_path}")
+        yield image_path, image
+
+    def detect(images):
+        for batch in iter_batches(images, batch_size):
+            start = time.perf_counter()
+            # the backends take RGB, cv2 decodes BGR
+            with profiler.for_images([image_path for image_path, _ in batch]):
+                predictions = detector.predict_batch([image[:, :, ::-1] for _, image in batch])
+            batch_seconds.append(time.perf_counter() - start)
+            for (image_path, image), detections in zip(batch, predictions):
+                profiler.count("slices", 1, image_path)
+                profiler.count("detections", len(detections.scores), image_path)
+                with profiler.span("serialize", image_path):
+                    shapes = []
+                    for box, score, class_id in zip(detections.boxes, detections.scores, detections.class_ids):
+                        shapes.append(yolo_to_labelme_shape(box.tolist(), detector.names[int(class_id)], score))
+                yield image_path, shapes, image.shape
+
+    def write_json(result):
+        image_path, shapes, image_shape = result
+        with profiler.span("serialize", image_path):
+            json_dict = create_labelme_json_dict(image_path, shapes, image_shape)
+        json_path = output_dir/(image_path.with_suffix(".json").name)
+        with profiler.span("write", image_path), open(json_path, "w") as f:
+            json.dump(json_dict, f, indent=2)
+        print(f"Saved: {json_path}")
+
+    stats = run_pipeline(image_paths, read_image, detect, write_json, num_readers=num_readers, read_queue_size=max(2 * batch_size, 8))
+    stats.report()
+    report_throughput(stats.compute_stats.items, batch_seconds, stats.wall_seconds)
+
+
+def detect_and_save_json(model_path, image_dir,output_dir, pipeline=False, num_readers=2, batch_size=None, backend="ultralytics",
+                         confidence_threshold=CONFIDENCE_THRESHOLD, profile=None, profile_trace=False, cprofile=False):
+    profiler = Profiler(trace=profile_trace, cprofile=cprofile) if profile else NULL_PROFILER
+    detector = load_backend(backend, model_path, confidence_threshold, profiler=profiler)
     image_dir = Path(image_dir)
     output_dir =  Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
     image_paths = list(image_dir.glob("*.jpg")) + list(image_dir.glob("*.png")) + list(image_dir.glob("*.tif"))
+    pipelined = pipeline or batch_size or backend != "ultralytics"
+    if profile and image_paths and not pipelined:
+        # warm the model up first, the time of the call outside its own step timings is charged to read
+        detector.model(image_paths[0], conf=confidence_threshold, verbose=False)
     start_time = time.time()
 
-    for image_path in image_paths:
-        print(f"Processing {image_path.name}")
-        results = model(image_path)
-        shapes = []
+    if pipelined:
+        detect_and_save_json_pipelined(detector, image_paths, output_dir, num_readers, batch_size or 1, profiler)
+    else:
+        model = detector.model
+        for image_path in image_paths:
+            print(f"Processing {image_path.name}")
+            call_start = time.perf_counter()
+            results = model(image_path, conf=confidence_threshold)
+            if profile:
+                # ultralytics times its steps, the rest of the (warmed up) call is loading the image
+                steps = {"preprocess": "preprocess", "forward": "inference", "postprocess": "postprocess"}
+                step_seconds = {stage: sum(r.speed[step] for r in results) / 1000 for stage, step in steps.items()}
+                profiler.add("read", max(time.perf_counter() - call_start - sum(step_seconds.values()), 0.0), image_path)
+                for stage, seconds in step_seconds.items():
+                    profiler.add(stage, seconds, image_path)
+                profiler.count("slices", 1, image_path)
+            shapes = []
+            image_shape = None
 
-        for r in results:
-            for box, cls in zip(r.boxes.xyxy, r.boxes.cls):
-                shape = yolo_to_labelme_shape(box.tolist(), model.names[int(cls)])
-                shapes.append(shape)
+            with profiler.span("serialize", image_path):
+                for r in results:
+                    # the shape of the image as the model decoded it
+                    image_shape = r.orig_shape
+                    for box, score, cls in zip(r.boxes.xyxy, r.boxes.conf, r.boxes.cls):
+                        shape = yolo_to_labelme_shape(box.tolist(), model.names[int(cls)], score)
+                        shapes.append(shape)
 
-        json_dict = create_labelme_json_dict(image_path, shapes)
-        json_path = output_dir/(image_path.with_suffix(".json").name)
+                json_dict = create_labelme_json_dict(image_path, shapes, image_shape)
+            profiler.count("detections", len(shapes), image_path)
+            json_path = output_dir/(image_path.with_suffix(".json").name)
 
-        with open(json_path, "w") as f:
-            json.dump(json_dict, f, indent=2)
+            with profiler.span("write", image_path), open(json_path, "w") as f:
+                json.dump(json_dict, f, indent=2)
 
-        print(f"Saved: {json_path}")
+            print(f"Saved: {json_path}")
     end_time = time.time()
     print("inference took : "+str(end_time -start_time))
     print("time_per image: "+str((end_time -start_time)/len(image_paths)))
+    if profile:
+        profiler.write(profile, settings={"weights": str(model_path), "weights_sha256": file_sha256(model_path),
+                                          "backend": backend, "pipeline": pipeline,
+                                          "num_readers": num_readers, "batch_size": batch_size,
+                                          "confidence_threshold": confidence_threshold})
 
 def main():
     parser = argparse.ArgumentParser(description="Run YOLOv8 and export LabelMe-compatible JSON annotations.")
     parser.add_argument("--path_to_trained_model", type=str, required=True, help="Path to YOLOv8 model")
     parser.add_argument("--path_to_images", type=str, required=True, help="Path to image folder")
     parser.add_argument("--output_folder", type=str, required=True, help="Path to output folder")
+    parser.add_argument("--pipeline", action="store_true", help="Overlap image decoding, inference and JSON writing in separate threads")
+    parser.add_argument("--readers", type=int, default=2, help="Number of reader threads in --pipeline mode (default: 2)")
+    parser.add_argument("--batch_size", type=int, default=None, help="Run the model on this many images per forward pass, decoding the next batch in the background (implies --pipeline)")
+    parser.add_argument("--backend", choices=BACKENDS, default="ultralytics", help="ultralytics: YOLOv8 .pt through PyTorch (default), onnxruntime: an ONNX export on the CPU, without torch (implies --pipeline)")
+    parser.add_argument("--confidence_threshold", type=float, default=CONFIDENCE_THRESHOLD, help=f"Minimum score of the detections that are kept (default: {CONFIDENCE_THRESHOLD}), the scores are written with the shapes")
+    parser.add_argument("--profile", type=str, default=None, help="Write the per image times of every stage and the detection counts to timings.csv/timings.json in this folder (see profiling.py)")
+    parser.add_argument("--profile_trace", action="store_true", help="With --profile, also write a Chrome trace of the stages of every thread (trace.json)")
+    parser.add_argument("--cprofile", action="store_true", help="With --profile, also write cProfile statistics of the main thread (cprofile.prof)")
     args = parser.parse_args()
+    if (args.profile_trace or args.cprofile) and not args.profile:
+        parser.error("--profile_trace and --cprofile need --profile")
 
-    detect_and_save_json(args.path_to_trained_model, args.path_to_images,args.output_folder)
+    detect_and_save_json(args.path_to_trained_model, args.path_to_images,args.output_folder, pipeline=args.pipeline, num_readers=args.readers,
+                         batch_size=args.batch_size, backend=args.backend, confidence_threshold=args.confidence_threshold,
+                         profile=args.profile, profile_trace=args.profile_trace, cprofile=args.cprofile)
 
 if __name__ == "__main__":
     main()
@@ -2,37 +2,46 @@
 
 import argparse
 import os
-import json
-import torch
-from sahi import AutoDetectionModel
-from sahi.predict import get_sliced_prediction
-from tqdm import tqdm
 import time
 import pathlib
-import tifffile
+import queue
+from tile_reader import get_slice_bboxes, open_window_reader, iter_slice_windows
+from batched_inference import iter_folder_slices, iter_image_slices, run_batched_inference
+from detector_backends import BACKENDS, MAX_DETECTIONS, MAX_NMS, load_backend
+from pipeline import run_pipeline
+from file_utils import atomic_write_json, file_sha256
+from inference_manifest import append_entry, is_up_to_date, load_manifest, reset_manifest
+from detections import Detections, concatenate_detections
+from box_merge import MERGE_METHODS, merge_detections
+from image_probe import get_image_size
+from slice_filter import SliceFilter, SliceFilterChain
+from geo_output import FLATGEOBUF_SUFFIXES, GEO_OUTPUT_SUFFIXES, drop_image_features, open_feature_writer
+from detection_store import DetectionStoreWriter
+from coarse_to_fine import COARSE_CONFIDENCE_THRESHOLD, CoarseSliceSelector, serialized, thresholded
+from profiling import NULL_PROFILER, Profiler
+import numpy as np
 
-def get_image_size(image_path):
-    with tifffile.TiffFile(image_path) as tif:
-        page = tif.pages[0]
-        height, width = page.shape[:2]
-    return width, height
+CONFIDENCE_THRESHOLD = 0.3
 
-def yolo_to_labelme_shape(box, label):
-    """Convert YOLO bounding box to LabelMe rectangle shape"""
+def yolo_to_labelme_shape(box, label, score=None):
+    """Convert YOLO bounding box to LabelMe rectangle shape, with the confidence as "score" when given"""
     x1, y1, x2, y2 = map(float, box)
     x1, x2 = sorted([x1, x2])
     y1, y2 = sorted([y1, y2])
-    return {
+    shape = {
         "label": label,
         "points": [[x1, y1], [x2, y2]],
         "group_id": None,
         "shape_type": "rectangle",
         "flags": {}
     }
+    if score is not None:
+        shape["score"] = float(score)
+    return shape
 
-def create_labelme_json_dict(image_path, shapes):
-
-    width, height = get_image_size(str(image_path))
+def create_labelme_json_dict(image_path, shapes, image_size=None):
+    """image_size: (width, height) when already known, otherwise read from the image header."""
+    width, height = image_size or get_image_size(image_path)
 
     return {
         "version": "5.0.1",
@@ -45,46 +54,232 @@ def create_labelme_json_dict(image_path, shapes):
     }
 
 
-def sahi_inference(weights_path, folder_path, result_folder, slice_width, overlap_ratio):
+def object_predictions_to_detections(object_prediction_list):
+    """Convert a list of sahi ObjectPrediction to Detections."""
+    return Detections(
+        np.array([r.bbox.to_xyxy() for r in object_prediction_list], dtype=np.float32).reshape(-1, 4),
+        np.array([r.score.value for r in object_prediction_list], dtype=np.float32),
+        np.array([r.category.id for r in object_prediction_list], dtype=np.int64),
+    )
+
+
+def get_windowed_sliced_prediction(image_path, detection_model, slice_width, overlap_ratio, slice_filter=None, profiler=NULL_PROFILER):
     """
-    Performs sliced inference on a folder of images using SAHI and YOLO.
-    
+    Sliced prediction that reads one slice window at a time from the image file
+    instead of letting SAHI decode the full image first.
+
+    The slice geometry is the same as get_sliced_prediction's. The extra full-image
+    "standard" prediction that get_sliced_prediction adds is skipped, since it would
+    need the whole image in RAM. Slices dropped by slice_filter are not read.
+    The stage times of the image go to profiler.
+
+    Returns:
+        (Detections, width, height): the per-slice detections in full image
+        coordinates, not yet merged.
+    """
+    parts = []
+
+    with profiler.for_images([image_path]):
+        with profiler.span("read"):
+            reader = open_window_reader(image_path)
+        with reader:
+            full_shape = [reader.height, reader.width]
+            for (x_min, y_min, _, _), window in iter_slice_windows(reader, slice_width, overlap_ratio, slice_filter, profiler):
+                # SAHI's model wrapper preprocesses inside its forward
+                with profiler.span("forward"):
+                    detection_model.perform_inference(window)
+                with profiler.span("postprocess"):
+                    detection_model.convert_original_predictions(shift_amount=[x_min, y_min], full_shape=full_shape)
+                    object_prediction_list = [
+                        object_prediction.get_shifted_object_prediction()
+                        for object_prediction in detection_model.object_prediction_list if object_prediction
+                    ]
+                    parts.append(object_predictions_to_detections(object_prediction_list))
+
+    return concatenate_detections(parts), reader.width, reader.height
+
+
+def merge_detections_with_sahi(detections, names, width, height):
+    """
+    Merge the per-slice detections of one image with the same greedy NMM/IOS
+    postprocess that get_sliced_prediction uses.
+
+    Returns:
+        list of merged sahi ObjectPrediction.
+    """
+    from sahi.postprocess.combine import GreedyNMMPostprocess
+    from sahi.prediction import ObjectPrediction
+
+    object_prediction_list = [
+        ObjectPrediction(
+            bbox=box.tolist(),
+            category_id=int(class_id),
+            category_name=names[int(class_id)],
+            score=float(score),
+            full_shape=[height, width],
+        )
+        for box, score, class_id in zip(detections.boxes, detections.scores, detections.class_ids)
+    ]
+    if len(object_prediction_list) > 1:
+        postprocess = GreedyNMMPostprocess(match_threshold=0.5, match_metric="IOS", class_agnostic=False)
+        object_prediction_list = postprocess(object_prediction_list)
+    return object_prediction_list
+
+
+def postprocess_detections(detections, postprocess, names, width, height):
+    """
+    Merge the detections of overlapping slices.
+
     Args:
-        weights_path (str): Path to the YOLO model weights.
-        folder_path (str): Path to the folder containing images.
-        result_folder (str): Path to save the output JSON file.
-        slice_width (int): The width of each image slice.
-        overlap_ratio (float): The overlap ratio between slices.
+        postprocess (str): "sahi" for SAHI's own greedy NMM, or one of
+            box_merge.MERGE_METHODS for the vectorized implementation.
+            Both match with IOS >= 0.5 per class, like get_sliced_prediction.
     """
+    if postprocess == "sahi":
+        return object_predictions_to_detections(merge_detections_with_sahi(detections, names, width, height))
+    _, merged = merge_detections(detections, method=postprocess, match_metric="IOS", match_threshold=0.5)
+    return merged
+
+
+def get_json_path(image_path, result_folder):
+    return pathlib.Path(result_folder)/(pathlib.Path(image_path).with_suffix(".json").name)
+
+
+def save_labelme_json(image_path, detections, names, result_folder, record_manifest=False, image_size=None, writers=(),
+                      profiler=NULL_PROFILER):
+    """
+    Write the LabelMe JSON of an image atomically (temp file + rename).
+
+    image_size: (width, height) when already known, saves reading the image header.
+    writers: output writers (geo_output, detection_store) that also get the detections of the image.
+    profiler: profiling.Profiler that gets the serialize and write times of the image.
+    """
+    profiler.count("detections", len(detections.scores), image_path)
+    with profiler.span("serialize", image_path):
+        shapes = []
+
+        for box, score, class_id in zip(detections.boxes, detections.scores, detections.class_ids):
+            shape = yolo_to_labelme_shape(box.tolist(), names[int(class_id)], score)
+            shapes.append(shape)
+
+        json_dict = create_labelme_json_dict(image_path, shapes, image_size)
+    json_path = get_json_path(image_path, result_folder)
+
+    with profiler.span("write", image_path):
+        atomic_write_json(json_dict, json_path)
+        for writer in writers:
+            writer.write_image(image_path, detections, names)
+        if record_manifest:
+            append_entry(result_folder, image_path)
+
+    print(f"Saved: {json_path}")
+
+
+def batched_sahi_inference(weights_path, image_paths, result_folder, slice_width, overlap_ratio, progress, batch_size, pipeline=False, num_readers=2,
+                           incremental=False, postprocess="greedy_nmm", backend="ultralytics", num_threads=None, slice_filter=None,
+                           two_stage=None, writers=(), confidence_threshold=CONFIDENCE_THRESHOLD, profiler=NULL_PROFILER):
+    """
+    Sliced inference where slices from many images are gathered into batches of
+    batch_size, one forward pass per batch. Slices are read window by window.
+
+    With pipeline=True, num_readers threads decode and slice upcoming images, the
+    main thread runs the model and a writer thread merges and writes the JSON files.
+    The model is run by one of detector_backends.BACKENDS.
+
+    two_stage: coarse_to_fine options (factor, margin, classes, confidence_threshold)
+    to only run the slices around the candidates of a coarse pass, None to run all.
+    confidence_threshold: minimum score of the detections that are kept.
+    profiler: profiling.Profiler that gets the stage times of every image.
+    """
+    # the coarse pass finds its candidates with the same model, loaded with the lower threshold and
+    # without the maximum of detections per slice, which thresholded applies to the fine pass
+    threshold, max_detections = confidence_threshold, MAX_DETECTIONS
+    if two_stage is not None:
+        threshold = min(threshold, two_stage.get("confidence_threshold", COARSE_CONFIDENCE_THRESHOLD))
+        max_detections = MAX_NMS
+    try:
+        detector = load_backend(backend, weights_path, threshold, num_threads=num_threads, max_detections=max_detections,
+                                profiler=profiler)
+    except Exception as e:
+        print(f"Error loading model: {e}")
+        return
+    names = detector.names
+    print("model.names:"+str(names))
+    predict_batch = detector.predict_batch
+
+    selector = None
+    if two_stage is not None:
+        class_ids = None
+        if two_stage.get("classes"):
+            unknown = set(two_stage["classes"]) - set(names.values())
+            if unknown:
+                raise ValueError(f"Unknown classes {sorted(unknown)}, the model has {list(names.values())}")
+            class_ids = [class_id for class_id, name in names.items() if name in two_stage["classes"]]
+        # the coarse pass runs in the reader threads, the fine pass in the main thread
+        predict_batch = serialized(predict_batch)
+        selector = CoarseSliceSelector(predict_batch, slice_width, two_stage.get("factor", 4), two_stage.get("margin", 128),
+                                       class_ids, batch_size)
+        predict_batch = thresholded(predict_batch, confidence_threshold, MAX_DETECTIONS)
+        slice_filter = selector if slice_filter is None else SliceFilterChain([slice_filter, selector])
+
+    def write_result(result):
+        image, detections = result
+        with profiler.span("merge", image.path):
+            detections = postprocess_detections(detections, postprocess, names, image.width, image.height)
+        save_labelme_json(image.path, detections, names, result_folder, record_manifest=incremental,
+                          image_size=(image.width, image.height), writers=writers, profiler=profiler)
+        progress.update(1)
+
+    if pipeline:
+        stats = run_pipeline(
+            image_paths,
+            read_item=lambda image_path: iter_image_slices(image_path, slice_width, overlap_ratio, slice_filter, profiler),
+            process_stream=lambda slice_stream: run_batched_inference(slice_stream, predict_batch, batch_size, profiler),
+            write_result=write_result,
+            num_readers=num_readers,
+            read_queue_size=max(2 * batch_size, 8),
+        )
+        stats.report()
+    else:
+        slice_stream = iter_folder_slices(image_paths, slice_width, overlap_ratio, slice_filter, profiler)
+        for result in run_batched_inference(slice_stream, predict_batch, batch_size, profiler):
+            write_result(result)
+    if selector is not None:
+        selector.report()
+
+
+def sliced_inference(weights_path, image_paths, result_folder, slice_width, overlap_ratio, progress, windowed=False, incremental=False,
+                     postprocess="greedy_nmm", slice_filter=None, writers=(), confidence_threshold=CONFIDENCE_THRESHOLD,
+                     profiler=NULL_PROFILER):
+    """Per image sliced inference with SAHI (get_sliced_prediction or windowed reading)."""
+    import torch
+    from sahi import AutoDetectionModel
+    from sahi.predict import get_sliced_prediction
+
     # Initialize the detection model
     try:
         detection_model = AutoDetectionModel.from_pretrained(
             model_type='yolov8',
             model_path=weights_path,
-            confidence_threshold=0.3,
+            confidence_threshold=confidence_threshold,
             device="cuda:0" if torch.cuda.is_available() else "cpu"
         )
     except Exception as e:
         print(f"Error loading model: {e}")
         return
-    print("detection_model.names:"+str(detection_model.model.names))
-    # List image files in the folder
-    image_files = [f for f in os.listdir(folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tif', '.bmp', '.gif'))]
-    
-    if not image_files:
-        print("No image files found in the specified folder.")
-        return
+    names = detection_model.model.names
+    print("detection_model.names:"+str(names))
 
-    all_detections = {}
-
-    print(f"Found {len(image_files)} images. Starting inference...")
-    start_time=time.time()
-
-    for image_name in tqdm(image_files, desc="Processing Images"):
-        image_path = pathlib.Path(os.path.join(folder_path, image_name))
-        
-        if True: #try:
-            result_path = (pathlib.Path(result_folder)/pathlib.Path(image_path).name).with_suffix(".json")
+    for image_path in image_paths:
+        image_size = None
+        if windowed:
+            detections, width, height = get_windowed_sliced_prediction(
+                image_path, detection_model, slice_width, overlap_ratio, slice_filter, profiler
+            )
+            with profiler.span("merge", image_path):
+                detections = postprocess_detections(detections, postprocess, names, width, height)
+            image_size = (width, height)
+        else:
             # Perform sliced prediction with user-defined slice parameters
             result = get_sliced_prediction(
                 str(image_path),
@@ -94,53 +289,305 @@ def sahi_inference(weights_path, folder_path, result_folder, slice_width, overla
                 overlap_height_ratio=overlap_ratio,
                 overlap_width_ratio=overlap_ratio
             )
+            # already merged by SAHI's own postprocess
+            detections = object_predictions_to_detections(result.object_prediction_list)
+            # SAHI times the image read with the slicing, and the merge with the prediction
+            profiler.add("slice", result.durations_in_seconds.get("slice", 0.0), image_path)
+            profiler.add("forward", result.durations_in_seconds.get("prediction", 0.0), image_path)
+            # the slices SAHI cut, with its geometry (the JSON needs the image size anyway)
+            image_size = get_image_size(image_path)
+            profiler.count("slices", len(get_slice_bboxes(*image_size, slice_width, slice_width, overlap_ratio, overlap_ratio)),
+                           image_path)
 
+        save_labelme_json(image_path, detections, names, result_folder, record_manifest=incremental, image_size=image_size,
+                          writers=writers, profiler=profiler)
+        progress.update(1)
 
 
-        results = result
-        shapes = []
+def run_inference(weights_path, image_paths, result_folder, slice_width, overlap_ratio, progress,
+                  windowed=False, batch_size=None, pipeline=False, num_readers=2, incremental=False, postprocess="greedy_nmm",
+                  backend="ultralytics", num_threads=None, skip_slices=None, two_stage=None, geo_output=None, store=None,
+                  confidence_threshold=CONFIDENCE_THRESHOLD, profiler=NULL_PROFILER):
+    """
+    Run the inference mode selected by the options on a list of images, reporting to progress.
+    Backends other than ultralytics always use the batched path, SAHI's model wrapper needs torch.
+    skip_slices: slice_filter.SliceFilter options to skip empty slices (reads windowed), None to run every slice.
+    two_stage: coarse_to_fine options for the two-stage mode (always batched), None for the exhaustive mode.
+    geo_output: geo_output file the georeferenced features are appended to, None for LabelMe JSON only.
+    store: detection_store directory the detections are written to, None for LabelMe JSON only.
+    profiler: profiling.Profiler that gets the stage times of every image.
+    """
+    slice_filter = SliceFilter(**skip_slices) if skip_slices is not None else None
+    writers = []
+    if geo_output:
+        writers.append(open_feature_writer(geo_output))
+    if store:
+        writers.append(DetectionStoreWriter(store))
+    try:
+        if batch_size or pipeline or backend != "ultralytics" or two_stage is not None:
+            batched_sahi_inference(
+                weights_path, image_paths, result_folder, slice_width, overlap_ratio, progress,
+                batch_size or 1, pipeline=pipeline, num_readers=num_readers, incremental=incremental,
+                postprocess=postprocess, backend=backend, num_threads=num_threads, slice_filter=slice_filter,
+                two_stage=two_stage, writers=writers, confidence_threshold=confidence_threshold, profiler=profiler
+            )
+        else:
+            sliced_inference(
+                weights_path, image_paths, result_folder, slice_width, overlap_ratio, progress,
+                windowed=windowed or slice_filter is not None, incremental=incremental, postprocess=postprocess,
+                slice_filter=slice_filter, writers=writers, confidence_threshold=confidence_threshold, profiler=profiler
+            )
+    finally:
+        for writer in writers:
+            writer.close()
+    if slice_filter is not None:
+        slice_filter.report()
 
-        for r in results.object_prediction_list:
-            #print("r:"+str(r))
-            #print(" pred.category.name:"+str(r.category.name))
-            #print("bbox  : "+str(r.bbox))
-            #print("bbox  : "+str(dir(r.bbox)))
-            #print("bbox  : "+str(r.bbox.to_xyxy()))
 
-            shape = yolo_to_labelme_shape(r.bbox.to_xyxy(), r.category.name)
-            shapes.append(shape)
+class QueueProgress:
+    """Stands in for tqdm in a worker process, forwards progress to the parent through a queue."""
+
+    def __init__(self, progress_queue):
+        self.progress_queue = progress_queue
+
+    def update(self, n=1):
+        self.progress_queue.put(n)
+
+
+def _inference_worker(shard, num_threads, progress_queue, args, kwargs):
+    # Limit the intra-op threads so N workers share the cores instead of oversubscribing them
+    if kwargs.get("backend", "ultralytics") == "ultralytics":
+        import torch
+        torch.set_num_threads(num_threads)
+    weights_path, _, *rest = args
+    try:
+        run_inference(weights_path, shard, *rest, QueueProgress(progress_queue), num_threads=num_threads, **kwargs)
+    finally:
+        progress_queue.put(None)
+
+
+def sharded_inference(image_paths, workers, threads_per_worker, progress, args, kwargs):
+    """
+    Split image_paths into shards and run each shard in its own process.
+    Every worker loads the weights once; progress from all workers is merged into progress.
+    """
+    import multiprocessing
+
+    # spawn instead of fork, forking a process that already initialized torch is not safe
+    context = multiprocessing.get_context("spawn")
+    progress_queue = context.Queue()
+    # Round robin shards, so large and small images are spread over the workers
+    shards = [image_paths[i::workers] for i in range(workers)]
+    processes = [
+        context.Process(target=_inference_worker, args=(shard, threads_per_worker, progress_queue, args, kwargs))
+        for shard in shards if shard
+    ]
+    for process in processes:
+        process.start()
 
+    running = len(processes)
+    while running:
+        try:
+            message = progress_queue.get(timeout=5)
+        except queue.Empty:
+            # A worker that died (e.g. out of memory) never sends its end message
+            running = sum(process.is_alive() for process in processes)
+            continue
+        if message is None:
+            running -= 1
+        else:
+            progress.update(message)
 
+    for process in processes:
+        process.join()
+        if process.exitcode != 0:
+            print(f"Worker {process.name} exited with code {process.exitcode}")
 
-            #bbox = pred.bbox.minx, pred.bbox.miny, pred.bbox.maxx, pred.bbox.maxy
-            #confidence = pred.score.value
-            #for box, cls in zip(r.boxes.xyxy, r.boxes.cls):
-            #    shape = yolo_to_labelme_shape(bbox.tolist(), detection_model.model.names[int(category)])
-            #    shapes.append(shape)
 
-        json_dict = create_labelme_json_dict(image_path, shapes)
-        json_path = pathlib.Path(result_folder)/(image_path.with_suffix(".json").name)
+def sahi_inference(weights_path, folder_path, result_folder, slice_width, overlap_ratio, windowed=False, batch_size=None,
+                   pipeline=False, num_readers=2, workers=1, threads_per_worker=None, incremental=False,
+                   postprocess="greedy_nmm", backend="ultralytics", skip_slices=None, two_stage=None, geo_output=None, store=None,
+                   confidence_threshold=CONFIDENCE_THRESHOLD, profile=None, profile_trace=False, cprofile=False):
+    """
+    Performs sliced inference on a folder of images using SAHI and YOLO.
+    
+    Args:
+        weights_path (str): Path to the YOLO model weights.
+        folder_path (str): Path to the folder containing images.
+        result_folder (str): Path to save the output JSON file.
+        slice_width (int): The width of each image slice.
+        overlap_ratio (float): The overlap ratio between slices.
+        windowed (bool): Read each slice window straight from the file instead of
+            decoding the full image, keeps memory bounded to a few slices.
+        batch_size (int): If set, batch slices across images into forward passes of
+            this many slices (always reads windowed).
+        pipeline (bool): Overlap decoding, model forward and JSON writing in separate
+            threads (uses the batched path, batch_size defaults to 1).
+        num_readers (int): Number of reader threads in pipeline mode.
+        workers (int): Number of worker processes, each processing a shard of the images.
+        threads_per_worker (int): Torch/onnxruntime intra-op threads per worker (default: cores / workers).
+        incremental (bool): Skip images whose JSON in result_folder is up to date according
+            to the manifest kept there, and record every finished image in it.
+        postprocess (str): How detections of overlapping slices are merged in the windowed
+            and batched modes: "greedy_nmm" (default), "nmm" or "nms" with the vectorized
+            box_merge engine, or "sahi" for SAHI's own greedy NMM.
+        backend (str): "ultralytics" (.pt weights, through PyTorch) or "onnxruntime"
+            (an ONNX export, on the CPU without torch, always batched).
+        skip_slices (dict): If set, skip nodata and plain slices before inference,
+            judged on an overview of the image, with these slice_filter.SliceFilter
+            options (e.g. {"min_std": 2.0}). Reads windowed.
+        two_stage (dict): If set, run a coarse pass on the image reduced "factor" times
+            and the full resolution slices only around its candidates (grown by
+            "margin" pixels, only candidates of "classes" if given, found above
+            "confidence_threshold"), see coarse_to_fine. Always batched.
+        geo_output (str): If set, also write the detections georeferenced through the
+            geotransform of every image, streamed image by image, as newline-delimited
+            GeoJSON (.geojsonl, .geojsons, .ndjson) or FlatGeobuf (.fgb), see geo_output.
+            With incremental, the features of the images run again replace their earlier ones.
+        store (str): If set, also write the detections with their scores into this
+            columnar detection_store directory (started empty). Not with workers or
+            incremental, convert their LabelMe JSON with detection_store.py instead.
+        confidence_threshold (float): Minimum score of the detections that are kept. The
+            scores are written with the shapes, so a run at a low threshold can be
+            filtered later with filter_detections.py without running the model again.
+        profile (str): If set, write the per image times of the stages (read, slice,
+            preprocess, forward, postprocess, merge, serialize, write) with the slice and
+            detection counts into this folder as timings.csv and timings.json, see profiling.
+            Not with workers.
+        profile_trace (bool): With profile, also write the timed spans of every thread as
+            a Chrome trace (trace.json).
+        cprofile (bool): With profile, also write cProfile statistics of the main thread
+            (cprofile.prof).
+    """
+    from tqdm import tqdm
+
+    if geo_output:
+        suffix = pathlib.Path(geo_output).suffix.lower()
+        if suffix not in GEO_OUTPUT_SUFFIXES:
+            raise ValueError(f"Unknown georeferenced output format {suffix}, expected one of {GEO_OUTPUT_SUFFIXES}")
+        if suffix in FLATGEOBUF_SUFFIXES and (workers > 1 or incremental):
+            raise ValueError("FlatGeobuf output can not be shared by workers or appended to, use newline-delimited GeoJSON")
+        if not incremental:
+            # workers append to the NDJSON file, FlatGeobuf is created by fiona
+            if suffix in FLATGEOBUF_SUFFIXES:
+                pathlib.Path(geo_output).unlink(missing_ok=True)
+            else:
+                open(geo_output, "w").close()
+    if store and (workers > 1 or incremental):
+        raise ValueError("A detection store can not be shared by workers or updated incrementally, "
+                         "convert the LabelMe JSON with detection_store.py from_labelme")
+    if profile and workers > 1:
+        raise ValueError("Profile a run with one worker, the stage times of workers sharing the cores are not comparable")
+
+    # List image files in the folder
+    image_files = [f for f in os.listdir(folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tif', '.bmp', '.gif'))]
+    
+    if not image_files:
+        print("No image files found in the specified folder.")
+        return
+
+    image_paths = [pathlib.Path(os.path.join(folder_path, image_name)) for image_name in image_files]
+    print(f"Found {len(image_files)} images.")
+
+    if incremental:
+        settings = {
+            "weights_sha256": file_sha256(weights_path),
+            "slice_width": slice_width,
+            "overlap_ratio": overlap_ratio,
+            "confidence_threshold": confidence_threshold,
+            # the merge and the inference path change the detections
+            "postprocess": postprocess,
+            "windowed": windowed,
+            "batch_size": batch_size,
+        }
+        if backend != "ultralytics":
+            settings["backend"] = backend
+        if skip_slices is not None:
+            settings["skip_slices"] = skip_slices
+        if two_stage is not None:
+            settings["two_stage"] = two_stage
+        entries = load_manifest(result_folder, settings)
+        image_paths = [p for p in image_paths if not is_up_to_date(entries, p, get_json_path(p, result_folder))]
+        print(f"Skipping {len(image_files) - len(image_paths)} images with up to date results.")
+        if not image_paths:
+            return
+        if geo_output:
+            # features of earlier runs of these images (changed, or cut off by a crash before being recorded)
+            removed = drop_image_features(geo_output, [p.name for p in image_paths])
+            if removed:
+                print(f"Removed {removed} features of the images to run again from {geo_output}.")
+    else:
+        # the results are rewritten without being recorded, a later incremental run must not trust the manifest
+        reset_manifest(result_folder)
+
+    profiler = Profiler(trace=profile_trace, cprofile=cprofile) if profile else NULL_PROFILER
+    args = (weights_path, image_paths, result_folder, slice_width, overlap_ratio)
+    kwargs = dict(windowed=windowed, batch_size=batch_size, pipeline=pipeline, num_readers=num_readers, incremental=incremental,
+                  postprocess=postprocess, backend=backend, skip_slices=skip_slices, two_stage=two_stage,
+                  geo_output=geo_output, store=store, confidence_threshold=confidence_threshold, profiler=profiler)
 
-        with open(json_path, "w") as f:
-            json.dump(json_dict, f, indent=2)
+    print(f"Starting inference on {len(image_paths)} images...")
+    start_time=time.time()
+    progress = tqdm(total=len(image_paths), desc="Processing Images")
 
-        print(f"Saved: {json_path}")
+    if workers > 1:
+        threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        print(f"Running {workers} workers with {threads_per_worker} threads each")
+        sharded_inference(image_paths, workers, threads_per_worker, progress, args, kwargs)
+    else:
+        run_inference(*args, progress, **kwargs)
+    progress.close()
     
     print("inference took (seconds): "+str(time.time()-start_time))
-    print("inference per image(seconds): "+str((time.time()-start_time)/len(image_files)))
+    print("inference per image(seconds): "+str((time.time()-start_time)/len(image_paths)))
+    if profile:
+        profiler.write(profile, settings={
+            "weights": str(weights_path), "weights_sha256": file_sha256(weights_path), "backend": backend,
+            "slice_width": slice_width, "overlap_ratio": overlap_ratio, "windowed": windowed, "batch_size": batch_size,
+            "pipeline": pipeline, "num_readers": num_readers, "postprocess": postprocess,
+            "confidence_threshold": confidence_threshold, "skip_slices": skip_slices, "two_stage": two_stage,
+        })
 
-if __name__ == "__main__":
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Run sliced object detection on large images using SAHI.")
     parser.add_argument("--weights", required=True, help="Path to the YOLO model weights file (e.g., best.pt).")
     parser.add_argument("--folder_with_images", required=True, help="Path to the folder containing the images.")
     parser.add_argument("--result_folder", required=True, help="Path to a foloder where the output JSON file should be saved.")
     parser.add_argument("--slice_width", type=int, default=640, help="Width of the image slices (default: 640).")
     parser.add_argument("--overlap_ratio", type=float, default=0.0625, help="Overlap ratio between slices (default: 0.0625).")
+    parser.add_argument("--windowed", action="store_true", help="Read each slice window directly from the TIFF instead of decoding the full image (bounded memory).")
+    parser.add_argument("--batch_size", type=int, default=None, help="Batch slices from many images into forward passes of this many slices (implies --windowed).")
+    parser.add_argument("--pipeline", action="store_true", help="Overlap image decoding, inference and JSON writing in separate threads (bounded queues).")
+    parser.add_argument("--readers", type=int, default=2, help="Number of reader threads in --pipeline mode (default: 2).")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, the images are split into one shard per worker (default: 1).")
+    parser.add_argument("--threads_per_worker", type=int, default=None, help="Intra-op threads (torch or onnxruntime) per worker (default: CPU cores / workers).")
+    parser.add_argument("--incremental", action="store_true", help="Resume/update a previous run: skip images whose results in result_folder are up to date (tracked in a manifest there).")
+    parser.add_argument("--postprocess", choices=MERGE_METHODS + ("sahi",), default="greedy_nmm", help="How detections of overlapping slices are merged in --windowed/--batch_size mode (default: greedy_nmm, vectorized).")
+    parser.add_argument("--backend", choices=BACKENDS, default="ultralytics", help="ultralytics: .pt weights through PyTorch (default), onnxruntime: an ONNX export (train.py --export) on the CPU, without torch (implies --batch_size).")
 
-    args = parser.parse_args()
-
+    parser.add_argument("--skip_empty", action="store_true", help="Skip nodata and near-constant slices (sky, water) before inference, judged on a reduced overview of the image (implies --windowed).")
+    parser.add_argument("--skip_min_std", type=float, default=0.0, help="With --skip_empty, also skip slices whose gray value standard deviation is below this (default: 0, off).")
+    parser.add_argument("--skip_min_entropy", type=float, default=0.0, help="With --skip_empty, also skip slices whose gray value entropy in bits is below this (default: 0, off).")
+    parser.add_argument("--nodata", type=int, default=None, help="With --skip_empty, the nodata value of the images (default: the one stored in the file, if any).")
+    parser.add_argument("--two_stage", action="store_true", help="Coarse-to-fine mode for sparse objects: detect candidates on a reduced image first and only run the full resolution slices around them (implies --batch_size).")
+    parser.add_argument("--coarse_factor", type=int, default=4, help="With --two_stage, reduction of the image in the coarse pass (default: 4).")
+    parser.add_argument("--coarse_margin", type=int, default=128, help="With --two_stage, safety margin around the coarse candidates in full resolution pixels (default: 128).")
+    parser.add_argument("--coarse_confidence", type=float, default=COARSE_CONFIDENCE_THRESHOLD, help=f"With --two_stage, confidence threshold of the coarse candidates (default: {COARSE_CONFIDENCE_THRESHOLD}).")
+    parser.add_argument("--coarse_classes", nargs="+", default=None, help="With --two_stage, only candidates of these class names select slices (default: all classes).")
+    parser.add_argument("--geo_output", default=None, help="Also write the georeferenced detections (through the GeoTIFF geotransform) to this file, streamed image by image: newline-delimited GeoJSON (.geojsonl/.geojsons/.ndjson) or FlatGeobuf (.fgb).")
+    parser.add_argument("--confidence_threshold", type=float, default=CONFIDENCE_THRESHOLD, help=f"Minimum score of the detections that are kept (default: {CONFIDENCE_THRESHOLD}). Scores are written with the shapes: run once at a low threshold and filter with filter_detections.py.")
+    parser.add_argument("--store", default=None, help="Also write the detections, with their scores, into this columnar detection store directory (see detection_store.py).")
+    parser.add_argument("--profile", default=None, help="Write the per image times of every stage (read, slice, preprocess, forward, postprocess, merge, serialize, write) and the slice and detection counts to timings.csv/timings.json in this folder (see profiling.py).")
+    parser.add_argument("--profile_trace", action="store_true", help="With --profile, also write a Chrome trace of the stages of every thread (trace.json, open in Perfetto or speedscope).")
+    parser.add_argument("--cprofile", action="store_true", help="With --profile, also write cProfile statistics of the main thread (cprofile.prof).")
+    args = parser.parse_args(argv)
+    if (args.profile_trace or args.cprofile) and not args.profile:
+        parser.error("--profile_trace and --cprofile need --profile")
 
-    print("GPU is available: "+str(torch.cuda.is_available()))
+    if args.backend == "ultralytics":
+        import torch
+        print("GPU is available: "+str(torch.cuda.is_available()))
 
     # Create the output directory if it doesn't exist
     os.makedirs(args.result_folder, exist_ok=True)
@@ -150,5 +597,24 @@ if __name__ == "__main__":
         args.folder_with_images, 
         args.result_folder, 
         args.slice_width, 
-        args.overlap_ratio
+        args.overlap_ratio,
+        windowed=args.windowed,
+        batch_size=args.batch_size,
+        pipeline=args.pipeline,
+        num_readers=args.readers,
+        workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+        incremental=args.incremental,
+        postprocess=args.postprocess,
+        backend=args.backend,
+        skip_slices=dict(min_std=args.skip_min_std, min_entropy=args.skip_min_entropy, nodata=args.nodata) if args.skip_empty else None,
+        two_stage=dict(factor=args.coarse_factor, margin=args.coarse_margin, confidence_threshold=args.coarse_confidence,
+                       classes=args.coarse_classes) if args.two_stage else None,
+        geo_output=args.geo_output, store=args.store,
+        confidence_threshold=args.confidence_threshold,
+        profile=args.profile, profile_trace=args.profile_trace, cprofile=args.cprofile
     )
+
+
+if __name__ == "__main__":
+    main()
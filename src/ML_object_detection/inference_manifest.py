@@ -0,0 +1,92 @@
+"""
+Manifest for resumable, incremental inference runs.
+
+The manifest lives in the result folder as JSON lines. The first line holds the
+settings of the run (weights hash, slice geometry, merge and every other option
+that changes the detections), every following line records one finished image
+(mtime and size). Lines are appended when an image's JSON has been written, so a
+crashed run loses at most the image it was working on.
+
+If the settings change, all existing results are out of date and the manifest is
+started again. An image whose mtime or size changed is redone: a hash of a few
+samples of a large TIFF would miss edits elsewhere in it, and hashing all of it
+costs as much I/O as running the inference. A run that is not incremental
+rewrites the results without recording them, it removes the manifest.
+"""
+import json
+import os
+from pathlib import Path
+
+MANIFEST_NAME = ".inference_manifest.jsonl"
+
+
+def manifest_path(result_folder):
+    return Path(result_folder) / MANIFEST_NAME
+
+
+def load_manifest(result_folder, settings):
+    """
+    Load the entries of the manifest in result_folder.
+
+    Returns:
+        dict image name -> entry. Empty (and the manifest is restarted) when the
+        manifest is missing, unreadable or was written with other settings.
+    """
+    path = manifest_path(result_folder)
+    entries = {}
+    header = None
+    if path.exists():
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line cut short by a crash, the image will simply be redone
+                    continue
+                if header is None:
+                    header = record
+                    if header.get("settings") != settings:
+                        break
+                    continue
+                entries[record["image"]] = record
+
+    if header is None or header.get("settings") != settings:
+        if header is not None:
+            print("Inference settings changed since the last run, all images will be processed again.")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"settings": settings}) + "\n")
+        return {}
+    return entries
+
+
+def image_entry(image_path):
+    stat = os.stat(image_path)
+    return {
+        "image": Path(image_path).name,
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+    }
+
+
+def is_up_to_date(entries, image_path, json_path):
+    """True if json_path exists and was produced from the current content of image_path."""
+    entry = entries.get(Path(image_path).name)
+    if entry is None or not Path(json_path).exists():
+        return False
+    stat = os.stat(image_path)
+    return stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]
+
+
+def reset_manifest(result_folder):
+    """Forget all recorded images, for a run that rewrites the results without recording them."""
+    manifest_path(result_folder).unlink(missing_ok=True)
+
+
+def append_entry(result_folder, image_path):
+    """
+    Record a finished image. One write per line in append mode, so threads and
+    worker processes can record into the same manifest.
+    """
+    line = json.dumps(image_entry(image_path)) + "\n"
+    with open(manifest_path(result_folder), "a", encoding="utf-8") as f:
+        f.write(line)
@@ -0,0 +1,346 @@
+"""
+Long-running local inference service.
+
+The model is loaded and warmed up once and stays resident, so small jobs do not pay
+the model load of infer_with_sahi.py every time:
+
+    python inference_server.py --weights best.pt --port 8765
+    python inference_server.py --weights best.onnx --backend onnxruntime --socket /tmp/detector.sock
+
+It speaks JSON over HTTP, on localhost or on a Unix socket:
+
+    POST /predict  {"image_path": "/data/image.tif",
+                    "window": [x, y, width, height],    (optional, default: the full image)
+                    "output_json": "/out/image.json",   (optional, also write the result there)
+                    "slice_width": 640, "overlap_ratio": 0.0625, "postprocess": "greedy_nmm"}
+               -> a LabelMe dict: the rectangles of the image (or of the window, in image
+                  coordinates), imageWidth and imageHeight of the image
+    GET /health    -> class names and request / batching counters
+
+    curl -s localhost:8765/predict -d '{"image_path": "/data/image.tif"}'
+    curl -s --unix-socket /tmp/detector.sock http://localhost/predict -d '{"image_path": "/data/image.tif"}'
+
+Every request is handled in its own thread, which reads and slices its image and
+hands the slices to the micro-batcher. One model thread runs the slices of all
+concurrent requests together: a forward pass starts when max_batch_size slices are
+waiting, or when the oldest waiting slice has waited max_latency_ms. The slices are
+then shifted, merged and converted like in infer_with_sahi.py.
+
+InferenceClient sends requests from Python (one client per thread).
+"""
+import argparse
+import http.client
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+
+from box_merge import MERGE_METHODS
+from detections import concatenate_detections, shift_detections
+from detector_backends import BACKENDS, load_backend
+from file_utils import atomic_write_json
+from infer_with_sahi import CONFIDENCE_THRESHOLD, create_labelme_json_dict, postprocess_detections, yolo_to_labelme_shape
+from tile_reader import get_slice_bboxes, open_window_reader
+
+DEFAULT_PORT = 8765
+_STOP = object()
+
+
+class MicroBatcher:
+    """
+    Runs predict_batch on one thread for slices submitted from many threads.
+
+    submit() returns a Future per slice. Slices are gathered into batches of up to
+    max_batch_size, a batch is run as soon as it is full or its first slice has
+    waited max_latency seconds. The queue is bounded, so request threads that read
+    faster than the model predicts wait instead of piling up slices in memory.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=8, max_latency=0.01):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.batches = 0
+        self.slices = 0
+        self._queue = queue.Queue(maxsize=4 * max_batch_size)
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, array):
+        future = Future()
+        self._queue.put((time.monotonic(), array, future))
+        return future
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = item[0] + self.max_latency
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        try:
+            predictions = self.predict_batch([array for _, array, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.slices += len(batch)
+        for (_, _, future), detections in zip(batch, predictions):
+            future.set_result(detections)
+
+
+class InferenceService:
+    """The resident model and the request handling that does not depend on the transport."""
+
+    def __init__(self, detector, batcher, slice_width=640, overlap_ratio=0.0625, postprocess="greedy_nmm"):
+        self.detector = detector
+        self.names = detector.names
+        self.batcher = batcher
+        self.slice_width = slice_width
+        self.overlap_ratio = overlap_ratio
+        self.postprocess = postprocess
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def predict(self, image_path, window=None, output_json=None, slice_width=None, overlap_ratio=None, postprocess=None):
+        """
+        Detect the objects of an image, or of a window of it.
+
+        Args:
+            image_path (str): Image readable by tile_reader.
+            window (list): [x, y, width, height] in pixels (default: the full image).
+            output_json (str): If set, also write the LabelMe JSON there.
+            slice_width, overlap_ratio, postprocess: Override the defaults of the server.
+
+        Returns:
+            LabelMe dict with the rectangles in image coordinates.
+        """
+        slice_width = slice_width or self.slice_width
+        overlap_ratio = self.overlap_ratio if overlap_ratio is None else overlap_ratio
+        postprocess = postprocess or self.postprocess
+        if postprocess not in MERGE_METHODS + ("sahi",):
+            raise ValueError(f"Unknown postprocess {postprocess}")
+
+        futures = []
+        with open_window_reader(image_path) as reader:
+            width, height = reader.width, reader.height
+            x, y, w, h = window or (0, 0, width, height)
+            if w <= 0 or h <= 0 or x < 0 or y < 0 or x + w > width or y + h > height:
+                raise ValueError(f"Window {window} is not inside the {width}x{height} image")
+            # slices are submitted while the next ones are read
+            for x_min, y_min, x_max, y_max in get_slice_bboxes(w, h, slice_width, slice_width, overlap_ratio, overlap_ratio):
+                bbox = (x + x_min, y + y_min, x + x_max, y + y_max)
+                futures.append((bbox, self.batcher.submit(reader.read_window(*bbox))))
+
+        parts = [
+            shift_detections(future.result(), x_min, y_min, x_max - x_min, y_max - y_min)
+            for (x_min, y_min, x_max, y_max), future in futures
+        ]
+        detections = postprocess_detections(concatenate_detections(parts), postprocess, self.names, width, height)
+        shapes = [yolo_to_labelme_shape(box.tolist(), self.names[int(class_id)], score)
+                  for box, score, class_id in zip(detections.boxes, detections.scores, detections.class_ids)]
+        result = create_labelme_json_dict(Path(image_path), shapes, (width, height))
+        if output_json:
+            atomic_write_json(result, output_json)
+        with self._lock:
+            self.requests += 1
+        return result
+
+    def health(self):
+        return {
+            "status": "ok",
+            "names": self.names,
+            "requests": self.requests,
+            "batches": self.batcher.batches,
+            "slices": self.batcher.slices,
+            "mean_batch_size": self.batcher.slices / self.batcher.batches if self.batcher.batches else 0.0,
+        }
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive, so a client sends many requests over one connection
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self.send_json(404, {"error": f"Unknown path {self.path}"})
+        self.send_json(200, self.server.service.health())
+
+    def do_POST(self):
+        if self.path != "/predict":
+            return self.send_json(404, {"error": f"Unknown path {self.path}"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            result = self.server.service.predict(**request)
+        except (ValueError, TypeError, FileNotFoundError) as e:
+            return self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            return self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+        self.send_json(200, result)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(service, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None, verbose=False):
+    """HTTP server of service on host:port, or on the Unix socket socket_path when given."""
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, InferenceRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), InferenceRequestHandler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class InferenceClient:
+    """
+    Client of a running inference server, keeps its connection open between requests.
+    Not thread safe, use one client per thread.
+    """
+
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None, timeout=None):
+        if socket_path:
+            self.connection = UnixHTTPConnection(socket_path, timeout=timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(self, method, path, data=None):
+        body = None if data is None else json.dumps(data).encode("utf-8")
+        headers = {"Content-Type": "application/json"} if body else {}
+        for attempt in range(2):
+            try:
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                break
+            except (ConnectionError, http.client.RemoteDisconnected):
+                # the server closed the kept-alive connection, retry once on a new one
+                self.connection.close()
+                if attempt:
+                    raise
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(f"Inference server error {response.status}: {result.get('error')}")
+        return result
+
+    def predict(self, image_path, window=None, output_json=None, **options):
+        """
+        Detect the objects of an image (or of a window [x, y, width, height] of it).
+        options: slice_width, overlap_ratio, postprocess.
+
+        Returns:
+            LabelMe dict with the rectangles in image coordinates.
+        """
+        request = {"image_path": str(image_path), **options}
+        if window is not None:
+            request["window"] = [int(v) for v in window]
+        if output_json is not None:
+            request["output_json"] = str(output_json)
+        return self._request("POST", "/predict", request)
+
+    def health(self):
+        return self._request("GET", "/health")
+
+    def close(self):
+        self.connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve sliced object detection with a resident model over local HTTP.")
+    parser.add_argument("--weights", required=True, help="Path to the YOLO model weights file (e.g., best.pt) or ONNX export.")
+    parser.add_argument("--backend", choices=BACKENDS, default="ultralytics", help="Detector backend (default: ultralytics).")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1, local only).")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port to listen on (default: {DEFAULT_PORT}).")
+    parser.add_argument("--socket", default=None, help="Listen on this Unix socket instead of host:port.")
+    parser.add_argument("--slice_width", type=int, default=640, help="Default width of the image slices (default: 640).")
+    parser.add_argument("--overlap_ratio", type=float, default=0.0625, help="Default overlap ratio between slices (default: 0.0625).")
+    parser.add_argument("--postprocess", choices=MERGE_METHODS + ("sahi",), default="greedy_nmm", help="Default merge of overlapping slices (default: greedy_nmm).")
+    parser.add_argument("--confidence_threshold", type=float, default=CONFIDENCE_THRESHOLD, help=f"Minimum score of the detections (default: {CONFIDENCE_THRESHOLD}).")
+    parser.add_argument("--max_batch_size", type=int, default=8, help="Maximum slices per forward pass (default: 8).")
+    parser.add_argument("--max_latency_ms", type=float, default=10.0, help="Longest a slice waits for a batch to fill, in ms (default: 10).")
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads of the onnxruntime backend (default: onnxruntime's).")
+    parser.add_argument("--verbose", action="store_true", help="Log every request.")
+    args = parser.parse_args(argv)
+
+    detector = load_backend(args.backend, args.weights, args.confidence_threshold, num_threads=args.threads)
+    print("model.names:" + str(detector.names))
+    # warm up, so the first request does not pay for it
+    detector.predict_batch([np.zeros((args.slice_width, args.slice_width, 3), dtype=np.uint8)] * args.max_batch_size)
+
+    batcher = MicroBatcher(detector.predict_batch, args.max_batch_size, args.max_latency_ms / 1000)
+    service = InferenceService(detector, batcher, args.slice_width, args.overlap_ratio, args.postprocess)
+    server = create_server(service, args.host, args.port, args.socket, args.verbose)
+    # stop cleanly on SIGTERM (e.g. from a process manager) like on Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f"Serving {args.weights} on {args.socket or f'http://{args.host}:{args.port}'} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,383 @@
+"""
+Merges GeoJSON files into one, streaming: the inputs are decoded one feature at a
+time and every feature is written out right away, so the memory use does not grow
+with the number or size of the inputs.
+
+Input:  GeoJSON FeatureCollections, or newline-delimited GeoJSON (.geojsonl,
+        .geojsons, .ndjson) like infer_with_sahi.py --geo_output writes.
+Output, chosen by the suffix of the output path:
+
+    .geojson (or other) -> GeoJSON FeatureCollection, one feature per line
+    .geojsonl / .geojsons / .ndjson -> newline-delimited GeoJSON
+    .fgb  -> FlatGeobuf with a packed R-tree spatial index (through fiona)
+    .gpkg -> GeoPackage with an R-tree spatial index (through fiona)
+
+Every feature gets the property image, the name of the FeatureCollection file it
+came from (newline-delimited features keep the image they already have). The CRS
+of the first input that has one is used for the output.
+
+FlatGeobuf and GeoPackage need the CRS and the fields before the first feature,
+while a FeatureCollection may carry its "crs" member after its features (like the
+output of this tool). For them the inputs are read twice: a first pass collects
+the CRS and the properties of all features into the fields, the second writes.
+"""
 import argparse
 import json
+import re
 import sys
 from pathlib import Path
-def merge_geojson_files(input_paths, output_path):
+
+from geo_output import NDJSON_SUFFIXES
+
+CHUNK_SIZE = 1 << 20
+WRITE_BATCH = 10000
+# output suffix -> fiona driver, both create a spatial index
+FIONA_DRIVERS = {".fgb": "FlatGeobuf", ".gpkg": "GPKG"}
+# GeoJSON property value -> fiona field type, anything else is written as JSON text
+FIELD_TYPES = {bool: "bool", int: "int", float: "float", str: "str"}
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# what may follow a complete JSON value
+_DELIMITERS = " \t\n\r,:]}"
+
+
+class JsonStreamReader:
+    """
+    Decodes a JSON text piece by piece with json.JSONDecoder.raw_decode, holding
+    only the undecoded rest of the last chunk read and the value being decoded.
+    """
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """The next non-whitespace character, '' at the end of the text."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read():
+                return ""
+
+    def expect(self, chars):
+        """Consume the next non-whitespace character, which must be one of chars, and return it."""
+        char = self.peek()
+        if not char or char not in chars:
+            raise json.JSONDecodeError(f"Expecting one of {chars!r}", self.buffer, self.pos)
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """Decode the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number cut by the end of the buffer ("12." of "12.5") may go on in the next chunk
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in _DELIMITERS):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read()
+
+
+def iter_feature_collection(f, chunk_size=CHUNK_SIZE):
+    """
+    Stream the members of a GeoJSON object.
+
+    Yields:
+        (key, value) for every member, but ("features", feature) for every single
+        feature of the features array, in the order of the file.
+    """
+    stream = JsonStreamReader(f, chunk_size)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+    while True:
+        key = stream.decode()
+        if not isinstance(key, str):
+            raise json.JSONDecodeError("Expecting property name", stream.buffer, stream.pos)
+        stream.expect(":")
+        if key == "features":
+            stream.expect("[")
+            if stream.peek() == "]":
+                stream.pos += 1
+            else:
+                while True:
+                    yield "features", stream.decode()
+                    if stream.expect(",]") == "]":
+                        break
+        else:
+            yield key, stream.decode()
+        if stream.expect(",}") == "}":
+            break
+
+
+def iter_ndjson_features(f):
+    """
+    Stream newline-delimited GeoJSON (also RFC 8142 text sequences).
+
+    Yields:
+        ("crs", crs) for the "crs" member of a feature, then ("features", feature).
+    """
+    for line in f:
+        line = line.strip().lstrip("\x1e")
+        if not line:
+            continue
+        feature = json.loads(line)
+        crs = feature.pop("crs", None)
+        if crs is not None:
+            yield "crs", crs
+        yield "features", feature
+
+
+class GeoJsonWriter:
+    """Writes a FeatureCollection, one feature per line. The CRS member goes last, it is known only at the end."""
+
+    def __init__(self, path):
+        self.f = open(path, "w", encoding="utf-8")
+        self.f.write('{"type": "FeatureCollection", "features": [')
+        self.crs = None
+        self.features = 0
+
+    def write(self, feature):
+        self.f.write(("\n" if not self.features else ",\n") + json.dumps(feature))
+        self.features += 1
+
+    def close(self):
+        self.f.write("\n]" + (f', "crs": {json.dumps(self.crs)}' if self.crs is not None else "") + "}\n")
+        self.f.close()
+
+
+class NdjsonWriter:
+    """Writes one feature per line, every feature carries the CRS member, like geo_output.NdjsonFeatureWriter."""
+
+    def __init__(self, path):
+        self.f = open(path, "w", encoding="utf-8")
+        self.crs = None
+        self.features = 0
+
+    def write(self, feature):
+        if self.crs is not None:
+            feature = {**feature, "crs": self.crs}
+        self.f.write(json.dumps(feature) + "\n")
+        self.features += 1
+
+    def close(self):
+        self.f.close()
+
+
+def iter_members(path, chunk_size=CHUNK_SIZE):
+    """Open a FeatureCollection or newline-delimited GeoJSON file and stream its members, see iter_feature_collection."""
+    with open(path, 'r', encoding='utf-8') as f:
+        if Path(path).suffix.lower() in NDJSON_SUFFIXES:
+            yield from iter_ndjson_features(f)
+        else:
+            yield from iter_feature_collection(f, chunk_size)
+
+
+def merge_field_type(field_type, value):
+    """The fiona field type holding both the values of field_type (None: none yet) and value."""
+    if value is None:
+        return field_type
+    value_type = FIELD_TYPES.get(type(value), "str")
+    if field_type is None or field_type == value_type:
+        return value_type
+    if {field_type, value_type} == {"int", "float"}:
+        return "float"
+    return "str"
+
+
+def scan_inputs(input_paths, chunk_size=CHUNK_SIZE):
     """
-    Merges features from multiple GeoJSON FeatureCollection files into a single file.
+    First pass over the inputs for the fiona outputs.
+
+    Returns:
+        (crs, fields): the "crs" member of the first input that has one (None if none
+        has), and field name -> fiona field type for the properties of all features.
     """
-    all_features = []
-    # The CRS (Coordinate Reference System) from the first file will be used for the output
     crs = None
-    
+    fields = {}
+    for path in input_paths:
+        try:
+            for key, value in iter_members(path, chunk_size):
+                if key == "features":
+                    for name, property_value in (value.get("properties") or {}).items():
+                        fields[name] = merge_field_type(fields.get(name), property_value)
+                elif key == "type" and value != "FeatureCollection":
+                    break
+                elif key == "crs" and crs is None:
+                    crs = value
+        except Exception:
+            # reported by the pass that writes
+            continue
+    fields["image"] = "str"
+    return crs, {name: field_type or "str" for name, field_type in fields.items()}
+
+
+def field_value(value, field_type):
+    """A property value for a fiona field, lists and objects in text fields as JSON, integers in float fields as floats."""
+    if field_type == "str" and value is not None and not isinstance(value, str):
+        return json.dumps(value)
+    if field_type == "float" and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+class FionaWriter:
+    """
+    Writes the features into a FlatGeobuf or GeoPackage with its spatial index, in
+    batches of WRITE_BATCH. The file is created at the first feature with the given
+    fields and CRS (see scan_inputs). Without fields, the properties of the first
+    feature give them (other properties of later features are dropped) and the CRS
+    known by then is used. The FlatGeobuf spatial index has no place for features
+    without geometry, they are skipped.
+    """
+
+    def __init__(self, path, driver, crs=None, fields=None):
+        self.path = path
+        self.driver = driver
+        self.crs = crs
+        self.sink = None
+        self.fields = fields
+        self.records = []
+        self.features = 0
+        self.skipped = 0
+
+    def _open(self, properties):
+        import fiona
+
+        if self.fields is None:
+            self.fields = {key: FIELD_TYPES.get(type(value), "str") for key, value in properties.items()}
+        schema = {"geometry": "Unknown", "properties": self.fields}
+        crs = (self.crs.get("properties") or {}).get("name") if self.crs is not None else None
+        if crs is None:
+            print(f"Warning: no CRS known, '{self.path}' is written without one.")
+        self.sink = fiona.open(self.path, "w", driver=self.driver, schema=schema, crs=crs, SPATIAL_INDEX="YES")
+
+    def write(self, feature):
+        if feature.get("geometry") is None and self.driver == "FlatGeobuf":
+            self.skipped += 1
+            return
+        properties = feature.get("properties") or {}
+        if self.sink is None:
+            self._open(properties)
+        self.records.append({
+            "geometry": feature.get("geometry"),
+            "properties": {key: field_value(properties.get(key), field_type) for key, field_type in self.fields.items()},
+        })
+        if len(self.records) >= WRITE_BATCH:
+            self.flush()
+        self.features += 1
+
+    def flush(self):
+        if self.records:
+            self.sink.writerecords(self.records)
+            self.records = []
+
+    def close(self):
+        if self.sink is not None:
+            self.flush()
+            self.sink.close()
+        if self.skipped:
+            print(f"Warning: {self.skipped} features without geometry were not written to '{self.path}'.")
+
+
+def open_writer(output_path, input_paths=None, chunk_size=CHUNK_SIZE):
+    """
+    The streaming writer for the format of the suffix of output_path. For FlatGeobuf
+    and GeoPackage, input_paths are scanned first for the CRS and fields.
+    """
+    suffix = Path(output_path).suffix.lower()
+    if suffix in FIONA_DRIVERS:
+        crs, fields = scan_inputs(input_paths, chunk_size) if input_paths is not None else (None, None)
+        return FionaWriter(output_path, FIONA_DRIVERS[suffix], crs, fields)
+    if suffix in NDJSON_SUFFIXES:
+        return NdjsonWriter(output_path)
+    return GeoJsonWriter(output_path)
+
+
+def merge_geojson_files(input_paths, output_path, chunk_size=CHUNK_SIZE):
+    """
+    Merges features from multiple GeoJSON files into a single file, streaming.
+
+    Args:
+        input_paths (list): GeoJSON FeatureCollection or newline-delimited GeoJSON files.
+        output_path (str): Output file, the format follows from the suffix (see the module docstring).
+        chunk_size (int): Characters read from a FeatureCollection at a time.
+    """
     print(f"Starting merge of {len(input_paths)} files...")
+    try:
+        writer = open_writer(output_path, input_paths, chunk_size)
+    except Exception as e:
+        print(f"Fatal Error: Could not write output file to '{output_path}'. Reason: {e}")
+        sys.exit(1)
 
-    for i, path in enumerate(input_paths):
+    for path in input_paths:
+        count = 0
+        ndjson = Path(path).suffix.lower() in NDJSON_SUFFIXES
         try:
-            with open(path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-
-            if data.get('type') != 'FeatureCollection':
-                print(f"Warning: File '{path}' is not a 'FeatureCollection' and will be skipped.")
-                continue
-
-            # Set CRS from the first valid file
-            if i == 0:
-                crs = data.get('crs')
-            
-            # Extend the master feature list with features from the current file
-            features = data.get('features', [])
-            for i in range(len(features)):
-                features[i]["properties"]["image"]=Path(path).name
-            all_features.extend(features)
-            print(f"Loaded {len(features)} features from '{path}'.")
+            other_crs = False
+            for key, value in iter_members(path, chunk_size):
+                if key == "features":
+                    if value.get("properties") is None:
+                        value["properties"] = {}
+                    if ndjson:
+                        value["properties"].setdefault("image", Path(path).name)
+                    else:
+                        value["properties"]["image"] = Path(path).name
+                    writer.write(value)
+                    count += 1
+                elif key == "type" and value != "FeatureCollection":
+                    print(f"Warning: File '{path}' is not a 'FeatureCollection' and will be skipped.")
+                    break
+                elif key == "crs":
+                    # the CRS of the first file that has one is used for the output
+                    if writer.crs is None:
+                        writer.crs = value
+                    elif value != writer.crs and not other_crs:
+                        print(f"Warning: File '{path}' has another CRS than the output, its coordinates are not converted.")
+                        other_crs = True
+            print(f"Loaded {count} features from '{path}'.")
 
         except FileNotFoundError:
             print(f"Error: Input file not found at '{path}'. Skipping.")
-        except json.JSONDecodeError:
-            print(f"Error: Invalid JSON format in file at '{path}'. Skipping.")
+        except json.JSONDecodeError as e:
+            print(f"Error: Invalid JSON format in file at '{path}' ({e}), {count} features of it were merged. Skipping the rest.")
         except Exception as e:
             print(f"An unexpected error occurred while processing '{path}': {e}. Skipping.")
 
-    # Construct the final GeoJSON FeatureCollection
-    output_geojson = {
-        "type": "FeatureCollection",
-        # Include CRS if it was found
-        **({'crs': crs} if crs is not None else {}),
-        "features": all_features
-    }
-
     try:
-        # Write the merged data to the output file with indentation for readability
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(output_geojson, f, indent=2)
-        
-        print("\n--------------------------------")
-        print(f"Merge **complete**! Total features: {len(all_features)}")
-        print(f"Output saved to: {output_path}")
-        print("--------------------------------")
-
+        writer.close()
     except Exception as e:
         print(f"Fatal Error: Could not write output file to '{output_path}'. Reason: {e}")
         sys.exit(1)
 
+    print("\n--------------------------------")
+    print(f"Merge **complete**! Total features: {writer.features}")
+    print(f"Output saved to: {output_path}")
+    print("--------------------------------")
+
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(
-        description="A Python script to merge multiple GeoJSON FeatureCollection files into a single output file.",
+        description="A Python script to merge multiple GeoJSON files into a single output file, streaming.",
         formatter_class=argparse.RawTextHelpFormatter
     )
 
@@ -73,17 +386,21 @@ def main():
         '--geojson',
         nargs='+',
         required=True,
-        help="One or more paths to input GeoJSON files, separated by spaces (e.g., file1.geojson file2.geojson)."
+        help="One or more paths to input GeoJSON FeatureCollection or newline-delimited GeoJSON\n"
+             "(.geojsonl/.geojsons/.ndjson) files, separated by spaces (e.g., file1.geojson file2.geojson)."
     )
 
     # Argument for the output file
     parser.add_argument(
         '--outputgeojson',
         required=True,
-        help="Path to the new GeoJSON file to be created (e.g., merged_data.geojson)."
+        help="Path to the new file to be created, the format follows from the suffix:\n"
+             ".geojson (FeatureCollection), .geojsonl/.geojsons/.ndjson (newline-delimited),\n"
+             ".fgb (FlatGeobuf) or .gpkg (GeoPackage), both with a spatial index. For these two the inputs\n"
+             "are read twice, first for the CRS and the fields of the properties of all features."
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     merge_geojson_files(args.geojson, args.outputgeojson)
 
@@ -1,8 +1,17 @@
 import argparse
 import json
 import re
+from collections import defaultdict
+from functools import lru_cache
 from pathlib import Path
 
+import numpy as np
+
+from box_merge import MERGE_METHODS, merge_detections
+from detection_store import DetectionStore, is_store, labelme_shapes
+from detections import Detections, concatenate_detections
+from image_probe import get_image_size
+
 def parse_offset_from_filename(filename: str):
     match = re.search(r"_x_(\d+)_y_(\d+)", filename)
     if not match:
@@ -21,50 +30,354 @@ def update_shape_points(shapes, offset_x, offset_y):
     return updated_shapes
 
 
-def get_image_size(image_path: Path):
+def is_rectangle(shape):
+    return shape.get("shape_type") == "rectangle" and len(shape["points"]) == 2
+
+
+def merge_shapes(shapes, method="greedy_nmm", match_metric="IOU", match_threshold=0.5):
+    """
+    Merge overlapping rectangle shapes with the same label (box_merge).
+
+    Shapes that are not rectangles are kept as they are. A shape "score" is used
+    when present, otherwise all rectangles count as equally confident.
+    """
+    rectangles = [shape for shape in shapes if is_rectangle(shape)]
+    others = [shape for shape in shapes if not is_rectangle(shape)]
+    if len(rectangles) < 2:
+        return shapes
+
+    labels = sorted({shape["label"] for shape in rectangles})
+    label_ids = {label: i for i, label in enumerate(labels)}
+    points = np.array([shape["points"] for shape in rectangles], dtype=np.float32)
+    boxes = np.concatenate([points.min(axis=1), points.max(axis=1)], axis=1)
+    detections = Detections(
+        boxes,
+        np.array([shape.get("score", 1.0) for shape in rectangles], dtype=np.float32),
+        np.array([label_ids[shape["label"]] for shape in rectangles], dtype=np.int64),
+    )
+    keep, merged = merge_detections(detections, method=method, match_metric=match_metric, match_threshold=match_threshold)
+
+    merged_shapes = []
+    for k, box, score in zip(keep, merged.boxes, merged.scores):
+        shape = rectangles[k].copy()
+        x1, y1, x2, y2 = box.tolist()
+        shape["points"] = [[x1, y1], [x2, y2]]
+        if "score" in shape:
+            shape["score"] = float(score)
+        merged_shapes.append(shape)
+    return merged_shapes + others
+
+
+# pixels from a tile edge within which a rectangle counts as truncated by the tile
+EDGE_TOLERANCE = 1.0
+
+
+def clip_rectangle(shape, x_min, y_min, x_max, y_max):
+    """
+    Return a copy of a rectangle shape clipped to the given bounds,
+    or None if nothing of it is left.
+    """
+    (x1, y1), (x2, y2) = shape["points"]
+    x1, x2 = sorted([min(max(x1, x_min), x_max), min(max(x2, x_min), x_max)])
+    y1, y2 = sorted([min(max(y1, y_min), y_max), min(max(y2, y_min), y_max)])
+    if x2 <= x1 or y2 <= y1:
+        return None
+    clipped = shape.copy()
+    clipped["points"] = [[x1, y1], [x2, y2]]
+    return clipped
+
+
+def overlap_strips(offsets, sizes):
+    """
+    Strips along one axis where neighbouring tiles overlap.
+
+    Args:
+        offsets: tile offsets along the axis (one per tile).
+        sizes: tile sizes along the axis (one per tile).
+
+    Returns:
+        (starts, ends): sorted arrays of disjoint [start, end) intervals.
+    """
+    tile_ends = {}
+    for offset, size in zip(offsets, sizes):
+        tile_ends[offset] = max(tile_ends.get(offset, offset), offset + size)
+    grid = sorted(tile_ends)
+
+    strips = []
+    for previous, following in zip(grid, grid[1:]):
+        if tile_ends[previous] > following:
+            if strips and following <= strips[-1][1]:
+                strips[-1][1] = max(strips[-1][1], tile_ends[previous])
+            else:
+                strips.append([following, tile_ends[previous]])
+    strips = np.array(strips, dtype=np.float64).reshape(-1, 2)
+    return strips[:, 0], strips[:, 1]
+
+
+def in_strips(lows, highs, starts, ends):
+    """Which intervals [lows, highs] overlap any of the disjoint sorted strips [starts, ends)."""
+    k = np.searchsorted(ends, lows, side="right")
+    hit = k < len(starts)
+    hit[hit] = starts[k[hit]] < highs[hit]
+    return hit
+
+
+def seam_merge_detections(detections, tile_ids, tiles, image_width, image_height, method="greedy_nmm", match_metric="IOS",
+                          match_threshold=0.5):
+    """
+    Merge the detections of overlapping tiles, comparing only boxes in the overlap strips.
+
+    Boxes are clipped to their tile and the image. Only boxes that reach into a strip
+    where tiles overlap are compared, and only with boxes of other tiles of the same
+    class, so the cost grows with the number of boxes on the seams instead of all
+    boxes. Boxes that are not truncated at an inner tile edge are kept first, so the
+    complete copy of an object absorbs the truncated copies from the neighbouring
+    tiles. With greedy_nmm/nmm duplicates are fused into their union box, which also
+    restores objects that no tile holds completely.
+
+    Args:
+        detections: Detections in large image coordinates.
+        tile_ids: index into tiles for every detection.
+        tiles: (offset_x, offset_y, width, height) of every tile.
+        image_width, image_height: size of the large image.
+        method, match_metric, match_threshold: see merge_shapes.
+            IOS matches truncated boxes with their complete duplicates better than IOU.
+
+    Returns:
+        (index, Detections): the detection every output box comes from, and the output
+        boxes (float64), the boxes off the seams first.
     """
-    Efficiently get image width, height without reading full image.
-    Supports TIFF (via tifffile) and other formats (via Pillow fallback).
+    tile_ids = np.asarray(tile_ids, dtype=np.int64)
+    bounds = np.array(tiles, dtype=np.float64).reshape(-1, 4)[tile_ids]
+    x_min, y_min = np.maximum(bounds[:, 0], 0), np.maximum(bounds[:, 1], 0)
+    x_max = np.minimum(bounds[:, 0] + bounds[:, 2], image_width)
+    y_max = np.minimum(bounds[:, 1] + bounds[:, 3], image_height)
+    boxes = np.asarray(detections.boxes, dtype=np.float64).reshape(-1, 4)
+    x1, x2 = np.clip(boxes[:, 0], x_min, x_max), np.clip(boxes[:, 2], x_min, x_max)
+    y1, y2 = np.clip(boxes[:, 1], y_min, y_max), np.clip(boxes[:, 3], y_min, y_max)
+    x1, x2 = np.minimum(x1, x2), np.maximum(x1, x2)
+    y1, y2 = np.minimum(y1, y2), np.maximum(y1, y2)
+    clipped = np.stack([x1, y1, x2, y2], axis=1)
+    # touching a tile edge inside the image, the object probably continues in the next tile
+    truncated = (
+        ((x_min > 0) & (x1 <= x_min + EDGE_TOLERANCE)) | ((x_max < image_width) & (x2 >= x_max - EDGE_TOLERANCE))
+        | ((y_min > 0) & (y1 <= y_min + EDGE_TOLERANCE)) | ((y_max < image_height) & (y2 >= y_max - EDGE_TOLERANCE))
+    )
+
+    index = np.flatnonzero((x2 > x1) & (y2 > y1))
+    tile_array = np.array(tiles, dtype=np.float64).reshape(-1, 4)
+    x_starts, x_ends = overlap_strips(tile_array[:, 0], tile_array[:, 2])
+    y_starts, y_ends = overlap_strips(tile_array[:, 1], tile_array[:, 3])
+    on_seam = (
+        in_strips(x1[index], x2[index], x_starts, x_ends)
+        | in_strips(y1[index], y2[index], y_starts, y_ends)
+    )
+    rest, seam = index[~on_seam], index[on_seam]
+    scores = np.asarray(detections.scores, dtype=np.float32)
+    class_ids = np.asarray(detections.class_ids, dtype=np.int64)
+
+    seam_boxes, seam_scores = clipped[seam], scores[seam]
+    if len(seam) > 1:
+        priority = ~truncated[seam]
+        # lift the complete boxes above all others in the merge order
+        lift = float(seam_scores.max()) + 1.0
+        keep, merged = merge_detections(
+            Detections(seam_boxes.astype(np.float32), seam_scores + lift * priority, class_ids[seam]),
+            method=method, match_metric=match_metric, match_threshold=match_threshold, groups=tile_ids[seam],
+        )
+        seam = seam[keep]
+        seam_boxes = merged.boxes.astype(np.float64)
+        seam_scores = merged.scores - lift * priority[keep]
+
+    index = np.concatenate([rest, seam])
+    return index, Detections(
+        np.concatenate([clipped[rest], seam_boxes]),
+        np.concatenate([scores[rest], seam_scores]).astype(np.float32),
+        class_ids[index],
+    )
+
+
+def seam_merge_shapes(shapes, tile_ids, tiles, image_width, image_height, method="greedy_nmm", match_metric="IOS", match_threshold=0.5):
     """
-    try:
-        import tifffile
-        with tifffile.TiffFile(image_path) as tif:
-            page = tif.pages[0]
-            return page.imagewidth, page.imagelength
-    except Exception:
-        from PIL import Image
-        with Image.open(image_path) as img:
-            return img.size
+    Merge the shapes of overlapping tiles with seam_merge_detections. Shapes that are
+    not rectangles are kept as they are, a shape "score" is used when present.
 
+    Args:
+        shapes: shapes in large image coordinates.
+        tile_ids: index into tiles for every shape.
+        tiles: (offset_x, offset_y, width, height) of every tile.
+        image_width, image_height: size of the large image.
+        method, match_metric, match_threshold: see seam_merge_detections.
+    """
+    rectangle_index = [k for k, shape in enumerate(shapes) if is_rectangle(shape)]
+    others = [shape for shape in shapes if not is_rectangle(shape)]
+    if not rectangle_index:
+        return others
+    rectangles = [shapes[k] for k in rectangle_index]
+    labels = sorted({shape["label"] for shape in rectangles})
+    label_ids = {label: i for i, label in enumerate(labels)}
+    points = np.array([shape["points"] for shape in rectangles], dtype=np.float64)
+    detections = Detections(
+        np.concatenate([points.min(axis=1), points.max(axis=1)], axis=1),
+        np.array([shape.get("score", 1.0) for shape in rectangles], dtype=np.float32),
+        np.array([label_ids[shape["label"]] for shape in rectangles], dtype=np.int64),
+    )
+    index, merged = seam_merge_detections(
+        detections, [tile_ids[k] for k in rectangle_index], tiles, image_width, image_height, method, match_metric, match_threshold
+    )
 
-def merge_jsons(input_folder, output_json, large_image_path):
+    merged_shapes = []
+    for k, box, score in zip(index.tolist(), merged.boxes.tolist(), merged.scores.tolist()):
+        shape = rectangles[k].copy()
+        x1, y1, x2, y2 = box
+        shape["points"] = [[x1, y1], [x2, y2]]
+        if "score" in shape:
+            shape["score"] = score
+        merged_shapes.append(shape)
+    return merged_shapes + others
+
+
+@lru_cache(maxsize=None)
+def open_tile_store(path):
+    """
+    Open a detection store of tiles once and index its images by large image.
+
+    Returns:
+        (store, tiles): the DetectionStore and a dict large image stem -> image ids
+        of its tiles (named <large image stem>_x_{x}_y_{y}).
+    """
+    store = DetectionStore(path)
+    tiles = defaultdict(list)
+    for image_id, image in enumerate(store.images):
+        large_basename, sep, _ = image["name"].rpartition("_x_")
+        if sep:
+            tiles[large_basename].append(image_id)
+    return store, dict(tiles)
+
+
+def load_store_tiles(input_store, large_basename):
+    """
+    The detections of the tiles of a large image in a detection store, in large image coordinates.
+
+    Returns:
+        (store, first image id, Detections, tile id of every detection, tiles as
+        (offset_x, offset_y, width, height)), the first image id is None without tiles.
+    """
+    store, tiles_by_image = open_tile_store(str(input_store))
+    image_ids = tiles_by_image.get(large_basename, [])
+    parts, tile_ids, tiles = [], [], []
+    for tile_id, image_id in enumerate(image_ids):
+        image = store.images[image_id]
+        offset_x, offset_y = parse_offset_from_filename(image["name"])
+        detections = store.detections(image_id)
+        offset = np.array([offset_x, offset_y, offset_x, offset_y], dtype=np.float32)
+        parts.append(Detections(detections.boxes + offset, detections.scores, detections.class_ids))
+        tile_ids.append(np.full(len(detections.scores), tile_id, dtype=np.int64))
+        tiles.append((offset_x, offset_y, image["width"], image["height"]))
+    detections = concatenate_detections(parts)
+    tile_ids = np.concatenate(tile_ids) if tile_ids else np.zeros(0, dtype=np.int64)
+    return store, image_ids[0] if image_ids else None, detections, tile_ids, tiles
+
+
+def iter_tile_annotations(input_folder, large_basename):
+    """Yield (tile name, LabelMe dict) of the tiles of a large image in a folder of LabelMe JSON."""
+    prefix = large_basename + "_x_"
+    for json_file in Path(input_folder).glob("*.json"):
+        if not json_file.name.startswith(prefix):
+            continue
+
+        with open(json_file, "r", encoding="utf-8") as f:
+            yield json_file.name, json.load(f)
+
+
+def merge_jsons(input_folder, output_json, large_image_path, postprocess=None, match_metric=None, match_threshold=0.5,
+                seam_merge=False):
+    """
+    Merge the LabelMe JSON of the tiles of a large image into one JSON.
+
+    Args:
+        input_folder (str): Folder with the tile JSON, named <large image stem>_x_{x}_y_{y}.json,
+            or a detection_store with the tiles.
+        output_json (str): Path of the merged JSON.
+        large_image_path (str): The large image.
+        postprocess (str): None to keep every shape, or one of box_merge.MERGE_METHODS
+            to merge duplicate rectangles of overlapping tiles.
+        match_metric (str): "IOU" or "IOS" for postprocess (default: IOS with seam_merge, else IOU).
+        match_threshold (float): Minimum overlap of duplicates for postprocess.
+        seam_merge (bool): Use the tile grid: clip rectangles to their tile and only merge
+            rectangles of different tiles in the overlap strips (postprocess defaults to
+            greedy_nmm).
+    """
     all_shapes = []
+    tile_ids = []
+    tiles = []
     large_image_path = Path(large_image_path)
     large_basename = large_image_path.stem
 
     # Efficiently get image size
     large_width, large_height = get_image_size(large_image_path)
 
-    merged_metadata = None
+    # the parts of an object cut by a seam overlap their union by IOS, not by IOU
+    if match_metric is None:
+        match_metric = "IOS" if seam_merge else "IOU"
 
-    for json_file in Path(input_folder).glob("*.json"):
-        if not json_file.name.startswith(large_basename + "_x_"):
-            continue
+    if is_store(input_folder):
+        merged_metadata = merge_store_tiles(input_folder, large_basename, large_width, large_height, postprocess,
+                                            match_metric, match_threshold, seam_merge)
+        write_merged(merged_metadata, output_json, large_image_path, large_width, large_height)
+        return
 
-        with open(json_file, "r", encoding="utf-8") as f:
-            data = json.load(f)
+    merged_metadata = None
 
+    for tile_name, data in iter_tile_annotations(input_folder, large_basename):
         if merged_metadata is None:
             merged_metadata = data.copy()
 
-        offset_x, offset_y = parse_offset_from_filename(json_file.name)
+        offset_x, offset_y = parse_offset_from_filename(tile_name)
         updated_shapes = update_shape_points(data["shapes"], offset_x, offset_y)
         all_shapes.extend(updated_shapes)
+        if seam_merge:
+            tile_ids.extend([len(tiles)] * len(updated_shapes))
+            tiles.append((offset_x, offset_y, data["imageWidth"], data["imageHeight"]))
 
     if merged_metadata is None:
         raise RuntimeError(f"No matching JSON files found for {large_basename}")
 
+    if seam_merge:
+        all_shapes = seam_merge_shapes(
+            all_shapes, tile_ids, tiles, large_width, large_height, postprocess or "greedy_nmm", match_metric, match_threshold
+        )
+    elif postprocess:
+        all_shapes = merge_shapes(all_shapes, postprocess, match_metric, match_threshold)
+
     merged_metadata["shapes"] = all_shapes
+    write_merged(merged_metadata, output_json, large_image_path, large_width, large_height)
+
+
+def merge_store_tiles(input_store, large_basename, large_width, large_height, postprocess, match_metric, match_threshold,
+                      seam_merge):
+    """
+    merge_jsons for tiles in a detection store: the boxes of the tiles are merged as
+    arrays and only the merged result is turned into LabelMe shapes.
+
+    Returns:
+        the LabelMe dict of the large image.
+    """
+    store, first_image_id, detections, tile_ids, tiles = load_store_tiles(input_store, large_basename)
+    if first_image_id is None:
+        raise RuntimeError(f"No tiles of {large_basename} found in the store {input_store}")
+
+    if seam_merge:
+        _, detections = seam_merge_detections(
+            detections, tile_ids, tiles, large_width, large_height, postprocess or "greedy_nmm", match_metric, match_threshold
+        )
+    elif postprocess:
+        _, detections = merge_detections(detections, method=postprocess, match_metric=match_metric, match_threshold=match_threshold)
+    return store.labelme_dict(first_image_id, labelme_shapes(detections, store.names))
+
+
+def write_merged(merged_metadata, output_json, large_image_path, large_width, large_height):
+    """Point the merged LabelMe dict to the large image and write it."""
     merged_metadata["imagePath"] = str(large_image_path)
     merged_metadata["imageData"] = None
     merged_metadata["imageHeight"] = large_height
@@ -74,13 +387,19 @@ def merge_jsons(input_folder, output_json, large_image_path):
         json.dump(merged_metadata, f, indent=2)
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Merge cropped JSONs into one full-image JSON")
-    parser.add_argument("--splitted_json_folder", required=True, help="Folder containing cropped JSON files")
+    parser.add_argument("--splitted_json_folder", required=True, help="Folder containing cropped JSON files, or a detection store of the crops")
     parser.add_argument("--output_json", required=True, help="Path to output merged JSON")
     parser.add_argument("--large_image", required=True, help="Path to the large image file")
-    args = parser.parse_args()
-    merge_jsons(args.splitted_json_folder, args.output_json, args.large_image)
+    parser.add_argument("--postprocess", choices=MERGE_METHODS, default=None, help="Merge duplicate rectangles of overlapping tiles with this method (default: keep all shapes)")
+    parser.add_argument("--match_metric", choices=["IOU", "IOS"], default=None, help="Overlap metric for --postprocess (default: IOS with --seam_merge, else IOU)")
+    parser.add_argument("--match_threshold", type=float, default=0.5, help="Minimum overlap of duplicates for --postprocess (default: 0.5)")
+    parser.add_argument("--seam_merge", action="store_true", help="Only merge duplicates of different tiles in the overlap strips, and clip rectangles to their tile")
+    args = parser.parse_args(argv)
+    merge_jsons(args.splitted_json_folder, args.output_json, args.large_image,
+                postprocess=args.postprocess, match_metric=args.match_metric, match_threshold=args.match_threshold,
+                seam_merge=args.seam_merge)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,186 @@
+"""
+Producer/consumer pipeline for folder inference.
+
+    reader threads --(read queue)--> main thread (model) --(write queue)--> writer thread
+
+A pool of reader threads decodes (and slices) upcoming images, the main thread
+runs the model and a writer thread serializes the results. Both queues are
+bounded so memory stays bounded when one stage is slower than the others.
+Decoding and disk I/O release the GIL, so they hide behind the model forward.
+
+The time every stage spends blocked on its queues and the queue depths are
+recorded and printed at the end of the run, which tells which stage is the
+bottleneck (e.g. readers blocked on a full read queue -> the model is the bottleneck).
+"""
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class StageStats:
+    """Counters for one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.blocked_seconds = 0.0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def add_blocked(self, seconds):
+        with self._lock:
+            self.blocked_seconds += seconds
+
+    def add_item(self):
+        with self._lock:
+            self.items += 1
+
+    def add_error(self):
+        with self._lock:
+            self.errors += 1
+
+
+class MonitoredQueue:
+    """A bounded queue.Queue that samples its depth on every put/get."""
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.depth_samples = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+
+    def _sample(self):
+        depth = self._queue.qsize()
+        with self._lock:
+            self.depth_samples += 1
+            self.depth_sum += depth
+            self.max_depth = max(self.max_depth, depth)
+
+    def put(self, item, stats):
+        start = time.perf_counter()
+        self._queue.put(item)
+        stats.add_blocked(time.perf_counter() - start)
+        self._sample()
+
+    def get(self, stats):
+        start = time.perf_counter()
+        item = self._queue.get()
+        stats.add_blocked(time.perf_counter() - start)
+        self._sample()
+        return item
+
+    @property
+    def mean_depth(self):
+        return self.depth_sum / self.depth_samples if self.depth_samples else 0.0
+
+
+class PipelineStats:
+    def __init__(self, read_queue, write_queue, reader_stats, compute_stats, writer_stats):
+        self.read_queue = read_queue
+        self.write_queue = write_queue
+        self.reader_stats = reader_stats
+        self.compute_stats = compute_stats
+        self.writer_stats = writer_stats
+        self.wall_seconds = 0.0
+
+    def report(self):
+        print("\n---------- pipeline report ----------")
+        print(f"wall time (seconds): {self.wall_seconds:.2f}")
+        for stats, what in (
+            (self.reader_stats, "waiting for free space in the read queue"),
+            (self.compute_stats, "waiting for input / free space in the write queue"),
+            (self.writer_stats, "waiting for results"),
+        ):
+            print(f"{stats.name:>8}: {stats.items} items, {stats.errors} errors, "
+                  f"{stats.blocked_seconds:.2f} s blocked ({what})")
+        for q in (self.read_queue, self.write_queue):
+            print(f"{q.name:>8}: max depth {q.max_depth}/{q.maxsize}, mean depth {q.mean_depth:.1f}")
+        print("-------------------------------------")
+
+
+def run_pipeline(items, read_item, process_stream, write_result, num_readers=2, read_queue_size=32, write_queue_size=8):
+    """
+    Run read -> process -> write over items with bounded queues between the stages.
+
+    Args:
+        items: list of work items (e.g. image paths).
+        read_item: function(item) -> iterable of records, runs in the reader threads.
+            Records of different items may end up interleaved in the read queue.
+        process_stream: function(iterator of records) -> iterator of results,
+            runs in the calling (main) thread, e.g. the batched model forward.
+        write_result: function(result), runs in the writer thread.
+        num_readers (int): number of reader threads.
+        read_queue_size (int): max records waiting for the model.
+        write_queue_size (int): max results waiting for the writer.
+
+    Returns:
+        PipelineStats
+    """
+    read_queue = MonitoredQueue("read q", read_queue_size)
+    write_queue = MonitoredQueue("write q", write_queue_size)
+    reader_stats = StageStats("readers")
+    compute_stats = StageStats("model")
+    writer_stats = StageStats("writer")
+    stats = PipelineStats(read_queue, write_queue, reader_stats, compute_stats, writer_stats)
+
+    work = iter(items)
+    work_lock = threading.Lock()
+
+    def reader():
+        while True:
+            with work_lock:
+                item = next(work, _DONE)
+            if item is _DONE:
+                read_queue.put(_DONE, reader_stats)
+                return
+            try:
+                for record in read_item(item):
+                    read_queue.put(record, reader_stats)
+                reader_stats.add_item()
+            except Exception as e:
+                reader_stats.add_error()
+                print(f"Error reading {item}: {e}")
+
+    def writer():
+        while True:
+            result = write_queue.get(writer_stats)
+            if result is _DONE:
+                return
+            try:
+                write_result(result)
+                writer_stats.add_item()
+            except Exception as e:
+                writer_stats.add_error()
+                print(f"Error writing result: {e}")
+
+    def records():
+        finished_readers = 0
+        while finished_readers < num_readers:
+            record = read_queue.get(compute_stats)
+            if record is _DONE:
+                finished_readers += 1
+                continue
+            yield record
+
+    start = time.perf_counter()
+    readers = [threading.Thread(target=reader, name=f"reader-{i}", daemon=True) for i in range(num_readers)]
+    writer_thread = threading.Thread(target=writer, name="writer", daemon=True)
+    for thread in readers:
+        thread.start()
+    writer_thread.start()
+
+    try:
+        for result in process_stream(records()):
+            compute_stats.add_item()
+            write_queue.put(result, compute_stats)
+    finally:
+        write_queue.put(_DONE, compute_stats)
+        writer_thread.join()
+
+    stats.wall_seconds = time.perf_counter() - start
+    return stats
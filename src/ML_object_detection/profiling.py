@@ -0,0 +1,262 @@
+"""
+Per-image and per-stage timings of the inference scripts (--profile).
+
+The time of every image is split into the stages
+
+    read         reading the image file (windows, or the whole image)
+    slice        the slice geometry and the slice filters (skip_empty, the coarse pass of --two_stage)
+    preprocess   letterboxing and normalizing the slices for the model
+    forward      the model forward pass
+    postprocess  decoding and NMS of the model output, per slice
+    merge        merging the detections of overlapping slices
+    serialize    building the LabelMe JSON
+    write        writing the JSON and the other outputs to disk
+
+together with the number of slices run and of detections kept. Slices of several
+images share a forward pass in the batched modes, the time of a batch is split
+over its images by their share of the slices. In pipeline mode the stages of
+different images overlap in time, the stage seconds then add up to more than the
+wall time.
+
+Written to the --profile folder:
+
+    timings.csv    one row per image
+    timings.json   the rows, the totals per stage and the settings of the run
+    trace.json     with --profile_trace, every timed span per thread as Chrome trace
+                   events (open in https://ui.perfetto.dev or speedscope)
+    cprofile.prof  with --cprofile, cProfile statistics of the main thread
+                   (python -m pstats cprofile.prof, or snakeviz)
+
+For a sampling profile of all threads with native frames, run the script under
+py-spy instead: py-spy record --format speedscope -o profile.json -- python infer_with_sahi.py ...
+
+Compare two runs, e.g. before and after changing the weights or the slice size:
+    python profiling.py --baseline old/timings.json --candidate new/timings.json
+"""
+import argparse
+import csv
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+STAGES = ("read", "slice", "preprocess", "forward", "postprocess", "merge", "serialize", "write")
+COUNTS = ("slices", "detections")
+
+
+class NullProfiler:
+    """Stands in for a Profiler when profiling is off, every call does nothing."""
+
+    def span(self, stage, image=None):
+        return nullcontext()
+
+    def for_images(self, images):
+        return nullcontext()
+
+    def add(self, stage, seconds, image=None):
+        pass
+
+    def count(self, key, n=1, image=None):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class Profiler:
+    """
+    Collects the stage seconds and counts of every image, from any thread.
+
+    A span is charged to the image it is given, or else to the images set with
+    for_images in the same thread (one entry per slice of a batch); spans with
+    neither are not recorded, e.g. the coarse pass of the two-stage mode inside
+    the slice stage.
+    """
+
+    def __init__(self, trace=False, cprofile=False):
+        self.records = {}
+        self.events = [] if trace else None
+        self._thread_names = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = time.perf_counter()
+        self.cprofile = None
+        if cprofile:
+            import cProfile
+
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def _record(self, image):
+        name = Path(image).name
+        record = self.records.get(name)
+        if record is None:
+            record = self.records[name] = {"image": name, **dict.fromkeys(COUNTS, 0), **dict.fromkeys(STAGES, 0.0),
+                                           "first": None, "last": None}
+        return record
+
+    def _images(self, image):
+        if image is not None:
+            return [image]
+        return getattr(self._local, "images", None)
+
+    @contextmanager
+    def for_images(self, images):
+        """Charge the spans of this thread without an image to images, split evenly."""
+        self._local.images = list(images)
+        try:
+            yield
+        finally:
+            self._local.images = None
+
+    @contextmanager
+    def span(self, stage, image=None):
+        """Time the block as stage of image (or of the images of for_images)."""
+        images = self._images(image)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if images:
+                self._charge(stage, images, start, time.perf_counter())
+
+    def add(self, stage, seconds, image=None):
+        """Charge seconds measured elsewhere (e.g. ultralytics' speed) to stage, not traced."""
+        images = self._images(image)
+        if images:
+            end = time.perf_counter()
+            self._charge(stage, images, end - seconds, end, trace=False)
+
+    def count(self, key, n=1, image=None):
+        """Add n to the count key ("slices", "detections") of image (or of the images of for_images)."""
+        images = self._images(image)
+        if not images:
+            return
+        with self._lock:
+            for name in images:
+                self._record(name)[key] += n
+
+    def _charge(self, stage, images, start, end, trace=True):
+        share = (end - start) / len(images)
+        with self._lock:
+            for name in images:
+                record = self._record(name)
+                record[stage] += share
+                record["first"] = start if record["first"] is None else min(record["first"], start)
+                record["last"] = end if record["last"] is None else max(record["last"], end)
+            if trace and self.events is not None:
+                thread = threading.current_thread()
+                self._thread_names.setdefault(thread.ident, thread.name)
+                self.events.append({
+                    "name": stage, "ph": "X", "pid": os.getpid(), "tid": thread.ident,
+                    "ts": round((start - self._start) * 1e6, 1), "dur": round((end - start) * 1e6, 1),
+                    "args": {"images": sorted({Path(name).name for name in images})},
+                })
+
+    def rows(self):
+        """One dict per image, in the order the images were started."""
+        rows = []
+        for record in sorted(self.records.values(), key=lambda r: r["first"] if r["first"] is not None else 0.0):
+            row = {key: record[key] for key in ("image",) + COUNTS}
+            row.update({stage: round(record[stage], 6) for stage in STAGES})
+            row["total_seconds"] = round(sum(record[stage] for stage in STAGES), 6)
+            wall = record["last"] - record["first"] if record["first"] is not None else 0.0
+            row["wall_seconds"] = round(wall, 6)
+            rows.append(row)
+        return rows
+
+    def write(self, folder, settings=None):
+        """
+        Stop the cProfile and write the profile files into folder, then print the summary.
+
+        Args:
+            folder (str): Output folder, created if needed.
+            settings (dict): Settings of the run, stored in timings.json to compare runs.
+        """
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        rows = self.rows()
+        summary = summarize(rows, time.perf_counter() - self._start)
+
+        with open(folder / "timings.csv", "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=["image", *COUNTS, *STAGES, "total_seconds", "wall_seconds"])
+            writer.writeheader()
+            writer.writerows(rows)
+        with open(folder / "timings.json", "w", encoding="utf-8") as f:
+            json.dump({"settings": settings or {}, "summary": summary, "images": rows}, f, indent=2)
+        if self.events is not None:
+            metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": ident, "args": {"name": name}}
+                        for ident, name in self._thread_names.items()]
+            with open(folder / "trace.json", "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}, f)
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(folder / "cprofile.prof")
+
+        report(summary)
+        print(f"Profile written to {folder}")
+
+
+def summarize(rows, wall_seconds):
+    """Totals over the image rows of a run."""
+    num_images = len(rows)
+    stage_seconds = {stage: round(sum(row[stage] for row in rows), 6) for stage in STAGES}
+    return {
+        "images": num_images,
+        "wall_seconds": round(wall_seconds, 6),
+        **{key: sum(row[key] for row in rows) for key in COUNTS},
+        "stage_seconds": stage_seconds,
+        "stage_seconds_per_image": {stage: round(seconds / num_images, 6) if num_images else 0.0
+                                    for stage, seconds in stage_seconds.items()},
+    }
+
+
+def report(summary):
+    """Print the seconds per stage of a summary."""
+    total = sum(summary["stage_seconds"].values())
+    print("\n---------- profile ----------")
+    print(f"{summary['images']} images, {summary['slices']} slices, {summary['detections']} detections, "
+          f"wall time {summary['wall_seconds']:.2f} s")
+    print(f"{'stage':>12} {'seconds':>10} {'ms/image':>10} {'share':>7}")
+    for stage in STAGES:
+        seconds = summary["stage_seconds"][stage]
+        print(f"{stage:>12} {seconds:>10.2f} {summary['stage_seconds_per_image'][stage] * 1000:>10.1f} "
+              f"{seconds / total if total else 0.0:>7.1%}")
+    print("-----------------------------")
+
+
+def compare(baseline, candidate):
+    """Print the per image stage times and counts of two timings.json summaries side by side."""
+    print(f"{'':>14} {'baseline':>10} {'candidate':>10} {'ratio':>7}")
+    rows = [(f"{stage} ms", baseline["stage_seconds_per_image"][stage] * 1000, candidate["stage_seconds_per_image"][stage] * 1000)
+            for stage in STAGES]
+    rows.append(("total ms", sum(baseline["stage_seconds_per_image"].values()) * 1000,
+                 sum(candidate["stage_seconds_per_image"].values()) * 1000))
+    for key in COUNTS:
+        rows.append((key, baseline[key] / max(baseline["images"], 1), candidate[key] / max(candidate["images"], 1)))
+    for name, old, new in rows:
+        print(f"{name:>14} {old:>10.1f} {new:>10.1f} {new / old if old else float('nan'):>7.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the per image stage timings of two --profile runs")
+    parser.add_argument("--baseline", required=True, help="timings.json of the reference run")
+    parser.add_argument("--candidate", required=True, help="timings.json of the run to compare")
+    args = parser.parse_args(argv)
+
+    profiles = []
+    for path in (args.baseline, args.candidate):
+        with open(path, "r", encoding="utf-8") as f:
+            profiles.append(json.load(f))
+    for key in sorted(set(profiles[0]["settings"]) | set(profiles[1]["settings"])):
+        old, new = profiles[0]["settings"].get(key), profiles[1]["settings"].get(key)
+        if old != new:
+            print(f"setting {key}: {old} -> {new}")
+    compare(profiles[0]["summary"], profiles[1]["summary"])
+
+
+if __name__ == "__main__":
+    main()
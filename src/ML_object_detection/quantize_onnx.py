@@ -0,0 +1,211 @@
+"""
+Post-training INT8 quantization of a YOLOv8 ONNX export (train.py --export_int8).
+
+The model is quantized statically with ONNX Runtime (QDQ format, INT8 weights per
+channel), calibrated on a random sample of the training images of the dataset's
+data.yaml, preprocessed exactly like the onnxruntime inference backend does.
+The whole network runs in INT8 except the box decoding at the end of the Detect
+head (DFL, anchor arithmetic, Sigmoid, output Concat): quantizing pixel
+coordinates costs whole pixels, and the decoding is a tiny part of the compute.
+
+The quantized model keeps the ultralytics metadata (class names, input size), so
+both inference backends load it like the FP32 export:
+    python infer_with_sahi.py --weights best_int8.onnx --backend onnxruntime ...
+
+evaluate_quantization validates both models on the validation split with
+ultralytics (mAP50, mAP50-95) and times them with the onnxruntime backend.
+"""
+import argparse
+import os
+import random
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import onnx
+import yaml
+from onnxruntime.quantization import CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, quantize_static
+
+from detector_backends import OnnxRuntimeBackend
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp")
+
+
+def list_split_images(data_yaml, split="train"):
+    """
+    Image paths of a split of an ultralytics data.yaml: a folder, a .txt file with
+    one image per line, or a list of those, relative to the yaml's "path".
+    """
+    data_yaml = Path(data_yaml)
+    with open(data_yaml, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f)
+    root = Path(data.get("path") or data_yaml.parent)
+    if not root.is_absolute():
+        root = data_yaml.parent / root
+
+    entries = data[split] if isinstance(data[split], list) else [data[split]]
+    images = []
+    for entry in entries:
+        entry = Path(entry) if Path(entry).is_absolute() else root / entry
+        if entry.is_dir():
+            images.extend(sorted(p for p in entry.rglob("*") if p.suffix.lower() in IMAGE_SUFFIXES))
+        else:
+            with open(entry, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        images.append(Path(line) if Path(line).is_absolute() else root / line)
+    return images
+
+
+class TileCalibrationReader(CalibrationDataReader):
+    """Feeds calibration images to quantize_static, one letterboxed image per call."""
+
+    def __init__(self, backend, image_paths):
+        self.backend = backend
+        self.image_paths = iter(image_paths)
+
+    def get_next(self):
+        for image_path in self.image_paths:
+            image = cv2.imread(str(image_path))
+            if image is None:
+                print(f"Skipping unreadable calibration image {image_path}")
+                continue
+            batch, _ = self.backend.preprocess([image[:, :, ::-1]])
+            return {self.backend.input_name: batch}
+        return None
+
+
+def float_decode_nodes(model):
+    """
+    Names of the Detect head nodes that decode the boxes, which stay in float.
+
+    The head is found from the node producing the model output. Its conv branches
+    (cv2: boxes, cv3: classes) and the Reshape/Concat gathering them are quantized,
+    everything from the DFL on, and everything consuming its float outputs, is not.
+    """
+    graph = model.graph
+    output = graph.output[0].name
+    producer = next(node for node in graph.node if output in node.output)
+    head = producer.name.rsplit("/", 1)[0] + "/"
+
+    float_tensors, nodes = set(), []
+    for node in graph.node:  # ONNX nodes are topologically sorted
+        if not node.name.startswith(head) or node.name.startswith((head + "cv2", head + "cv3")):
+            continue
+        gathers = node.op_type in ("Reshape", "Concat", "Constant") and "/dfl/" not in node.name
+        if not gathers or any(name in float_tensors for name in node.input):
+            nodes.append(node.name)
+            float_tensors.update(node.output)
+    return nodes
+
+
+def quantize_model(onnx_path, data_yaml, output_path=None, num_calibration=100, seed=0):
+    """
+    Quantize an ONNX export to INT8, calibrated on training images of data_yaml.
+
+    Args:
+        onnx_path (str): FP32 ONNX export of the model.
+        data_yaml (str): ultralytics data.yaml of the dataset the model was trained on.
+        output_path (str): Quantized model (default: <onnx_path stem>_int8.onnx).
+        num_calibration (int): Number of training images to calibrate on.
+        seed (int): Seed of the random image sample.
+
+    Returns:
+        Path of the quantized model.
+    """
+    onnx_path = Path(onnx_path)
+    output_path = Path(output_path) if output_path else onnx_path.with_name(onnx_path.stem + "_int8.onnx")
+
+    images = list_split_images(data_yaml, "train")
+    if not images:
+        raise ValueError(f"No training images found through {data_yaml}")
+    sample = random.Random(seed).sample(images, min(num_calibration, len(images)))
+    print(f"Calibrating on {len(sample)} of {len(images)} training images")
+
+    model = onnx.load(str(onnx_path))
+    backend = OnnxRuntimeBackend(onnx_path)
+    quantize_static(
+        str(onnx_path),
+        str(output_path),
+        TileCalibrationReader(backend, sample),
+        quant_format=QuantFormat.QDQ,
+        nodes_to_exclude=float_decode_nodes(model),
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        calibrate_method=CalibrationMethod.MinMax,
+    )
+
+    # keep the ultralytics metadata (names, imgsz, stride, ...) the backends read
+    quantized = onnx.load(str(output_path))
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(model.metadata_props)
+    onnx.save(quantized, str(output_path))
+    print(f"Quantized model saved to: {output_path} "
+          f"({os.path.getsize(onnx_path) / 1e6:.1f} MB -> {os.path.getsize(output_path) / 1e6:.1f} MB)")
+    return output_path
+
+
+def time_model(onnx_path, image_paths, repeats=3):
+    """Median seconds per image of the onnxruntime backend over image_paths."""
+    backend = OnnxRuntimeBackend(onnx_path)
+    images = [cv2.imread(str(p))[:, :, ::-1] for p in image_paths]
+    backend.predict_batch(images[:1])  # warm up
+    seconds = []
+    for _ in range(repeats):
+        for image in images:
+            start = time.perf_counter()
+            backend.predict_batch([image])
+            seconds.append(time.perf_counter() - start)
+    return float(np.median(seconds))
+
+
+def evaluate_quantization(fp32_path, int8_path, data_yaml, num_timing=20):
+    """
+    Report the accuracy and speed of the quantized model against the FP32 model:
+    mAP50 and mAP50-95 on the validation split (ultralytics val) and the median
+    time per image with the onnxruntime backend.
+
+    Returns:
+        dict with the metrics of both models.
+    """
+    from ultralytics import YOLO
+
+    report = {}
+    for name, path in (("fp32", fp32_path), ("int8", int8_path)):
+        metrics = YOLO(str(path), task="detect").val(data=str(data_yaml), split="val", batch=1, device="cpu", plots=False, verbose=False)
+        report[name] = {"map50": float(metrics.box.map50), "map50_95": float(metrics.box.map)}
+
+    timing_images = list_split_images(data_yaml, "val")[:num_timing]
+    for name, path in (("fp32", fp32_path), ("int8", int8_path)):
+        report[name]["seconds_per_image"] = time_model(path, timing_images)
+
+    fp32, int8 = report["fp32"], report["int8"]
+    print("\n---------- INT8 quantization report ----------")
+    print(f"{'':>6} {'mAP50':>8} {'mAP50-95':>9} {'ms/image':>9}")
+    for name in ("fp32", "int8"):
+        print(f"{name:>6} {report[name]['map50']:>8.4f} {report[name]['map50_95']:>9.4f} {report[name]['seconds_per_image'] * 1000:>9.1f}")
+    print(f"mAP50 delta: {int8['map50'] - fp32['map50']:+.4f}, mAP50-95 delta: {int8['map50_95'] - fp32['map50_95']:+.4f}")
+    print(f"speedup: {fp32['seconds_per_image'] / int8['seconds_per_image']:.2f}x")
+    print("----------------------------------------------")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize a YOLOv8 ONNX export to INT8 and compare it with the FP32 model.")
+    parser.add_argument("--onnx", required=True, help="Path to the FP32 ONNX export")
+    parser.add_argument("--data", required=True, help="Path to the YOLO-format data.yaml (train images calibrate, val images evaluate)")
+    parser.add_argument("--output", default=None, help="Path of the quantized model (default: <onnx>_int8.onnx)")
+    parser.add_argument("--calibration_images", type=int, default=100, help="Number of training images to calibrate on (default: 100)")
+    parser.add_argument("--no_eval", action="store_true", help="Skip the mAP and speed comparison")
+    args = parser.parse_args()
+
+    int8_path = quantize_model(args.onnx, args.data, args.output, args.calibration_images)
+    if not args.no_eval:
+        evaluate_quantization(args.onnx, int8_path, args.data)
+
+
+if __name__ == "__main__":
+    main()
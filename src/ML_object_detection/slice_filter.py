@@ -0,0 +1,129 @@
+"""
+Skip slices that have nothing to detect before they reach the model.
+
+Oblique images have large nodata borders and plain areas like sky or water. A cheap
+pre-pass reads the image reduced OVERVIEW_FACTOR times (from the TIFF overviews when
+it has them) and marks a slice as skippable when its overview pixels are
+
+    nodata        -> all nodata (all bands equal to the nodata value)
+    constant      -> otherwise within constant_range values in every band
+    low_variance  -> gray value standard deviation below min_std
+    low_entropy   -> gray value entropy (bits) below min_entropy
+
+ignoring the nodata pixels. The variance and entropy tests are off by default.
+The overview only samples every OVERVIEW_FACTOR-th pixel, so a small object in an
+otherwise plain slice can be missed: keep the thresholds low.
+"""
+import threading
+from collections import Counter
+
+import numpy as np
+
+OVERVIEW_FACTOR = 16
+CONSTANT_RANGE = 2
+SKIP_REASONS = ("nodata", "constant", "low_variance", "low_entropy")
+
+
+def gray_entropy(gray):
+    """Shannon entropy in bits of the histogram of uint8 gray values."""
+    counts = np.bincount(gray, minlength=256)
+    p = counts[counts > 0] / gray.size
+    return float(-(p * np.log2(p)).sum())
+
+
+class SliceFilter:
+    """
+    Drops the skippable slices of every image it is given and counts them.
+    Thread safe, the reader threads of the pipeline share one filter.
+
+    Args:
+        min_std (float): Skip slices with a lower gray value standard deviation (0: off).
+        min_entropy (float): Skip slices with a lower gray value entropy in bits (0: off).
+        nodata (int): Nodata value of the images (default: the one in the file, if any).
+        constant_range (int): Skip slices whose bands vary by at most this much.
+        overview_factor (int): Reduction of the overview the slices are judged on.
+    """
+
+    def __init__(self, min_std=0.0, min_entropy=0.0, nodata=None, constant_range=CONSTANT_RANGE, overview_factor=OVERVIEW_FACTOR):
+        self.min_std = min_std
+        self.min_entropy = min_entropy
+        self.nodata = nodata
+        self.constant_range = constant_range
+        self.overview_factor = overview_factor
+        self.slices = 0
+        self.skipped = Counter()
+        self._lock = threading.Lock()
+
+    def skip_reason(self, pixels, nodata=None):
+        """One of SKIP_REASONS for the (height, width, 3) uint8 overview pixels of a slice, or None."""
+        pixels = pixels.reshape(-1, 3)
+        if nodata is not None:
+            pixels = pixels[(pixels != nodata).any(axis=1)]
+            if not len(pixels):
+                return "nodata"
+        if (pixels.max(axis=0).astype(np.int16) - pixels.min(axis=0)).max() <= self.constant_range:
+            return "constant"
+        if self.min_std or self.min_entropy:
+            gray = (pixels @ np.array([299, 587, 114]) // 1000).astype(np.uint8)
+            if self.min_std and gray.std() < self.min_std:
+                return "low_variance"
+            if self.min_entropy and gray_entropy(gray) < self.min_entropy:
+                return "low_entropy"
+        return None
+
+    def filter_slices(self, reader, slice_bboxes):
+        """
+        Args:
+            reader: An open tile_reader window reader of the image.
+            slice_bboxes (list): [x_min, y_min, x_max, y_max] slice windows of the image.
+
+        Returns:
+            the slice windows that go to the model.
+        """
+        overview = reader.read_overview(self.overview_factor)
+        nodata = self.nodata if self.nodata is not None else reader.nodata
+        if nodata is not None and not 0 <= nodata <= 255:
+            nodata = None  # not representable in the uint8 pixels
+        overview_height, overview_width = overview.shape[:2]
+
+        kept, skipped = [], Counter()
+        for bbox in slice_bboxes:
+            x_min, y_min, x_max, y_max = bbox
+            row_start = y_min * overview_height // reader.height
+            row_end = max(row_start + 1, -(-y_max * overview_height // reader.height))
+            col_start = x_min * overview_width // reader.width
+            col_end = max(col_start + 1, -(-x_max * overview_width // reader.width))
+            reason = self.skip_reason(overview[row_start:row_end, col_start:col_end], nodata)
+            if reason is None:
+                kept.append(bbox)
+            else:
+                skipped[reason] += 1
+
+        with self._lock:
+            self.slices += len(slice_bboxes)
+            self.skipped.update(skipped)
+        return kept
+
+    def report(self):
+        skipped = sum(self.skipped.values())
+        share = 100 * skipped / self.slices if self.slices else 0.0
+        reasons = ", ".join(f"{reason}: {self.skipped[reason]}" for reason in SKIP_REASONS if self.skipped[reason])
+        print(f"Skipped {skipped} of {self.slices} slices ({share:.1f}%) before inference" + (f" ({reasons})" if reasons else ""))
+
+
+class SliceFilterChain:
+    """Applies slice filters one after the other, each only sees the slices the previous ones kept."""
+
+    def __init__(self, filters):
+        self.filters = filters
+
+    def filter_slices(self, reader, slice_bboxes):
+        for slice_filter in self.filters:
+            if not slice_bboxes:
+                break
+            slice_bboxes = slice_filter.filter_slices(reader, slice_bboxes)
+        return slice_bboxes
+
+    def report(self):
+        for slice_filter in self.filters:
+            slice_filter.report()
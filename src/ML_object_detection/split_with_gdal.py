@@ -1,54 +1,212 @@
 import os
 import argparse
-from osgeo import gdal
+from concurrent.futures import ProcessPoolExecutor
 
-def split_geotiff(image_path, output_dir, tile_width, tile_height, overlap):
-    os.makedirs(output_dir, exist_ok=True)
-    ds = gdal.Open(image_path)
-    if ds is None:
-        raise FileNotFoundError(f"Could not open {image_path}")
+# tif: copy the pixels of every tile into a GeoTIFF
+# vrt: write a small VRT per tile that refers to a window of the source image
+# index: write a single tile index (GeoPackage) with the window and footprint of every tile
+MODES = ("tif", "vrt", "index")
+TILE_INDEX_NAME = "tile_index.gpkg"
+
+# datasets opened by this (worker) process, so every tile does not reopen its source
+_datasets = {}
 
-    img_width = ds.RasterXSize
-    img_height = ds.RasterYSize
 
+def tile_windows(img_width, img_height, tile_width, tile_height, overlap):
+    """Yield the (x, y, w, h) source window of every tile, row by row."""
     x_step = tile_width - overlap
     y_step = tile_height - overlap
 
-    tile_count = 0
     for y in range(0, img_height, y_step):
         for x in range(0, img_width, x_step):
             w = min(tile_width, img_width - x)
             h = min(tile_height, img_height - y)
+            yield x, y, w, h
+
+
+def tile_name(image_path, x, y):
+    return f"{os.path.splitext(os.path.basename(image_path))[0]}_x_{x}_y_{y}"
+
+
+def init_worker(cache_mb):
+    """Set the GDAL block cache of a (worker) process, in MB (None: GDAL default)."""
+    if cache_mb:
+        from osgeo import gdal
+        gdal.SetCacheMax(cache_mb * 1024 * 1024)
+
+
+def open_source(image_path):
+    ds = _datasets.get(image_path)
+    if ds is None:
+        from osgeo import gdal
+        ds = gdal.Open(image_path)
+        if ds is None:
+            raise FileNotFoundError(f"Could not open {image_path}")
+        _datasets[image_path] = ds
+    return ds
+
+
+def write_tile(job):
+    """
+    Write one tile, runs in the worker processes.
+
+    Args:
+        job: (image_path, output_path, (x, y, w, h), mode, compress)
+    """
+    from osgeo import gdal
+
+    image_path, output_path, window, mode, compress = job
+    ds = open_source(image_path)
+    if mode == "vrt":
+        # the source was opened by its absolute path, so the VRT does not depend on the working directory
+        gdal.Translate(output_path, ds, format="VRT", srcWin=list(window))
+    else:
+        creation_options = [] if compress == "NONE" else [f"COMPRESS={compress}"]
+        gdal.Translate(output_path, ds, srcWin=list(window), creationOptions=creation_options)
+    return image_path
+
+
+def tile_jobs(image_path, output_dir, tile_width, tile_height, overlap, mode, compress):
+    """List the write_tile jobs of one image."""
+    ds = open_source(image_path)
+    extension = ".vrt" if mode == "vrt" else ".tif"
+    return [
+        (image_path, os.path.join(output_dir, tile_name(image_path, x, y) + extension), (x, y, w, h), mode, compress)
+        for x, y, w, h in tile_windows(ds.RasterXSize, ds.RasterYSize, tile_width, tile_height, overlap)
+    ]
+
+
+def write_tile_index(image_paths, output_dir, tile_width, tile_height, overlap):
+    """
+    Write a single GeoPackage with one feature per tile instead of tile files.
+
+    Every feature has the tile name, the source image (absolute path, "location"
+    like gdaltindex), the pixel window (x_off, y_off, width, height) and the
+    footprint of the tile as geometry, in the coordinate system of the sources
+    (which are expected to share one).
+    """
+    from osgeo import gdal, ogr
 
-            output_path = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(image_path))[0]}_x_{x}_y_{y}.tif")
-            gdal.Translate(
-                output_path,
-                ds,
-                srcWin=[x, y, w, h],
-                creationOptions=["COMPRESS=LZW"]
-            )
+    index_path = os.path.join(output_dir, TILE_INDEX_NAME)
+    driver = ogr.GetDriverByName("GPKG")
+    if os.path.exists(index_path):
+        driver.DeleteDataSource(index_path)
+    index = driver.CreateDataSource(index_path)
+
+    layer = None
+    for image_path in image_paths:
+        ds = open_source(image_path)
+        if layer is None:
+            layer = index.CreateLayer("tiles", ds.GetSpatialRef(), ogr.wkbPolygon)
+            layer.CreateField(ogr.FieldDefn("name", ogr.OFTString))
+            layer.CreateField(ogr.FieldDefn("location", ogr.OFTString))
+            for field in ("x_off", "y_off", "width", "height"):
+                layer.CreateField(ogr.FieldDefn(field, ogr.OFTInteger))
+            layer.StartTransaction()
+
+        geo_transform = ds.GetGeoTransform()
+        tile_count = 0
+        for x, y, w, h in tile_windows(ds.RasterXSize, ds.RasterYSize, tile_width, tile_height, overlap):
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            for px, py in ((x, y), (x + w, y), (x + w, y + h), (x, y + h), (x, y)):
+                ring.AddPoint_2D(*gdal.ApplyGeoTransform(geo_transform, px, py))
+            footprint = ogr.Geometry(ogr.wkbPolygon)
+            footprint.AddGeometry(ring)
+
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetField("name", tile_name(image_path, x, y))
+            feature.SetField("location", image_path)
+            feature.SetField("x_off", x)
+            feature.SetField("y_off", y)
+            feature.SetField("width", w)
+            feature.SetField("height", h)
+            feature.SetGeometry(footprint)
+            layer.CreateFeature(feature)
             tile_count += 1
+        print(f"Indexed {tile_count} tiles from '{image_path}' in '{index_path}'.")
+
+    if layer is not None:
+        layer.CommitTransaction()
+    index = None  # close and flush the GeoPackage
+
+
+def split_geotiffs(image_paths, output_dir, tile_width, tile_height, overlap, mode="tif", compress="LZW", workers=None, cache_mb=None):
+    """
+    Split GeoTIFFs into tiles with a pool of worker processes.
+
+    The tiles of all images are written by the same pool, so a folder of small
+    images keeps all workers as busy as a single huge image.
+
+    Args:
+        image_paths (list): GeoTIFFs to split.
+        output_dir (str): Directory for the tiles (or the tile index).
+        tile_width, tile_height (int): Tile size in pixels.
+        overlap (int): Overlap of neighbouring tiles in pixels.
+        mode (str): One of MODES.
+        compress (str): GeoTIFF compression of the tiles in "tif" mode (NONE for none).
+        workers (int): Number of worker processes (default: CPU count).
+        cache_mb (int): GDAL block cache per process in MB (default: GDAL's).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    image_paths = [os.path.abspath(path) for path in image_paths]
+    init_worker(cache_mb)
+
+    if mode == "index":
+        write_tile_index(image_paths, output_dir, tile_width, tile_height, overlap)
+        return
 
-    print(f"Created {tile_count} tiles from '{image_path}' in '{output_dir}'.")
+    jobs = []
+    for image_path in image_paths:
+        jobs.extend(tile_jobs(image_path, output_dir, tile_width, tile_height, overlap, mode, compress))
+    _datasets.clear()  # workers open their own handles
 
-def process_input(input_path, output_dir, tile_width, tile_height, overlap):
+    workers = workers or os.cpu_count() or 1
+    tile_counts = {}
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(cache_mb,)) as pool:
+            for image_path in pool.map(write_tile, jobs, chunksize=max(1, min(64, len(jobs) // (workers * 4)))):
+                tile_counts[image_path] = tile_counts.get(image_path, 0) + 1
+    else:
+        for image_path in map(write_tile, jobs):
+            tile_counts[image_path] = tile_counts.get(image_path, 0) + 1
+    _datasets.clear()
+
+    for image_path, tile_count in tile_counts.items():
+        print(f"Created {tile_count} tiles from '{image_path}' in '{output_dir}'.")
+
+
+def split_geotiff(image_path, output_dir, tile_width, tile_height, overlap, mode="tif", compress="LZW", workers=None, cache_mb=None):
+    split_geotiffs([image_path], output_dir, tile_width, tile_height, overlap, mode, compress, workers, cache_mb)
+
+
+def process_input(input_path, output_dir, tile_width, tile_height, overlap, mode="tif", compress="LZW", workers=None, cache_mb=None):
     if os.path.isdir(input_path):
-        for fname in os.listdir(input_path):
+        image_paths = []
+        for fname in sorted(os.listdir(input_path)):
             full_path = os.path.join(input_path, fname)
             if fname.lower().endswith(".tif") and os.path.isfile(full_path):
-                split_geotiff(full_path, output_dir, tile_width, tile_height, overlap)
+                image_paths.append(full_path)
     elif os.path.isfile(input_path):
-        split_geotiff(input_path, output_dir, tile_width, tile_height, overlap)
+        image_paths = [input_path]
     else:
         raise FileNotFoundError(f"{input_path} does not exist or is not a valid file/directory")
+    split_geotiffs(image_paths, output_dir, tile_width, tile_height, overlap, mode, compress, workers, cache_mb)
 
-if __name__ == "__main__":
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Split GeoTIFF(s) into tiles.")
     parser.add_argument("--image", required=True, help="Path to input GeoTIFF or directory containing GeoTIFFs")
     parser.add_argument("--output", required=True, help="Directory to save tiles")
     parser.add_argument("--x", type=int, required=True, help="Tile width in pixels")
     parser.add_argument("--y", type=int, required=True, help="Tile height in pixels")
     parser.add_argument("--overlap", type=int, default=0, help="Overlap in pixels")
+    parser.add_argument("--mode", choices=MODES, default="tif", help="tif: GeoTIFF tiles (default), vrt: VRT tiles referring to the source, index: a single tile index GeoPackage")
+    parser.add_argument("--compress", default="LZW", help="GeoTIFF compression of the tiles, e.g. LZW (default), DEFLATE, ZSTD or NONE")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: CPU count)")
+    parser.add_argument("--gdal_cache", type=int, default=None, help="GDAL block cache per worker process in MB (default: GDAL's default)")
+    args = parser.parse_args(argv)
+    process_input(args.image, args.output, args.x, args.y, args.overlap, args.mode, args.compress, args.workers, args.gdal_cache)
 
-    args = parser.parse_args()
-    process_input(args.image, args.output, args.x, args.y, args.overlap)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""
+Windowed access to large aerial images.
+
+Instead of decoding a whole oblique TIFF into RAM (which is what SAHI does when it
+is given a path), the readers in this module only decode the TIFF blocks (strips or
+tiles) that a requested window touches. Peak memory is therefore bounded by a few
+slices instead of the full image.
+
+Readers are tried in this order:
+    GDAL (osgeo)  -> block access through RasterIO, uses the GDAL block cache
+    tifffile      -> decodes only the strips/tiles that intersect the window
+    Pillow        -> full decode, used for small formats like PNG and JPEG
+"""
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from profiling import NULL_PROFILER
+
+TIFF_SUFFIXES = (".tif", ".tiff")
+
+# GDAL_NODATA, the TIFF tag GDAL (and tifffile) store the nodata value in
+GDAL_NODATA_TAG = 42113
+
+# Budget for decoded TIFF segments kept by TifffileWindowReader. Strip-organised
+# TIFFs decode full image rows, so a small cache avoids decoding the same strips
+# again for every slice in a row of slices.
+DEFAULT_SEGMENT_CACHE_BYTES = 256 * 1024 * 1024
+
+
+def get_slice_bboxes(image_width, image_height, slice_width, slice_height, overlap_width_ratio, overlap_height_ratio):
+    """
+    Compute slice windows with the same geometry as sahi.slicing.get_slice_bboxes.
+
+    The last slice in every row/column is moved back so that it ends on the image
+    border, which keeps all slices at full size when the image is larger than a slice.
+
+    Returns:
+        list of [x_min, y_min, x_max, y_max] windows in pixel coordinates.
+    """
+    if overlap_height_ratio >= 1.0 or overlap_width_ratio >= 1.0:
+        raise ValueError("Overlap ratio must be less than 1.0")
+    y_overlap = int(overlap_height_ratio * slice_height)
+    x_overlap = int(overlap_width_ratio * slice_width)
+
+    slice_bboxes = []
+    y_max = y_min = 0
+    while y_max < image_height:
+        x_min = x_max = 0
+        y_max = y_min + slice_height
+        while x_max < image_width:
+            x_max = x_min + slice_width
+            if y_max > image_height or x_max > image_width:
+                x_max = min(image_width, x_max)
+                y_max = min(image_height, y_max)
+                x_min = max(0, x_max - slice_width)
+                y_min = max(0, y_max - slice_height)
+            slice_bboxes.append([x_min, y_min, x_max, y_max])
+            x_min = x_max - x_overlap
+        y_min = y_max - y_overlap
+    return slice_bboxes
+
+
+def to_rgb8(array):
+    """
+    Normalize a (height, width[, bands]) array to a contiguous uint8 RGB array,
+    mirroring what PIL's convert("RGB") does for the images we get from the cameras.
+    """
+    if array.ndim == 2:
+        array = array[:, :, np.newaxis]
+    if array.shape[2] >= 3:
+        array = array[:, :, :3]
+    else:
+        array = np.repeat(array[:, :, :1], 3, axis=2)
+    if array.dtype != np.uint8:
+        array = np.clip(array, 0, 255).astype(np.uint8)
+    return np.ascontiguousarray(array)
+
+
+def overview_shape(width, height, factor):
+    """(height, width) of an overview of an image reduced factor times."""
+    return -(-height // factor), -(-width // factor)
+
+
+def sample_nearest(array, shape):
+    """Nearest neighbour resample of a (height, width, ...) array to shape (height, width)."""
+    rows = np.arange(shape[0]) * array.shape[0] // shape[0]
+    cols = np.arange(shape[1]) * array.shape[1] // shape[1]
+    return array[rows[:, np.newaxis], cols]
+
+
+class GdalWindowReader:
+    """Reads windows through GDAL RasterIO, only touching the blocks that are needed."""
+
+    def __init__(self, image_path):
+        from osgeo import gdal
+
+        self.path = str(image_path)
+        self.ds = gdal.Open(self.path)
+        if self.ds is None:
+            raise FileNotFoundError(f"Could not open {image_path}")
+        self.width = self.ds.RasterXSize
+        self.height = self.ds.RasterYSize
+        self.nodata = self.ds.GetRasterBand(1).GetNoDataValue()
+
+    def read_window(self, x_min, y_min, x_max, y_max):
+        data = self.ds.ReadAsArray(int(x_min), int(y_min), int(x_max - x_min), int(y_max - y_min))
+        if data.ndim == 3:
+            data = np.moveaxis(data, 0, -1)
+        return to_rgb8(data)
+
+    def read_overview(self, factor):
+        """The image reduced factor times (nearest neighbour), from its overviews when it has them."""
+        height, width = overview_shape(self.width, self.height, factor)
+        data = self.ds.ReadAsArray(0, 0, self.width, self.height, buf_xsize=width, buf_ysize=height)
+        if data.ndim == 3:
+            data = np.moveaxis(data, 0, -1)
+        return to_rgb8(data)
+
+    def close(self):
+        self.ds = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TifffileWindowReader:
+    """
+    Reads windows from a TIFF by decoding only the strips/tiles that intersect them.
+
+    Decoded segments are kept in a small LRU cache (bounded in bytes) because
+    neighbouring slices overlap and, for striped TIFFs, share the same strips.
+    """
+
+    def __init__(self, image_path, cache_bytes=DEFAULT_SEGMENT_CACHE_BYTES):
+        import tifffile
+
+        self.path = str(image_path)
+        self.tif = tifffile.TiffFile(self.path)
+        self.page = self.tif.pages[0]
+        if self.page.imagedepth != 1:
+            self.tif.close()
+            raise ValueError(f"Volumetric TIFFs are not supported: {image_path}")
+        self.width = self.page.imagewidth
+        self.height = self.page.imagelength
+        self.nodata = self.page.nodata if GDAL_NODATA_TAG in self.page.tags else None
+        self.samples = self.page.samplesperpixel
+        # planarconfig 2 stores every sample in its own set of segments
+        self.planes = self.samples if self.page.planarconfig == 2 else 1
+        if self.page.is_tiled:
+            self.segment_width = self.page.tilewidth
+            self.segment_height = self.page.tilelength
+        else:
+            self.segment_width = self.width
+            self.segment_height = min(self.page.rowsperstrip, self.height)
+        self.segments_across = -(-self.width // self.segment_width)
+        self.segments_down = -(-self.height // self.segment_height)
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        try:
+            # fail early (and fall back) when the compression codec is not available
+            self._segment(0)
+        except ValueError:
+            self.tif.close()
+            raise
+
+    def _segment(self, index):
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+
+        page = self.page
+        offset = page.dataoffsets[index]
+        bytecount = page.databytecounts[index]
+        data = None
+        if bytecount:
+            fh = self.tif.filehandle
+            fh.seek(offset)
+            data = fh.read(bytecount)
+        segment, position, shape = page.decode(data, index, jpegtables=page.jpegtables)
+        entry = (segment, position, shape)
+
+        self._cache[index] = entry
+        self._cached_bytes += 0 if segment is None else segment.nbytes
+        while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+            _, (old, _, _) = self._cache.popitem(last=False)
+            self._cached_bytes -= 0 if old is None else old.nbytes
+        return entry
+
+    def read_window(self, x_min, y_min, x_max, y_max):
+        x_min, y_min, x_max, y_max = int(x_min), int(y_min), int(x_max), int(y_max)
+        out = np.zeros((y_max - y_min, x_max - x_min, self.samples), dtype=self.page.dtype)
+
+        first_row, last_row = y_min // self.segment_height, (y_max - 1) // self.segment_height
+        first_col, last_col = x_min // self.segment_width, (x_max - 1) // self.segment_width
+        per_plane = self.segments_across * self.segments_down
+
+        for plane in range(self.planes):
+            for row in range(first_row, last_row + 1):
+                for col in range(first_col, last_col + 1):
+                    index = plane * per_plane + row * self.segments_across + col
+                    segment, position, shape = self._segment(index)
+                    if segment is None:
+                        continue
+                    # position/shape are given in the normalized
+                    # (separate sample, depth, length, width, contig sample) layout
+                    seg_y, seg_x = position[2], position[3]
+                    seg_h = min(shape[1], self.height - seg_y)
+                    seg_w = min(shape[2], self.width - seg_x)
+                    y0, y1 = max(y_min, seg_y), min(y_max, seg_y + seg_h)
+                    x0, x1 = max(x_min, seg_x), min(x_max, seg_x + seg_w)
+                    if y0 >= y1 or x0 >= x1:
+                        continue
+                    block = segment[0, y0 - seg_y:y1 - seg_y, x0 - seg_x:x1 - seg_x, :]
+                    if self.planes > 1:
+                        out[y0 - y_min:y1 - y_min, x0 - x_min:x1 - x_min, position[0]] = block[:, :, 0]
+                    else:
+                        out[y0 - y_min:y1 - y_min, x0 - x_min:x1 - x_min, :] = block
+        return to_rgb8(out)
+
+    def read_overview(self, factor):
+        """
+        The image reduced factor times (nearest neighbour). Read from the smallest
+        reduced resolution level of the TIFF that still has that size, otherwise
+        sampled from the full resolution image in bands of rows.
+        """
+        shape = overview_shape(self.width, self.height, factor)
+        levels = self.tif.series[0].levels
+        for level in reversed(levels[1:]):
+            level_height, level_width = level.shape[level.axes.index("Y")], level.shape[level.axes.index("X")]
+            if level_height >= shape[0] and level_width >= shape[1]:
+                data = level.asarray()
+                if level.axes.startswith("S"):
+                    data = np.moveaxis(data, 0, -1)
+                return to_rgb8(sample_nearest(data, shape))
+
+        band_height = self.segment_height * -(-256 // self.segment_height)
+        bands = []
+        for y_min in range(0, self.height, band_height):
+            y_max = min(y_min + band_height, self.height)
+            first = -(-y_min // factor) * factor  # first sampled row in the band
+            if first < y_max:
+                bands.append(self.read_window(0, first, self.width, y_max)[::factor, ::factor])
+        return np.ascontiguousarray(np.concatenate(bands))
+
+    def close(self):
+        self._cache.clear()
+        self._cached_bytes = 0
+        self.tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PillowWindowReader:
+    """Fallback for formats without block access (PNG, JPEG, ...): decodes the image once."""
+
+    def __init__(self, image_path):
+        from PIL import Image
+
+        self.path = str(image_path)
+        with Image.open(self.path) as img:
+            self.array = to_rgb8(np.asarray(img.convert("RGB")))
+        self.height, self.width = self.array.shape[:2]
+        self.nodata = None
+
+    def read_window(self, x_min, y_min, x_max, y_max):
+        return np.ascontiguousarray(self.array[int(y_min):int(y_max), int(x_min):int(x_max)])
+
+    def read_overview(self, factor):
+        return np.ascontiguousarray(self.array[::factor, ::factor])
+
+    def close(self):
+        self.array = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_window_reader(image_path):
+    """
+    Open the cheapest available windowed reader for an image.
+    TIFFs are read block-wise through GDAL, or tifffile when GDAL is not installed.
+    """
+    if Path(image_path).suffix.lower() in TIFF_SUFFIXES:
+        try:
+            return GdalWindowReader(image_path)
+        except ImportError:
+            pass
+        try:
+            return TifffileWindowReader(image_path)
+        except ValueError as e:
+            print(f"Block access not possible for {image_path} ({e}), decoding the full image.")
+    return PillowWindowReader(image_path)
+
+
+def iter_slice_windows(reader, slice_width, overlap_ratio, slice_filter=None, profiler=NULL_PROFILER):
+    """
+    Yield ((x_min, y_min, x_max, y_max), rgb_array) for every square slice of an image,
+    reading one window at a time from the reader. With a slice_filter.SliceFilter,
+    only the slices it keeps are read. The slice and read times go to the images
+    profiler.for_images has set.
+    """
+    with profiler.span("slice"):
+        slice_bboxes = get_slice_bboxes(
+            reader.width, reader.height, slice_width, slice_width, overlap_ratio, overlap_ratio
+        )
+        if slice_filter is not None:
+            slice_bboxes = slice_filter.filter_slices(reader, slice_bboxes)
+    profiler.count("slices", len(slice_bboxes))
+    for bbox in slice_bboxes:
+        with profiler.span("read"):
+            window = reader.read_window(*bbox)
+        yield tuple(bbox), window
@@ -10,6 +10,8 @@ def main():
     parser.add_argument('--device', type=str, default='cuda:0', help='Device to use, e.g., "cuda:0", "cpu", "0,1"')
     parser.add_argument('--image', type=str, help='Optional path to an image for inference after training')
     parser.add_argument('--export', action='store_true', help='If set, export the trained model to ONNX format')
+    parser.add_argument('--export_int8', action='store_true', help='If set, also export a static INT8 quantized ONNX model (implies --export) and report its mAP and speed against the FP32 model')
+    parser.add_argument('--calibration_images', type=int, default=100, help='Number of training images to calibrate the INT8 model on (default: 100)')
     args = parser.parse_args()
 
     # Load YOLO model
@@ -32,9 +34,15 @@ def main():
         results[0].show()
 
     # Optionally export the model
-    if args.export:
+    if args.export or args.export_int8:
         export_path = model.export(format='onnx')
         print(f"Model exported to: {export_path}")
 
+    # Optionally quantize the export, calibrated on the training images
+    if args.export_int8:
+        from quantize_onnx import evaluate_quantization, quantize_model
+        int8_path = quantize_model(export_path, args.data, num_calibration=args.calibration_images)
+        evaluate_quantization(export_path, int8_path, args.data)
+
 if __name__ == '__main__':
     main()
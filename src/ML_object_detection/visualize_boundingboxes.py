@@ -2,9 +2,6 @@ import argparse
 import json
 from pathlib import Path
 import numpy as np
-import rasterio
-from rasterio.features import rasterize
-from shapely.geometry import box
 
 
 def get_color_map(labels):
@@ -24,7 +21,200 @@ def get_color_map(labels):
     return {label: base_colors[i % len(base_colors)] for i, label in enumerate(labels)}
 
 
-def draw_bounding_boxes_rasterio(image_path, json_path, output_path):
+# size of the output blocks, the image is read, drawn and written one block at a time
+BLOCK_SIZE = 512
+# how the overviews are reduced from the drawn blocks
+RESAMPLING = ("nearest", "average")
+
+
+def box_pixel_ranges(boxes, transform):
+    """
+    Pixel ranges of rectangles given in the coordinates of the transform.
+
+    The ranges are the pixels rasterio.features.rasterize burns for
+    shapely.geometry.box(x1, y1, x2, y2) with the same transform: the coordinates
+    are mapped to pixels with the inverse geotransform, as GDAL computes it, and
+    a pixel is burnt when its center is inside the box (GDAL's edge rules).
+
+    Args:
+        boxes: (N, 4) array of x1, y1, x2, y2.
+        transform: affine transform of the raster, without rotation.
+
+    Returns:
+        (row_start, row_end, col_start, col_end) integer arrays, the ends exclusive.
+    """
+    if transform.b != 0 or transform.d != 0:
+        raise ValueError("Rotated geotransforms are not supported")
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    px = -transform.c / transform.a + boxes[:, [0, 2]] * (1.0 / transform.a)
+    py = -transform.f / transform.e + boxes[:, [1, 3]] * (1.0 / transform.e)
+    px1, px2 = px.min(axis=1), px.max(axis=1)
+    py1, py2 = py.min(axis=1), py.max(axis=1)
+
+    col_start = np.floor(px1 + 0.5)
+    col_end = np.floor(px2 + 0.5)
+    row_start = np.ceil(py1 - 0.5)
+    # the bottom edge counts as inside when the transform flips the orientation
+    # (north up rasters) and for boxes without height
+    closed = (transform.a * transform.e < 0) | (py1 == py2)
+    row_end = np.where(closed, np.floor(py2 - 0.5) + 1, np.ceil(py2 - 0.5))
+    return row_start.astype(np.int64), row_end.astype(np.int64), col_start.astype(np.int64), col_end.astype(np.int64)
+
+
+def index_boxes_by_block(row_start, row_end, col_start, col_end, height, width, block_size):
+    """
+    Map every block (block_row, block_col) of the raster to the boxes that touch it.
+
+    Returns:
+        dict (block_row, block_col) -> array of box indices in drawing order.
+    """
+    row_start, col_start = np.maximum(row_start, 0), np.maximum(col_start, 0)
+    row_end, col_end = np.minimum(row_end, height), np.minimum(col_end, width)
+    visible = np.flatnonzero((row_end > row_start) & (col_end > col_start))
+
+    block_row0 = row_start[visible] // block_size
+    block_col0 = col_start[visible] // block_size
+    rows = (row_end[visible] - 1) // block_size - block_row0 + 1
+    cols = (col_end[visible] - 1) // block_size - block_col0 + 1
+    counts = rows * cols
+    box_index = np.repeat(visible, counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    block_row = np.repeat(block_row0, counts) + local // np.repeat(cols, counts)
+    block_col = np.repeat(block_col0, counts) + local % np.repeat(cols, counts)
+
+    index = {}
+    order = np.lexsort((box_index, block_col, block_row))
+    keys = block_row[order] * (width // block_size + 1) + block_col[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    for start, end in zip(starts, np.r_[starts[1:], len(keys)]):
+        k = order[start]
+        index[(int(block_row[k]), int(block_col[k]))] = box_index[order[start:end]]
+    return index
+
+
+def read_rgb_window(src, window):
+    """Read a window as 3 uint8 bands, a single band image is repeated as gray."""
+    if src.count < 3:
+        return np.repeat(src.read(1, window=window, out_dtype="uint8")[np.newaxis], 3, axis=0)
+    return src.read([1, 2, 3], window=window, out_dtype="uint8")
+
+
+def iter_rendered_blocks(src, shapes, label_to_color, block_size=BLOCK_SIZE):
+    """
+    Yield (window, RGB array) for every block of src with the rectangles drawn on it.
+
+    Like drawing on the full image: every rectangle fills its pixels with its class
+    color, per band the maximum color value of the overlapping rectangles, and a
+    band keeps the image value where that maximum is 0.
+    """
+    from rasterio.windows import Window
+
+    rectangles = [shape for shape in shapes if shape.get("shape_type") == "rectangle"]
+    boxes = np.array([[*shape["points"][0], *shape["points"][1]] for shape in rectangles], dtype=np.float64).reshape(-1, 4)
+    colors = np.array([label_to_color.get(shape["label"], (255, 255, 255)) for shape in rectangles], dtype=np.uint8).reshape(-1, 3)
+    row_start, row_end, col_start, col_end = box_pixel_ranges(boxes, src.transform)
+    blocks = index_boxes_by_block(row_start, row_end, col_start, col_end, src.height, src.width, block_size)
+
+    for block_row, row_off in enumerate(range(0, src.height, block_size)):
+        for block_col, col_off in enumerate(range(0, src.width, block_size)):
+            window = Window(col_off, row_off, min(block_size, src.width - col_off), min(block_size, src.height - row_off))
+            img_data = read_rgb_window(src, window)
+
+            box_indices = blocks.get((block_row, block_col))
+            if box_indices is not None:
+                overlay = np.zeros_like(img_data)
+                for k in box_indices:
+                    r0 = max(row_start[k] - row_off, 0)
+                    r1 = min(row_end[k] - row_off, window.height)
+                    c0 = max(col_start[k] - col_off, 0)
+                    c1 = min(col_end[k] - col_off, window.width)
+                    region = overlay[:, r0:r1, c0:c1]
+                    np.maximum(region, colors[k][:, np.newaxis, np.newaxis], out=region)
+                # Combine original image + overlay (overlay just replaces pixels on boxes)
+                img_data = np.where(overlay > 0, overlay, img_data)
+            yield window, img_data
+
+
+def auto_overview_levels(width, height, block_size):
+    """
+    Overview factors 2, 4, 8, ... until the smallest overview fits in one block,
+    like gdaladdo without levels (at most block_size, see decimate_block).
+    """
+    levels = []
+    factor = 1
+    while -(-max(width, height) // factor) > block_size and factor < block_size:
+        factor *= 2
+        levels.append(factor)
+    return levels
+
+
+def decimate_block(data, factor, resampling):
+    """
+    Reduce a (bands, rows, cols) uint8 block by factor for an overview.
+
+    Every overview pixel comes from the factor x factor pixels it covers, so a
+    block whose offset is a multiple of factor fills its own part of the overview.
+    A partial last row or column of the block is reduced from the pixels it has.
+
+    Args:
+        data: The drawn block.
+        factor (int): Overview factor.
+        resampling (str): "nearest" takes the first pixel (like GDAL), "average" the rounded mean.
+    """
+    if resampling == "nearest":
+        return data[:, ::factor, ::factor]
+
+    rows, cols = data.shape[1:]
+    row_starts = np.arange(0, rows, factor)
+    col_starts = np.arange(0, cols, factor)
+    sums = np.add.reduceat(np.add.reduceat(data.astype(np.uint32), row_starts, axis=1), col_starts, axis=2)
+    counts = np.outer(np.diff(np.r_[row_starts, rows]), np.diff(np.r_[col_starts, cols]))
+    return ((sums + counts // 2) // counts).astype(np.uint8)
+
+
+def create_output(output_path, src, block_size, overview_levels):
+    """
+    Create the tiled 3 band output TIFF with the georeference of src and empty
+    internal overviews, which are filled while the blocks are written.
+    """
+    from osgeo import gdal
+
+    options = ["TILED=YES", f"BLOCKXSIZE={block_size}", f"BLOCKYSIZE={block_size}", "COMPRESS=DEFLATE", "BIGTIFF=YES"]
+    dst = gdal.GetDriverByName("GTiff").Create(output_path, src.width, src.height, 3, gdal.GDT_Byte, options=options)
+    if dst is None:
+        raise IOError(f"Could not create {output_path}")
+    dst.SetGeoTransform(src.transform.to_gdal())
+    if src.crs:
+        dst.SetProjection(src.crs.to_wkt())
+    if src.nodata is not None:
+        for band in range(1, 4):
+            dst.GetRasterBand(band).SetNoDataValue(src.nodata)
+    if overview_levels:
+        # "NONE" only allocates the overviews, they are written from the drawn blocks
+        dst.BuildOverviews("NONE", list(overview_levels))
+    return dst
+
+
+def draw_bounding_boxes_rasterio(image_path, json_path, output_path, block_size=BLOCK_SIZE, overview_levels=None, resampling="average"):
+    """
+    Draw the rectangles of a LabelMe JSON on a (huge) image into a new tiled TIFF.
+
+    The image is processed block by block, so memory stays bounded by the block
+    size, and every box is only drawn into the blocks it touches. The internal
+    overviews are written in the same pass from the drawn blocks, so the output
+    opens quickly in QGIS without a second read of the image.
+
+    Args:
+        image_path (str): Image to draw on.
+        json_path (str): LabelMe JSON with the rectangles.
+        output_path (str): Output TIFF.
+        block_size (int): Tile size of the output, a multiple of 16.
+        overview_levels (list): Overview factors, powers of 2 up to block_size
+            (None: automatic, empty: no overviews).
+        resampling (str): One of RESAMPLING.
+    """
+    import rasterio
+
     # Load JSON bounding boxes
     with open(json_path, "r", encoding="utf-8") as f:
         data = json.load(f)
@@ -36,59 +226,40 @@ def draw_bounding_boxes_rasterio(image_path, json_path, output_path):
 
     # Open large image with rasterio
     with rasterio.open(image_path) as src:
-        meta = src.meta.copy()
-
-        # Ensure output has 3 bands (RGB)
-        meta.update(count=3, dtype="uint8", compress="deflate", BIGTIFF="YES")
-
-        # Read original image into memory (careful if extremely large!)
-        img_data = src.read(out_dtype="uint8")
-
-        # If grayscale, expand to RGB
-        if img_data.shape[0] == 1:
-            img_data = np.repeat(img_data, 3, axis=0)
-
-    # Create overlay mask for bounding boxes
-    overlay = np.zeros_like(img_data, dtype=np.uint8)
-
-    # Rasterize each bounding box into overlay
-    for shape in shapes:
-        print("new shape")
-        if shape.get("shape_type") != "rectangle":
-            continue
-        pts = shape["points"]
-        (x1, y1), (x2, y2) = pts
-        print((x1, y1))
-        geom = box(x1, y1, x2, y2)
-        color = label_to_color.get(shape["label"], (255, 255, 255))
-
-        # Burn each channel separately
-        for band, val in enumerate(color):
-            mask = rasterize(
-                [(geom, val)],
-                out_shape=(overlay.shape[1], overlay.shape[2]),
-                transform=src.transform,
-                fill=0,
-                dtype="uint8"
-            )
-            overlay[band] = np.maximum(overlay[band], mask)
-
-    # Combine original image + overlay (overlay just replaces pixels on boxes)
-    img_out = np.where(overlay > 0, overlay, img_data)
-
-    # Save new TIFF
-    with rasterio.open(output_path, "w", **meta) as dst:
-        dst.write(img_out)
-
-
-def main():
+        if overview_levels is None:
+            overview_levels = auto_overview_levels(src.width, src.height, block_size)
+        overview_levels = sorted(set(overview_levels))
+        for factor in overview_levels:
+            if factor < 2 or block_size % factor:
+                raise ValueError(f"Overview level {factor} must be at least 2 and divide the block size {block_size}")
+
+        dst = create_output(output_path, src, block_size, overview_levels)
+        bands = [dst.GetRasterBand(band) for band in range(1, 4)]
+        for window, img_data in iter_rendered_blocks(src, shapes, label_to_color, block_size):
+            col_off, row_off = int(window.col_off), int(window.row_off)
+            for band, band_data in zip(bands, img_data):
+                band.WriteArray(band_data, col_off, row_off)
+            # GDAL keeps the overviews sorted from large to small, like overview_levels
+            for level, factor in enumerate(overview_levels):
+                reduced = decimate_block(img_data, factor, resampling)
+                for band, band_data in zip(bands, reduced):
+                    band.GetOverview(level).WriteArray(band_data, col_off // factor, row_off // factor)
+        dst = None  # close and flush the TIFF
+
+    print(f"Wrote '{output_path}' with overview levels {overview_levels}.")
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Draw bounding boxes on a huge TIFF using rasterio")
     parser.add_argument("--largeimage", required=True, help="Path to the large input TIFF image")
     parser.add_argument("--json", required=True, help="Path to the merged JSON file with bounding boxes")
     parser.add_argument("--new_large_tiff", required=True, help="Path to the output TIFF with drawn boxes")
-    args = parser.parse_args()
+    parser.add_argument("--block_size", type=int, default=BLOCK_SIZE, help=f"Size of the blocks the image is drawn in, a multiple of 16 (default: {BLOCK_SIZE})")
+    parser.add_argument("--overview_levels", type=int, nargs="*", default=None, help="Overview factors, powers of 2 up to the block size, e.g. 2 4 8 16 (default: automatic, no values: no overviews)")
+    parser.add_argument("--resampling", choices=RESAMPLING, default="average", help="How the overviews are reduced from the drawn image (default: average)")
+    args = parser.parse_args(argv)
 
-    draw_bounding_boxes_rasterio(args.largeimage, args.json, args.new_large_tiff)
+    draw_bounding_boxes_rasterio(args.largeimage, args.json, args.new_large_tiff, args.block_size, args.overview_levels, args.resampling)
 
 
 if __name__ == "__main__":